@@ -1,14 +1,12 @@
 # app.py
 import streamlit as st
+import lazy_imports         # 重いモジュールの遅延インポートと起動時間の計測
+lazy_imports.start_import_profile()  # STARTUP_PROFILE=1 のときだけモジュールごとのインポート時間を記録
 import ui                   # UIモジュール
 import llm                  # LLMモジュール
 import database             # データベースモジュール
 import metrics              # 評価指標モジュール
 import data                 # データモジュール
-import torch
-from transformers import pipeline
-from config import MODEL_NAME
-from huggingface_hub import HfFolder
 
 
 
@@ -16,8 +14,7 @@ from huggingface_hub import HfFolder
 st.set_page_config(page_title="Gemma Chatbot", layout="wide")
 
 # --- 初期化処理 ---
-# NLTKデータのダウンロード（初回起動時など）
-metrics.initialize_nltk()
+# NLTKデータの確認は評価指標を初めて計算するときに1回だけ行う（metrics.initialize_nltk）
 
 # データベースの初期化（テーブルが存在しない場合、作成）
 database.init_db()
@@ -27,27 +24,9 @@ data.ensure_initial_data()
 # set background color to black
 
 
-# LLMモデルのロード（キャッシュを利用）
-# モデルをキャッシュして再利用
-@st.cache_resource
-def load_model():
-    """LLMモデルをロードする"""
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        st.success(f"Success loading model '{MODEL_NAME}'")
-        return pipe
-    except Exception as e:
-        st.error(f"Failed to load model '{MODEL_NAME}': {e}")
-        st.error("There may be insufficient GPU memory. Please terminate unnecessary processes or consider using a smaller model.")
-        return None
-pipe = llm.load_model()
+# モデルはバックグラウンドで読み込み、読み込み中もページはすぐに表示する
+model_loader = llm.get_model_loader()
+pipe = model_loader.model
 
 # --- Streamlit アプリケーション ---
 st.title("llama 3.2-3B Chatbot with Feedback")
@@ -74,16 +53,31 @@ page = st.sidebar.radio(
 
 # --- Main Content ---
 if st.session_state.page == "Chat":
-    if pipe:
-        ui.display_chat_page(pipe)
-    else:
-        st.error("Chat functionality is unavailable. Failed to load the model.")
+    if not pipe:
+        # 読み込み状態を表示し、準備ができたらページを再実行する（それまでチャット入力は無効）
+        ui.display_model_status(model_loader)
+    ui.display_chat_page(pipe)
 elif st.session_state.page == "View History":
     ui.display_history_page()
 elif st.session_state.page == "Manage Sample Data":
     ui.display_data_page()
 
 
+# --- Response cache ---
+st.sidebar.markdown("---")
+st.sidebar.checkbox("Reuse cached answers for repeated questions", key="cache_sampled")
+cache_stats = llm.get_response_cache().stats()
+st.sidebar.caption(
+    f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+    f"({cache_stats['hit_rate']:.0%} hit rate, {cache_stats['memory_entries']} entries)"
+)
+
+# --- Telemetry ---
+ui.display_telemetry_panel(llm.get_metrics())
+
 st.sidebar.markdown("---")
 st.sidebar.info("Developer: Komori Koki")
 
+# 起動時のインポート時間を表示（STARTUP_PROFILE=1 の場合のみ）
+lazy_imports.print_import_profile()
+
@@ -0,0 +1,98 @@
+# benchmark_bucketing.py
+# Compare the padding efficiency of batching prompts in arrival order, sorted by length, and
+# length-bucketed (bucketing.plan_batches) on a synthetic, heavy-tailed prompt length distribution,
+# and optionally time real generation of arrival-order and bucketed batches with a model.
+# Usage: python benchmark_bucketing.py --prompts 2000 --batch-size 8
+#        python benchmark_bucketing.py --model meta-llama/Llama-3.2-1B-Instruct --prompts 32 --max-new-tokens 16
+import argparse
+import random
+import time
+
+import shared_path  # Puts ../shared on sys.path
+import bucketing
+
+
+def synthetic_lengths(count, median, sigma, max_length, seed=0):
+    """Log-normal prompt lengths in tokens: mostly short prompts with a long tail up to max_length"""
+    rng = random.Random(seed)
+    return [min(max_length, max(1, round(rng.lognormvariate(0, sigma) * median))) for _ in range(count)]
+
+
+def arrival_batches(count, batch_size):
+    return [list(range(start, min(count, start + batch_size))) for start in range(0, count, batch_size)]
+
+
+def sorted_batches(lengths, batch_size):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def padding_stats(lengths, batches):
+    stats = bucketing.PaddingStats()
+    for batch in batches:
+        stats.record([lengths[i] for i in batch])
+    return stats.stats()
+
+
+def time_generation(model_name, lengths, batch_size, min_efficiency, max_new_tokens):
+    """Seconds to generate for prompts of the given lengths in arrival order and bucketed"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float32)
+    vocab = [i for i in range(min(len(tokenizer), 30000)) if i not in tokenizer.all_special_ids]
+    rng = random.Random(1)
+    input_ids = [[rng.choice(vocab) for _ in range(length)] for length in lengths]
+    # Force exactly max_new_tokens so both orders do the same decoding work
+    kwargs = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False}
+
+    bucketing.generate_from_ids(model, tokenizer, input_ids[:1], **kwargs)  # Warm-up
+    start_time = time.perf_counter()
+    for batch in arrival_batches(len(input_ids), batch_size):
+        bucketing.generate_from_ids(model, tokenizer, [input_ids[i] for i in batch], **kwargs)
+    arrival_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    bucketing.generate_bucketed(model, tokenizer, input_ids, batch_size, min_efficiency=min_efficiency, **kwargs)
+    return arrival_seconds, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Padding efficiency of arrival-order, sorted and bucketed batching")
+    parser.add_argument("--prompts", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--median-length", type=int, default=64, help="Median prompt length in tokens")
+    parser.add_argument("--sigma", type=float, default=1.2, help="Spread of the log-normal length distribution")
+    parser.add_argument("--max-length", type=int, default=4096)
+    parser.add_argument("--min-efficiency", type=float, default=0.5,
+                        help="Merge partly filled bucket batches while they keep this share of real tokens")
+    parser.add_argument("--model", default=None, help="Also time generation with this model (uses --prompts prompts)")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    args = parser.parse_args()
+
+    lengths = synthetic_lengths(args.prompts, args.median_length, args.sigma, args.max_length)
+    ordered = sorted(lengths)
+    print(f"{len(lengths)} prompts, batch size {args.batch_size}, lengths min {ordered[0]} / "
+          f"median {ordered[len(ordered) // 2]} / p95 {ordered[int(len(ordered) * 0.95)]} / max {ordered[-1]} tokens")
+    plans = {
+        "arrival order": arrival_batches(len(lengths), args.batch_size),
+        "sorted": sorted_batches(lengths, args.batch_size),
+        "bucketed": bucketing.plan_batches(lengths, args.batch_size),
+        f"bucketed+merge {args.min_efficiency:g}": bucketing.plan_batches(
+            lengths, args.batch_size, min_efficiency=args.min_efficiency),
+    }
+    print(f"{'batching':>20s} {'batches':>8s} {'efficiency':>10s} {'padded tokens':>14s}")
+    for name, batches in plans.items():
+        stats = padding_stats(lengths, batches)
+        print(f"{name:>20s} {stats['batches']:8d} {stats['efficiency']:10.1%} {stats['padded_tokens']:14d}")
+
+    if args.model:
+        arrival_seconds, bucketed_seconds = time_generation(
+            args.model, lengths, args.batch_size, args.min_efficiency, args.max_new_tokens)
+        print(f"\nGeneration with {args.model} ({args.max_new_tokens} new tokens per prompt):")
+        print(f"  arrival order: {arrival_seconds:.2f} s")
+        print(f"  bucketed:      {bucketed_seconds:.2f} s ({arrival_seconds / bucketed_seconds:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
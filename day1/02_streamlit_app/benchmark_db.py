@@ -0,0 +1,122 @@
+# benchmark_db.py
+# Compare concurrent insert/read throughput of the old connect-per-call access pattern
+# against the persistent per-thread WAL connections in database.py, and time history page
+# queries on a large table.
+# Usage: python benchmark_db.py --threads 8 --ops 500 --history-rows 1000000
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import database
+
+ROW = ("2025-01-01 00:00:00", "question", "answer", "correct", "correct answer", 1.0, 1.2, 0.5, 0.5, 10, 0.5)
+INSERT_SQL = f'''
+INSERT INTO {database.TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
+                                   response_time, bleu_score, similarity_score, word_count, relevance_score)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+READ_SQL = f"SELECT COUNT(*) FROM {database.TABLE_NAME}"
+
+
+def baseline_op(db_file, sql, params=()):
+    """Previous behaviour: open a fresh connection with default pragmas for every call"""
+    conn = sqlite3.connect(db_file, timeout=5)
+    try:
+        conn.execute(sql, params)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pooled_op(db_file, sql, params=()):
+    """New behaviour: reuse this thread's tuned connection"""
+    def operation(conn):
+        with conn:
+            conn.execute(sql, params)
+    database.run_with_retry(operation, db_file)
+
+
+def run(op, db_file, threads, ops, write_ratio):
+    """Run `ops` operations on each of `threads` threads and return operations per second"""
+    writes_every = max(1, round(1 / write_ratio)) if write_ratio > 0 else None
+
+    def worker():
+        for i in range(ops):
+            if writes_every and i % writes_every == 0:
+                op(db_file, INSERT_SQL, ROW)
+            else:
+                op(db_file, READ_SQL)
+        database.close_connection(db_file)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start_time = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * ops / (time.perf_counter() - start_time)
+
+
+def benchmark_history_paging(db_file, rows):
+    """Fill the table with `rows` rows and time the queries behind one history page flip"""
+    conn = sqlite3.connect(db_file)
+    conn.execute(database.SCHEMA)
+    for index in database.INDEXES:
+        conn.execute(index)
+    scores = [1.0, 0.5, 0.0]
+    batch = []
+    for i in range(rows):
+        timestamp = f"2025-01-01 00:{(i // 60) % 60:02d}:{i % 60:02d}.{i:07d}"
+        batch.append((timestamp,) + ROW[1:5] + (scores[i % 3],) + ROW[6:])
+        if len(batch) == 100000:
+            conn.executemany(INSERT_SQL, batch)
+            batch = []
+    if batch:
+        conn.executemany(INSERT_SQL, batch)
+    conn.commit()
+    conn.close()
+
+    def timed_ms(fn, repeat=20):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        return (time.perf_counter() - start_time) * 1000 / repeat, result
+
+    print(f"History paging with {rows} rows:")
+    latest_ms, _ = timed_ms(lambda: database.get_latest_history_id(db_file=db_file))
+    print(f"  latest id (every rerun; counts are cached until it changes): {latest_ms:6.2f} ms")
+    for label, is_correct in [("all", None), ("correct only", 1.0)]:
+        count_ms, total = timed_ms(lambda: database.count_chat_history(is_correct, db_file=db_file))
+        first_ms, page = timed_ms(lambda: database.get_chat_history_page(is_correct, limit=5, db_file=db_file))
+        after = (page.iloc[-1]["timestamp"], int(page.iloc[-1]["id"]))
+        next_ms, _ = timed_ms(lambda: database.get_chat_history_page(is_correct, limit=5, after=after, db_file=db_file))
+        deep_ms, _ = timed_ms(lambda: database.get_chat_history_page(is_correct, limit=5, offset=total // 2, db_file=db_file), repeat=3)
+        print(f"  {label:13s}: count {count_ms:6.1f} ms, first page {first_ms:6.1f} ms, "
+              f"next page (keyset) {next_ms:6.1f} ms, middle page (offset) {deep_ms:6.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite access benchmark for database.py")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=500, help="Operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.5, help="Fraction of operations that are inserts")
+    parser.add_argument("--history-rows", type=int, default=0, help="Also time history page queries on a table of this size")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, op in [("before (connect per call)", baseline_op), ("after (pooled WAL)", pooled_op)]:
+            db_file = os.path.join(tmp, f"{op.__name__}.db")
+            conn = sqlite3.connect(db_file)
+            conn.execute(database.SCHEMA)
+            conn.close()
+            ops_per_sec = run(op, db_file, args.threads, args.ops, args.write_ratio)
+            print(f"{label:28s}: {ops_per_sec:10.0f} ops/s")
+        if args.history_rows:
+            benchmark_history_paging(os.path.join(tmp, "history.db"), args.history_rows)
+
+
+if __name__ == "__main__":
+    main()
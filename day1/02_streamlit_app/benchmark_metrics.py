@@ -0,0 +1,72 @@
+# benchmark_metrics.py
+# Measure the per-call cost of metrics.calculate_metrics on the SAMPLE_QUESTIONS_DATA corpus,
+# comparing a fresh Janome Tokenizer per call (previous behaviour) with the shared tokenizer and cache,
+# and the per-pair loop with metrics.calculate_metrics_batch.
+# Usage: python benchmark_metrics.py --repeat 5
+import argparse
+import time
+
+from janome.tokenizer import Tokenizer
+
+import metrics
+from data import SAMPLE_QUESTIONS_DATA
+
+
+def per_call_ms(fn, pairs, repeat):
+    """Average milliseconds per (answer, correct_answer) pair"""
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for answer, correct_answer in pairs:
+            fn(answer, correct_answer)
+    return (time.perf_counter() - start_time) * 1000 / (repeat * len(pairs))
+
+
+def fresh_tokenizer_metrics(answer, correct_answer):
+    """Previous behaviour: construct a new Tokenizer (and load its dictionary) for every call"""
+    metrics.clear_token_cache()
+    len(list(Tokenizer().tokenize(answer)))
+    return metrics.calculate_metrics(answer, correct_answer)
+
+
+def shared_tokenizer_uncached(answer, correct_answer):
+    """Shared tokenizer, but every text is tokenized again"""
+    metrics.clear_token_cache()
+    return metrics.calculate_metrics(answer, correct_answer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-call benchmark for metrics.calculate_metrics")
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the sample corpus")
+    parser.add_argument("--batch-repeat", type=int, default=200, help="Copies of the corpus scored by the batch comparison")
+    args = parser.parse_args()
+
+    pairs = [(item["answer"], item["correct_answer"]) for item in SAMPLE_QUESTIONS_DATA]
+    metrics.get_tokenizer()  # Exclude the one-time dictionary load from the shared-tokenizer timings
+
+    before = per_call_ms(fresh_tokenizer_metrics, pairs, args.repeat)
+    shared = per_call_ms(shared_tokenizer_uncached, pairs, args.repeat)
+    metrics.clear_token_cache()
+    cached = per_call_ms(metrics.calculate_metrics, pairs, args.repeat)
+
+    print(f"{len(pairs)} pairs x {args.repeat} passes")
+    print(f"fresh Tokenizer per call : {before:8.2f} ms/call")
+    print(f"shared Tokenizer         : {shared:8.2f} ms/call ({before / shared:.1f}x)")
+    print(f"shared Tokenizer + cache : {cached:8.2f} ms/call ({before / cached:.1f}x)")
+
+    # Batch API on a larger corpus built by repeating the sample pairs
+    batch_pairs = pairs * args.batch_repeat
+    answers = [a for a, _ in batch_pairs]
+    correct_answers = [c for _, c in batch_pairs]
+    start_time = time.perf_counter()
+    for answer, correct_answer in batch_pairs:
+        metrics.calculate_metrics(answer, correct_answer)
+    single_total = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    metrics.calculate_metrics_batch(answers, correct_answers)
+    batch_total = time.perf_counter() - start_time
+    print(f"{len(batch_pairs)} pairs: calculate_metrics loop {single_total:.2f}s, "
+          f"calculate_metrics_batch {batch_total:.2f}s ({single_total / batch_total:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# benchmark_precision.py
+# Compare the precision modes of precision.py: generation speed (tokens/sec), resident memory, and
+# answer quality (BLEU and cosine similarity from metrics.calculate_metrics) against the float32 baseline.
+# Each mode runs in a fresh process so memory figures do not include the other modes.
+# Usage: python benchmark_precision.py --model meta-llama/Llama-3.2-1B-Instruct --precisions float32,bfloat16,int8
+import argparse
+import multiprocessing
+import time
+
+import shared_path  # Puts ../shared on sys.path
+from config import MODEL_NAME
+from data import SAMPLE_QUESTIONS_DATA
+from metrics import calculate_metrics
+
+BASELINE = "float32"
+
+
+def resident_memory_mb():
+    """Current and peak resident memory of this process in MB (None where unavailable)"""
+    current = peak = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return current, peak
+
+
+def run_precision(model_name, mode, questions, max_new_tokens, threads):
+    """Load the model in one precision mode and answer every question greedily (runs in a child process)"""
+    import torch
+    from precision import build_precision_pipeline
+
+    if threads:
+        torch.set_num_threads(threads)
+    start_time = time.perf_counter()
+    pipe = build_precision_pipeline(model_name, mode)
+    load_time = time.perf_counter() - start_time
+    tokenizer, model = pipe.tokenizer, pipe.model
+
+    def answer(question):
+        input_ids = tokenizer.apply_chat_template(
+            [{"role": "user", "content": question}], add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        )["input_ids"].to(model.device)
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=max_new_tokens, do_sample=False
+            )
+        new_tokens = output_ids[0, input_ids.shape[1]:]
+        return tokenizer.decode(new_tokens, skip_special_tokens=True).strip(), len(new_tokens)
+
+    answer(questions[0])  # Warm-up
+    answers, tokens = [], 0
+    start_time = time.perf_counter()
+    for question in questions:
+        text, count = answer(question)
+        answers.append(text)
+        tokens += count
+    seconds = time.perf_counter() - start_time
+    rss, peak_rss = resident_memory_mb()
+    return {"answers": answers, "tokens": tokens, "seconds": seconds, "load_time": load_time, "rss": rss, "peak_rss": peak_rss}
+
+
+def average_metrics(answers, references):
+    """Mean BLEU and similarity of answers against references"""
+    scores = [calculate_metrics(answer, reference)[:2] for answer, reference in zip(answers, references)]
+    return sum(s[0] for s in scores) / len(scores), sum(s[1] for s in scores) / len(scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed, memory and quality of the model precision modes")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--precisions", default="float32,bfloat16,int8", help="Comma-separated precision modes")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--questions", type=int, default=len(SAMPLE_QUESTIONS_DATA), help="Sample questions to answer")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+
+    samples = SAMPLE_QUESTIONS_DATA[:args.questions]
+    questions = [item["question"] for item in samples]
+    references = [item["correct_answer"] for item in samples]
+    modes = [mode.strip() for mode in args.precisions.split(",")]
+    if BASELINE not in modes:
+        modes.insert(0, BASELINE)
+
+    runs = {}
+    ctx = multiprocessing.get_context("spawn")
+    for mode in modes:
+        with ctx.Pool(1) as pool:
+            runs[mode] = pool.apply(run_precision, (args.model, mode, questions, args.max_new_tokens, args.threads))
+        print(f"{mode}: done in {runs[mode]['seconds']:.1f} s")
+
+    baseline = runs[BASELINE]
+    base_bleu, base_similarity = average_metrics(baseline["answers"], references)
+    print(f"\n{len(questions)} questions, up to {args.max_new_tokens} new tokens, model {args.model}")
+    print("BLEU / similarity are against the reference answers (delta vs float32); 'agreement' compares with the float32 answers")
+    print(f"{'precision':>9s} {'tokens/s':>9s} {'load s':>7s} {'RSS MB':>8s} {'peak MB':>8s} "
+          f"{'BLEU':>7s} {'dBLEU':>7s} {'sim':>6s} {'dsim':>7s} {'agree BLEU':>10s} {'agree sim':>9s}")
+    for mode, run in runs.items():
+        bleu, similarity = average_metrics(run["answers"], references)
+        agree_bleu, agree_similarity = average_metrics(run["answers"], baseline["answers"])
+        rss = f"{run['rss']:8.0f}" if run["rss"] is not None else f"{'n/a':>8s}"
+        peak = f"{run['peak_rss']:8.0f}" if run["peak_rss"] is not None else f"{'n/a':>8s}"
+        print(f"{mode:>9s} {run['tokens'] / run['seconds']:9.1f} {run['load_time']:7.1f} {rss} {peak} "
+              f"{bleu:7.4f} {bleu - base_bleu:+7.4f} {similarity:6.3f} {similarity - base_similarity:+7.3f} "
+              f"{agree_bleu:10.4f} {agree_similarity:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
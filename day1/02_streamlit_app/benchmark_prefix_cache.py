@@ -0,0 +1,129 @@
+# benchmark_prefix_cache.py
+# Measure time-to-first-token on CPU for chat prompts that share a system prompt, with and without
+# reusing the prefix key/values from prefix_cache.PrefixKVCache. With --turns, also run a multi-turn
+# conversation through llm.Conversation and report time-to-first-token as the chat grows.
+# Usage: python benchmark_prefix_cache.py --model meta-llama/Llama-3.2-1B-Instruct --system-repeat 20 --turns 30
+import argparse
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from config import MODEL_NAME
+from data import SAMPLE_QUESTIONS_DATA
+from llm import Conversation
+import shared_path  # Puts ../shared on sys.path
+from prefix_cache import PrefixKVCache, chat_prefix_length
+
+SYSTEM_PROMPT = "You are a helpful assistant for a lecture on AI engineering. Answer accurately and concisely. "
+
+
+def time_to_first_token(model, tokenizer, messages, prefix_cache=None):
+    """Seconds until the first new token is produced"""
+    input_ids = tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_dict=True, return_tensors="pt"
+    )["input_ids"][0]
+    start_time = time.perf_counter()
+    if prefix_cache is None:
+        batch = input_ids.unsqueeze(0)
+        with torch.no_grad():
+            model.generate(batch, attention_mask=torch.ones_like(batch), max_new_tokens=1, do_sample=False)
+    else:
+        prefix_length = chat_prefix_length(tokenizer, messages, input_ids)
+        prefix_cache.generate(model, input_ids, prefix_length=prefix_length, max_new_tokens=1, do_sample=False)
+    return time.perf_counter() - start_time, len(input_ids)
+
+
+class FirstTokenTimer:
+    """Streamer that records when generate() emits its first new token"""
+
+    def __init__(self):
+        self.calls = 0
+        self.first_token_at = None
+
+    def put(self, value):
+        self.calls += 1
+        if self.calls == 2:  # The first call carries the prompt
+            self.first_token_at = time.perf_counter()
+
+    def end(self):
+        pass
+
+
+def multi_turn(model, tokenizer, turns, max_context_tokens, answer_tokens, prefix_cache=None):
+    """Time-to-first-token of each turn of a greedy conversation over the sample questions"""
+    conversation = Conversation(max_tokens=max_context_tokens)
+    timings = []
+    for turn in range(turns):
+        question = SAMPLE_QUESTIONS_DATA[turn % len(SAMPLE_QUESTIONS_DATA)]["question"]
+        messages = conversation.context(tokenizer, question)
+        input_ids = tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        )["input_ids"][0]
+        timer = FirstTokenTimer()
+        kwargs = dict(max_new_tokens=answer_tokens, do_sample=False, streamer=timer)
+        start_time = time.perf_counter()
+        if prefix_cache is None:
+            batch = input_ids.unsqueeze(0)
+            with torch.no_grad():
+                output_ids = model.generate(batch, attention_mask=torch.ones_like(batch), **kwargs)
+        else:
+            prefix_length = chat_prefix_length(tokenizer, messages, input_ids)
+            output_ids = prefix_cache.generate(model, input_ids, prefix_length=prefix_length, store_output=True, **kwargs)
+        timings.append((timer.first_token_at - start_time, len(input_ids)))
+        answer = tokenizer.decode(output_ids[0, len(input_ids):], skip_special_tokens=True)
+        conversation.add_turn(tokenizer, question, answer)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-first-token benchmark for the prefix key/value cache")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--system-repeat", type=int, default=20, help="Times the sample system prompt is repeated")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the sample questions")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    parser.add_argument("--turns", type=int, default=0, help="Also run a multi-turn conversation of this many turns")
+    parser.add_argument("--max-context-tokens", type=int, default=2048, help="Context budget for the multi-turn run")
+    parser.add_argument("--answer-tokens", type=int, default=32, help="Tokens generated per turn in the multi-turn run")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32)
+    model.eval()
+
+    system_prompt = SYSTEM_PROMPT * args.system_repeat
+    chats = [
+        [{"role": "system", "content": system_prompt}, {"role": "user", "content": item["question"]}]
+        for item in SAMPLE_QUESTIONS_DATA
+    ] * args.repeat
+    time_to_first_token(model, tokenizer, chats[0])  # Warm-up
+
+    prefix_cache = PrefixKVCache()
+    results = {}
+    for label, cache in [("no prefix cache", None), ("prefix cache", prefix_cache)]:
+        timings = [time_to_first_token(model, tokenizer, messages, cache) for messages in chats]
+        results[label] = sum(t for t, _ in timings) / len(timings)
+        prompt_tokens = sum(n for _, n in timings) / len(timings)
+
+    print(f"{len(chats)} prompts, {prompt_tokens:.0f} tokens on average, model {args.model}")
+    for label, seconds in results.items():
+        print(f"{label:16s}: time to first token {seconds * 1000:8.1f} ms")
+    print(f"speedup: {results['no prefix cache'] / results['prefix cache']:.1f}x, cache stats: {prefix_cache.stats()}")
+
+    if args.turns:
+        print(f"\nMulti-turn conversation, {args.turns} turns, context budget {args.max_context_tokens} tokens")
+        runs = {
+            label: multi_turn(model, tokenizer, args.turns, args.max_context_tokens, args.answer_tokens, cache)
+            for label, cache in [("no prefix cache", None), ("prefix cache", PrefixKVCache())]
+        }
+        print(f"{'turn':>4s} {'prompt tokens':>13s} " + " ".join(f"{label:>18s}" for label in runs))
+        step = max(1, args.turns // 10)
+        for turn in list(range(0, args.turns, step)) + ([args.turns - 1] if (args.turns - 1) % step else []):
+            prompt_tokens = runs["no prefix cache"][turn][1]
+            print(f"{turn + 1:4d} {prompt_tokens:13d} " + " ".join(f"{run[turn][0] * 1000:15.1f} ms" for run in runs.values()))
+
+
+if __name__ == "__main__":
+    main()
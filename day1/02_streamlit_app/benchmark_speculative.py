@@ -0,0 +1,106 @@
+# benchmark_speculative.py
+# Compare speculative decoding (speculative.py: a small draft model proposes tokens that the main model
+# verifies) with plain decoding on the SAMPLE_QUESTIONS_DATA questions: generation speed (tokens/sec),
+# draft acceptance rate, and answer quality (BLEU and cosine similarity from metrics.calculate_metrics).
+# Greedy answers must be identical in both modes; with sampling they follow the same distribution.
+# Usage: python benchmark_speculative.py --model meta-llama/Llama-3.2-3B-Instruct --draft meta-llama/Llama-3.2-1B-Instruct
+import argparse
+import time
+
+import shared_path  # Puts ../shared on sys.path
+from config import DRAFT_MODEL_NAME, DRAFT_TOKENS, MODEL_NAME, PRECISION
+from data import SAMPLE_QUESTIONS_DATA
+from metrics import calculate_metrics
+
+
+def answer_all(pipe, questions, generation_kwargs, decoder=None):
+    """Answer every question one at a time; returns (answers, generated tokens, seconds, per-answer statistics)"""
+    import torch
+
+    tokenizer, model = pipe.tokenizer, pipe.model
+    answers, runs, tokens, seconds = [], [], 0, 0.0
+    for question in questions:
+        input_ids = tokenizer.apply_chat_template(
+            [{"role": "user", "content": question}], add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        )["input_ids"][0]
+        start_time = time.perf_counter()
+        if decoder is not None:
+            output_ids, run = decoder.generate(input_ids, **generation_kwargs)
+            runs.append(run)
+        else:
+            batch = input_ids.reshape(1, -1).to(model.device)
+            with torch.no_grad():
+                output_ids = model.generate(batch, attention_mask=torch.ones_like(batch), **generation_kwargs)
+        seconds += time.perf_counter() - start_time
+        new_tokens = output_ids[0, len(input_ids):]
+        tokens += len(new_tokens)
+        answers.append(tokenizer.decode(new_tokens, skip_special_tokens=True).strip())
+    return answers, tokens, seconds, runs
+
+
+def average_metrics(answers, references):
+    """Mean BLEU and similarity of answers against references"""
+    scores = [calculate_metrics(answer, reference)[:2] for answer, reference in zip(answers, references)]
+    return sum(s[0] for s in scores) / len(scores), sum(s[1] for s in scores) / len(scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speculative decoding with a draft model against plain decoding")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--draft", default=DRAFT_MODEL_NAME, help="Draft model with the same tokenizer as --model")
+    parser.add_argument("--draft-tokens", type=int, default=DRAFT_TOKENS, help="Tokens drafted per step to start with")
+    parser.add_argument("--precision", default=PRECISION, help="Precision mode of precision.py for both models")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--questions", type=int, default=len(SAMPLE_QUESTIONS_DATA), help="Sample questions to answer")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+    if not args.draft:
+        parser.error("no draft model: pass --draft or set LLM_DRAFT_MODEL")
+
+    import torch
+    import speculative
+    from precision import build_precision_pipeline
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    pipe = build_precision_pipeline(args.model, args.precision)
+    decoder = speculative.make_decoder(pipe, speculative.load_draft(args.draft, args.precision), args.draft_tokens)
+
+    samples = SAMPLE_QUESTIONS_DATA[:args.questions]
+    questions = [item["question"] for item in samples]
+    references = [item["correct_answer"] for item in samples]
+    modes = {
+        "greedy": {"max_new_tokens": args.max_new_tokens, "do_sample": False},
+        "sampling": {"max_new_tokens": args.max_new_tokens, "do_sample": True,
+                     "temperature": args.temperature, "top_p": args.top_p},
+    }
+    answer_all(pipe, questions[:1], {"max_new_tokens": 8, "do_sample": False}, decoder)  # Warm-up of both models
+
+    print(f"{len(questions)} questions, up to {args.max_new_tokens} new tokens, "
+          f"model {args.model}, draft {args.draft} ({args.precision})")
+    print(f"{'mode':>9s} {'decoding':>11s} {'tokens/s':>9s} {'speed-up':>8s} {'accepted':>8s} "
+          f"{'tokens/step':>11s} {'BLEU':>7s} {'sim':>6s}")
+    for mode, generation_kwargs in modes.items():
+        torch.manual_seed(0)
+        plain_answers, plain_tokens, plain_seconds, _ = answer_all(pipe, questions, generation_kwargs)
+        torch.manual_seed(0)
+        answers, tokens, seconds, runs = answer_all(pipe, questions, generation_kwargs, decoder)
+        plain_speed, speed = plain_tokens / plain_seconds, tokens / seconds
+        drafted = sum(run["drafted_tokens"] for run in runs)
+        accepted = sum(run["accepted_tokens"] for run in runs)
+        steps = sum(run["verify_steps"] for run in runs)
+        bleu, similarity = average_metrics(plain_answers, references)
+        print(f"{mode:>9s} {'plain':>11s} {plain_speed:9.1f} {'':>8s} {'':>8s} {1.0:11.2f} {bleu:7.4f} {similarity:6.3f}")
+        bleu, similarity = average_metrics(answers, references)
+        acceptance = f"{accepted / drafted:8.1%}" if drafted else f"{'-':>8s}"
+        print(f"{mode:>9s} {'speculative':>11s} {speed:9.1f} {speed / plain_speed:7.2f}x {acceptance} "
+              f"{tokens / steps if steps else 0:11.2f} {bleu:7.4f} {similarity:6.3f}")
+        if mode == "greedy":
+            identical = sum(a == b for a, b in zip(plain_answers, answers))
+            print(f"{'':>9s} {identical}/{len(questions)} greedy answers identical to plain decoding")
+
+
+if __name__ == "__main__":
+    main()
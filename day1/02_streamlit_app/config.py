@@ -1,3 +1,27 @@
 # config.py
+import os
+
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "meta-llama/Llama-3.2-3B-Instruct"
\ No newline at end of file
+MODEL_NAME = "meta-llama/Llama-3.2-3B-Instruct"
+# Model precision: "bfloat16", "float32" or "int8" (dynamic quantization of Linear layers, CPU only)
+PRECISION = os.environ.get("LLM_PRECISION", "bfloat16")
+
+# Response cache for repeated questions
+RESPONSE_CACHE_SIZE = 256        # Entries kept in memory
+RESPONSE_CACHE_TTL = 3600        # Seconds before a cached response expires
+RESPONSE_CACHE_DB = None         # e.g. "response_cache.db" to add an on-disk tier
+RESPONSE_CACHE_DB_SIZE = 100000  # Entries kept on disk
+
+# Key/value cache of shared prompt prefixes (chat template header, system prompt)
+PREFIX_CACHE_MAX_MB = None       # Memory budget; None sizes it from the model (see below), 0 disables the prefix cache
+PREFIX_CACHE_CONVERSATIONS = 4   # With PREFIX_CACHE_MAX_MB = None: full context windows (prompt + reply) the budget holds
+
+# Multi-turn chat context window
+MAX_CONTEXT_TOKENS = 2048        # Prompt tokens sent to the model per turn
+CONTEXT_TRIM_TARGET = 0.75       # Once over budget, old turns are dropped until this fraction of it is used
+MESSAGE_OVERHEAD_TOKENS = 8      # Chat template tokens added around each message (estimate)
+
+# Speculative decoding: a small draft model of the same family (same tokenizer) proposes tokens that
+# the main model verifies, several per forward pass. Answers are unchanged; None disables it.
+DRAFT_MODEL_NAME = os.environ.get("LLM_DRAFT_MODEL") or None  # e.g. "meta-llama/Llama-3.2-1B-Instruct"
+DRAFT_TOKENS = 5                 # Tokens drafted per step to start with (adapted during generation)
@@ -1,7 +1,8 @@
 # data.py
 import streamlit as st
+import pandas as pd
 from datetime import datetime
-from database import save_to_db, get_db_count # DB操作関数をインポート
+from database import save_many, get_db_count, HISTORY_COLUMNS # DB操作関数をインポート
 
 # サンプルデータのリスト
 SAMPLE_QUESTIONS_DATA = [
@@ -91,20 +92,8 @@ SAMPLE_QUESTIONS_DATA = [
 def create_sample_evaluation_data():
     """定義されたサンプルデータをデータベースに保存する"""
     try:
-        count_before = get_db_count()
-        added_count = 0
-        # 各サンプルをデータベースに保存
-        for item in SAMPLE_QUESTIONS_DATA:
-            # save_to_dbが必要な引数のみ渡す
-            save_to_db(
-                question=item["question"],
-                answer=item["answer"],
-                feedback=item["feedback"],
-                correct_answer=item["correct_answer"],
-                is_correct=item["is_correct"],
-                response_time=item["response_time"]
-            )
-            added_count += 1
+        # 1回のトランザクションでまとめて保存（評価指標もまとめて計算）
+        added_count = save_many(SAMPLE_QUESTIONS_DATA)
 
         count_after = get_db_count()
         st.success(f"{added_count} 件のサンプル評価データが正常に追加されました。(合計: {count_after} 件)")
@@ -113,6 +102,41 @@ def create_sample_evaluation_data():
         st.error(f"サンプルデータの作成中にエラーが発生しました: {e}")
         print(f"エラー詳細: {e}") # コンソールにも出力
 
+def load_history_records(uploaded_file):
+    """CSV / JSONL ファイルを読み込み、save_many に渡せるレコードのリストに変換する"""
+    name = uploaded_file.name.lower()
+    if name.endswith(".csv"):
+        df = pd.read_csv(uploaded_file)
+    elif name.endswith(".jsonl") or name.endswith(".json"):
+        df = pd.read_json(uploaded_file, lines=True)
+    else:
+        raise ValueError("CSV または JSONL ファイルを指定してください。")
+
+    missing = [c for c in ("question", "answer") if c not in df.columns]
+    if missing:
+        raise ValueError(f"必須の列がありません: {', '.join(missing)}")
+
+    # 足りない列は空で補い、数値列は数値に変換する（変換できない値は欠損扱い）
+    for column in HISTORY_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+    for column in ("is_correct", "response_time"):
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    df = df[HISTORY_COLUMNS].astype(object).where(df[HISTORY_COLUMNS].notna(), None)
+    return df.to_dict("records")
+
+def import_history_file(uploaded_file, compute_metrics=False):
+    """アップロードされた履歴ファイルをデータベースに一括登録する"""
+    try:
+        records = load_history_records(uploaded_file)
+        added_count = save_many(records, compute_metrics=compute_metrics)
+        st.success(f"{added_count} 件の履歴データをインポートしました。(合計: {get_db_count()} 件)")
+        return added_count
+    except Exception as e:
+        st.error(f"履歴データのインポート中にエラーが発生しました: {e}")
+        print(f"エラー詳細: {e}") # コンソールにも出力
+        return 0
+
 def ensure_initial_data():
     """データベースが空の場合に初期サンプルデータを投入する"""
     if get_db_count() == 0:
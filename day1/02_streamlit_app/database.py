@@ -1,10 +1,16 @@
 # database.py
 import sqlite3
+import threading
+import queue
+import time
+import math
+import argparse
+from collections import Counter
 import pandas as pd
 from datetime import datetime
 import streamlit as st
 from config import DB_FILE
-from metrics import calculate_metrics  # Required for calculating metrics
+from metrics import calculate_metrics, calculate_metrics_batch  # Required for calculating metrics
 
 # --- Schema Definition ---
 TABLE_NAME = "chat_history"
@@ -21,58 +27,624 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  bleu_score REAL,
  similarity_score REAL,
  word_count INTEGER,
- relevance_score REAL)
+ relevance_score REAL,
+ metrics_status TEXT DEFAULT 'done')  -- 'pending' until the scoring worker has filled the metric columns
 '''
+INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_metrics_status ON {TABLE_NAME} (metrics_status)",
+    # History paging: newest first, optionally filtered by is_correct
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_timestamp ON {TABLE_NAME} (timestamp, id)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_is_correct ON {TABLE_NAME} (is_correct, timestamp, id)",
+    # Top efficiency scores (see EFFICIENCY_EXPR)
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_efficiency ON {TABLE_NAME} ((is_correct / (COALESCE(response_time, 0) + 0.1)))",
+]
+EFFICIENCY_EXPR = "is_correct / (COALESCE(response_time, 0) + 0.1)"
+
+# Aggregates maintained on every write so the Metrics Analysis tab never scans chat_history.
+# metrics_summary holds count / sum / sum of squares / min / max per accuracy level and metric
+# ("rows" counts the rows themselves); metrics_sketch holds a log-bucketed quantile sketch per metric.
+SUMMARY_TABLE = "metrics_summary"
+SKETCH_TABLE = "metrics_sketch"
+AGGREGATE_SCHEMAS = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE}
+    (accuracy REAL,
+     metric TEXT,
+     count INTEGER,
+     total REAL,
+     total_sq REAL,
+     min_value REAL,       -- Only widened incrementally; exact again after rebuild_aggregates()
+     max_value REAL,
+     PRIMARY KEY (accuracy, metric))
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS {SKETCH_TABLE}
+    (metric TEXT,
+     bucket INTEGER,
+     count INTEGER,
+     PRIMARY KEY (metric, bucket))
+    ''',
+]
+ROWS_METRIC = "rows"
+AGGREGATE_METRICS = ["response_time", "bleu_score", "similarity_score", "word_count", "relevance_score"]
+METRIC_COLUMNS = ["bleu_score", "similarity_score", "word_count", "relevance_score"]
+SKETCH_RELATIVE_ACCURACY = 0.01  # Quantiles are within 1% of the true value
+_SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_SKETCH_ZERO_BUCKET = -(2 ** 31)  # Values <= _SKETCH_MIN_VALUE (BLEU is often 0)
+_SKETCH_MIN_VALUE = 1e-9
+
+# Multi-turn conversations shown on the chat page. token_count caches the tokenized length of
+# each message so resuming a conversation does not tokenize its history again.
+SESSIONS_TABLE = "chat_sessions"
+MESSAGES_TABLE = "chat_messages"
+CONVERSATION_SCHEMAS = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {SESSIONS_TABLE}
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+     created_at TEXT,
+     updated_at TEXT,
+     title TEXT)
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS {MESSAGES_TABLE}
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+     session_id INTEGER REFERENCES {SESSIONS_TABLE} (id),
+     timestamp TEXT,
+     role TEXT,
+     content TEXT,
+     token_count INTEGER)
+    ''',
+    f"CREATE INDEX IF NOT EXISTS idx_{MESSAGES_TABLE}_session ON {MESSAGES_TABLE} (session_id, id)",
+    f"CREATE INDEX IF NOT EXISTS idx_{SESSIONS_TABLE}_updated_at ON {SESSIONS_TABLE} (updated_at)",
+]
+
+# Offline evaluation runs (evaluate.py). A run is one model + generation configuration; re-running
+# the same configuration resumes it, skipping items that already have a row in eval_results.
+EVAL_RUNS_TABLE = "eval_runs"
+EVAL_RESULTS_TABLE = "eval_results"
+EVALUATION_SCHEMAS = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {EVAL_RUNS_TABLE}
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+     model TEXT,
+     config_hash TEXT,
+     config TEXT,          -- JSON of the generation configuration the hash was computed from
+     created_at TEXT,
+     updated_at TEXT,
+     total_items INTEGER,
+     wall_seconds REAL DEFAULT 0,  -- Wall-clock time spent evaluating, summed over the invocations that resumed the run
+     UNIQUE (model, config_hash))
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS {EVAL_RESULTS_TABLE}
+    (run_id INTEGER REFERENCES {EVAL_RUNS_TABLE} (id),
+     item_key TEXT,        -- Stable id of the question in its source, e.g. "history:42" or "sample:3"
+     question TEXT,
+     correct_answer TEXT,
+     answer TEXT,
+     response_time REAL,   -- Seconds of the generation batch the item ran in
+     batch_size INTEGER,
+     bleu_score REAL,
+     similarity_score REAL,
+     word_count INTEGER,
+     relevance_score REAL,
+     PRIMARY KEY (run_id, item_key))
+    ''',
+]
+
+# Metric statuses
+METRICS_PENDING = "pending"
+METRICS_DONE = "done"
+METRICS_FAILED = "failed"
+
+# --- Connection Management ---
+# Applied once to every new connection. WAL lets readers run concurrently with a writer,
+# and synchronous=NORMAL is safe in WAL mode while avoiding an fsync on every commit.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,       # Negative value = size in KiB (about 20 MB)
+    "mmap_size": 268435456,     # 256 MB memory-mapped I/O
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,       # Milliseconds SQLite waits on a lock before raising "database is locked"
+}
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY = 0.05  # Seconds, doubled after each retry
+
+_local = threading.local()
+
+def get_connection(db_file=DB_FILE):
+    """Return this thread's persistent connection to db_file, opening and tuning it on first use"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_file)
+    if conn is None:
+        conn = sqlite3.connect(db_file, timeout=PRAGMAS["busy_timeout"] / 1000)
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        connections[db_file] = conn
+    return conn
+
+def close_connection(db_file=DB_FILE):
+    """Close this thread's connection to db_file (it is reopened on next use)"""
+    connections = getattr(_local, "connections", {})
+    conn = connections.pop(db_file, None)
+    if conn is not None:
+        conn.close()
+
+def _is_busy_error(e):
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+def run_with_retry(operation, db_file=DB_FILE):
+    """Run operation(conn), retrying with backoff while the database is busy"""
+    delay = BUSY_RETRY_DELAY
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            return operation(get_connection(db_file))
+        except sqlite3.OperationalError as e:
+            if attempt == BUSY_RETRIES or not _is_busy_error(e):
+                raise
+            print(f"Database is busy, retrying ({attempt + 1}/{BUSY_RETRIES})...")  # For debugging
+            time.sleep(delay)
+            delay *= 2
 
 # --- Database Initialization ---
 def init_db():
     """Initialize the database and table"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(SCHEMA)
-        conn.commit()
-        conn.close()
+        def create_table(conn):
+            with conn:
+                conn.execute(SCHEMA)
+                # Migrate databases created before the metrics_status column existed
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")]
+                if "metrics_status" not in columns:
+                    conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN metrics_status TEXT DEFAULT '{METRICS_DONE}'")
+                for index in INDEXES:
+                    conn.execute(index)
+                for schema in AGGREGATE_SCHEMAS + CONVERSATION_SCHEMAS + EVALUATION_SCHEMAS:
+                    conn.execute(schema)
+                _migrate_evaluation_tables(conn)
+            # Databases created before the aggregate tables existed need one full rebuild
+            has_history = conn.execute(f"SELECT EXISTS(SELECT 1 FROM {TABLE_NAME})").fetchone()[0]
+            has_summary = conn.execute(f"SELECT EXISTS(SELECT 1 FROM {SUMMARY_TABLE})").fetchone()[0]
+            return has_history and not has_summary
+        if run_with_retry(create_table):
+            rebuild_aggregates()
         print(f"Database '{DB_FILE}' initialized successfully.")
+        get_scoring_worker()  # Start the worker so rows left pending by a previous run are scored
     except Exception as e:
         st.error(f"Failed to initialize the database: {e}")
         raise e  # Re-raise the error to stop the app or handle it appropriately
 
+# --- Metric Aggregates ---
+def _sketch_bucket(value):
+    if value <= _SKETCH_MIN_VALUE:
+        return _SKETCH_ZERO_BUCKET
+    return math.ceil(math.log(value, _SKETCH_GAMMA))
+
+def _sketch_value(bucket):
+    if bucket == _SKETCH_ZERO_BUCKET:
+        return 0.0
+    return 2 * _SKETCH_GAMMA ** bucket / (_SKETCH_GAMMA + 1)
+
+def _aggregate_entries(rows, metrics):
+    """Turn (is_correct, value, value, ...) rows into (accuracy, metric, value) entries"""
+    for row in rows:
+        accuracy = row[0]
+        if accuracy is None or accuracy != accuracy:  # Rows without an accuracy score are not analysed
+            continue
+        for metric, value in zip(metrics, row[1:]):
+            yield accuracy, metric, value
+
+def _apply_aggregates(conn, entries, sign=1):
+    """Add (sign=1) or remove (sign=-1) (accuracy, metric, value) entries from the aggregate tables"""
+    summary = {}
+    sketch = Counter()
+    for accuracy, metric, value in entries:
+        if value is None or value != value:
+            continue
+        value = float(value)
+        stats = summary.get((accuracy, metric))
+        if stats is None:
+            stats = summary[(accuracy, metric)] = [0, 0.0, 0.0, value, value]
+        stats[0] += 1
+        stats[1] += value
+        stats[2] += value * value
+        stats[3] = min(stats[3], value)
+        stats[4] = max(stats[4], value)
+        if metric != ROWS_METRIC:
+            sketch[(metric, _sketch_bucket(value))] += 1
+
+    if sign > 0:
+        conn.executemany(f'''
+        INSERT INTO {SUMMARY_TABLE} (accuracy, metric, count, total, total_sq, min_value, max_value)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (accuracy, metric) DO UPDATE SET
+            count = count + excluded.count,
+            total = total + excluded.total,
+            total_sq = total_sq + excluded.total_sq,
+            min_value = MIN(min_value, excluded.min_value),
+            max_value = MAX(max_value, excluded.max_value)
+        ''', [key + tuple(stats) for key, stats in summary.items()])
+    else:
+        conn.executemany(f'''
+        UPDATE {SUMMARY_TABLE} SET count = count - ?, total = total - ?, total_sq = total_sq - ?
+        WHERE accuracy = ? AND metric = ?
+        ''', [(stats[0], stats[1], stats[2]) + key for key, stats in summary.items()])
+    conn.executemany(f'''
+    INSERT INTO {SKETCH_TABLE} (metric, bucket, count) VALUES (?, ?, ?)
+    ON CONFLICT (metric, bucket) DO UPDATE SET count = count + excluded.count
+    ''', [key + (sign * count,) for key, count in sketch.items()])
+
+def rebuild_aggregates(db_file=DB_FILE):
+    """Recompute the aggregate tables exactly from chat_history"""
+    def rebuild(conn):
+        conn.execute("BEGIN IMMEDIATE")  # Block writers so no insert is missed or counted twice
+        with conn:
+            conn.execute(f"DELETE FROM {SUMMARY_TABLE}")
+            conn.execute(f"DELETE FROM {SKETCH_TABLE}")
+            columns = ", ".join(AGGREGATE_METRICS)
+            cursor = conn.execute(f"SELECT is_correct, 1, {columns} FROM {TABLE_NAME} WHERE is_correct IS NOT NULL")
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                _apply_aggregates(conn, _aggregate_entries(rows, [ROWS_METRIC] + AGGREGATE_METRICS))
+    run_with_retry(rebuild, db_file)
+    print("Metric aggregates rebuilt.")  # For debugging
+
+ACCURACY_LABELS = {1.0: 'accurate', 0.5: 'partially accurate', 0.0: 'inaccurate'}
+
+def _accuracy_label(accuracy):
+    return ACCURACY_LABELS.get(accuracy, str(accuracy))
+
+def _read_summary(db_file=DB_FILE):
+    return run_with_retry(
+        lambda conn: pd.read_sql_query(f"SELECT * FROM {SUMMARY_TABLE} WHERE count > 0", conn), db_file
+    )
+
+def get_accuracy_counts(db_file=DB_FILE):
+    """Number of rows per accuracy label (same as value_counts() on the accuracy column)"""
+    try:
+        summary = _read_summary(db_file)
+        rows = summary[summary["metric"] == ROWS_METRIC]
+        counts = pd.Series(rows["count"].values, index=rows["accuracy"].map(_accuracy_label).values, name="count")
+        return counts.sort_values(ascending=False)
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving metric aggregates: {e}")
+        return pd.Series(dtype=float)
+
+def get_accuracy_means(db_file=DB_FILE):
+    """Mean of each metric per accuracy label (same as groupby('accuracy').mean())"""
+    try:
+        summary = _read_summary(db_file)
+        summary = summary[summary["metric"] != ROWS_METRIC].copy()
+        summary["mean"] = summary["total"] / summary["count"]
+        summary["accuracy"] = summary["accuracy"].map(_accuracy_label)
+        means = summary.pivot(index="accuracy", columns="metric", values="mean")
+        return means[[m for m in AGGREGATE_METRICS if m in means.columns]].sort_index()
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving metric aggregates: {e}")
+        return pd.DataFrame()
+
+def get_metric_quantiles(metric, quantiles=(0.25, 0.5, 0.75), db_file=DB_FILE):
+    """Approximate quantiles of a metric over all rows, read from the sketch"""
+    buckets = run_with_retry(
+        lambda conn: conn.execute(
+            f"SELECT bucket, count FROM {SKETCH_TABLE} WHERE metric = ? AND count > 0 ORDER BY bucket", (metric,)
+        ).fetchall(),
+        db_file,
+    )
+    total = sum(count for _, count in buckets)
+    results = []
+    for q in quantiles:
+        if total == 0:
+            results.append(float("nan"))
+            continue
+        rank = q * (total - 1)
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen > rank:
+                results.append(_sketch_value(bucket))
+                break
+    return results
+
+def get_metrics_describe(db_file=DB_FILE):
+    """describe()-style statistics for every metric, from the aggregates instead of the full table"""
+    try:
+        summary = _read_summary(db_file)
+        summary = summary[summary["metric"] != ROWS_METRIC]
+        totals = summary.groupby("metric").agg(
+            count=("count", "sum"), total=("total", "sum"), total_sq=("total_sq", "sum"),
+            min_value=("min_value", "min"), max_value=("max_value", "max"),
+        )
+        describe = {}
+        for metric in AGGREGATE_METRICS:
+            if metric not in totals.index or totals.loc[metric, "count"] == 0:
+                continue
+            row = totals.loc[metric]
+            count = row["count"]
+            mean = row["total"] / count
+            # Sample standard deviation, as in pandas
+            variance = (row["total_sq"] - count * mean * mean) / (count - 1) if count > 1 else float("nan")
+            q25, q50, q75 = get_metric_quantiles(metric, db_file=db_file)
+            describe[metric] = {
+                "count": float(count), "mean": mean, "std": math.sqrt(max(variance, 0.0)) if count > 1 else float("nan"),
+                "min": row["min_value"], "25%": q25, "50%": q50, "75%": q75, "max": row["max_value"],
+            }
+        return pd.DataFrame(describe)
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving metric aggregates: {e}")
+        return pd.DataFrame()
+
+def get_top_efficiency(limit=10, db_file=DB_FILE):
+    """Rows with the highest efficiency score (accuracy / (response time + 0.1)), using its index"""
+    try:
+        return run_with_retry(
+            lambda conn: pd.read_sql_query(
+                f"SELECT id, {EFFICIENCY_EXPR} AS efficiency_score FROM {TABLE_NAME} "
+                f"WHERE {EFFICIENCY_EXPR} IS NOT NULL ORDER BY {EFFICIENCY_EXPR} DESC LIMIT ?",
+                conn, params=[limit],
+            ),
+            db_file,
+        )
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving efficiency scores: {e}")
+        return pd.DataFrame()
+
+def get_recent_metrics(limit=2000, db_file=DB_FILE):
+    """Metric columns of the most recent rows, for charts that need individual points"""
+    try:
+        columns = ", ".join(["id", "is_correct"] + AGGREGATE_METRICS)
+        df = run_with_retry(
+            lambda conn: pd.read_sql_query(
+                f"SELECT {columns} FROM {TABLE_NAME} WHERE is_correct IS NOT NULL ORDER BY timestamp DESC, id DESC LIMIT ?",
+                conn, params=[limit],
+            ),
+            db_file,
+        )
+        df["accuracy"] = df["is_correct"].map(ACCURACY_LABELS)
+        return df
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving recent metrics: {e}")
+        return pd.DataFrame(columns=["accuracy"] + AGGREGATE_METRICS)
+
+# --- Background Metric Scoring ---
+class MetricsScoringWorker:
+    """Compute evaluation metrics for saved rows on background threads and write them back in batches"""
+
+    def __init__(self, num_threads=2, batch_size=32, max_wait=0.2, db_file=DB_FILE):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.max_wait = max_wait  # Seconds to wait for more row ids before scoring a partial batch
+        self.queue = queue.Queue()
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._run, name=f"metrics-scoring-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def enqueue(self, row_ids):
+        """Schedule metric computation for the given row ids"""
+        for row_id in row_ids:
+            self.queue.put(row_id)
+
+    def enqueue_pending(self):
+        """Schedule all rows whose metrics are still pending"""
+        rows = run_with_retry(
+            lambda conn: conn.execute(
+                f"SELECT id FROM {TABLE_NAME} WHERE metrics_status = ?", (METRICS_PENDING,)
+            ).fetchall(),
+            self.db_file,
+        )
+        self.enqueue(row_id for (row_id,) in rows)
+        return len(rows)
+
+    def pending_count(self):
+        """Number of row ids waiting in the queue"""
+        return self.queue.qsize()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            row_ids = self._next_batch()
+            try:
+                self._score(row_ids)
+            except Exception as e:
+                # Rows stay 'pending' and are picked up again by enqueue_pending on the next start
+                print(f"Metric scoring failed for {len(row_ids)} rows: {e}")
+
+    def _score(self, row_ids):
+        placeholders = ",".join("?" * len(row_ids))
+        rows = run_with_retry(
+            lambda conn: conn.execute(
+                f"SELECT id, answer, correct_answer FROM {TABLE_NAME} WHERE id IN ({placeholders})", row_ids
+            ).fetchall(),
+            self.db_file,
+        )
+        updates = []
+        try:
+            bleu_scores, similarity_scores, word_counts, relevance_scores = calculate_metrics_batch(
+                [answer for _, answer, _ in rows], [correct_answer for _, _, correct_answer in rows]
+            )
+            for i, (row_id, _, _) in enumerate(rows):
+                updates.append((float(bleu_scores[i]), float(similarity_scores[i]), int(word_counts[i]),
+                                float(relevance_scores[i]), METRICS_DONE, row_id))
+        except Exception as e:
+            # Fall back to scoring row by row so one bad row does not fail the whole batch
+            print(f"Batch metric calculation failed, scoring rows individually: {e}")
+            for row_id, answer, correct_answer in rows:
+                try:
+                    bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(answer, correct_answer)
+                    updates.append((bleu_score, similarity_score, word_count, relevance_score, METRICS_DONE, row_id))
+                except Exception as e:
+                    print(f"Metric calculation failed for row {row_id}: {e}")
+                    updates.append((None, None, None, None, METRICS_FAILED, row_id))
+
+        def write(conn):
+            conn.execute("BEGIN IMMEDIATE")  # Read the old values and replace them atomically
+            with conn:
+                ids = [update[-1] for update in updates]
+                columns = ", ".join(METRIC_COLUMNS)
+                previous = conn.execute(
+                    f"SELECT id, is_correct, {columns} FROM {TABLE_NAME} WHERE id IN ({','.join('?' * len(ids))})", ids
+                ).fetchall()
+                accuracy = {row[0]: row[1] for row in previous}
+                conn.executemany(f'''
+                UPDATE {TABLE_NAME}
+                SET bleu_score = ?, similarity_score = ?, word_count = ?, relevance_score = ?, metrics_status = ?
+                WHERE id = ?
+                ''', updates)
+                _apply_aggregates(conn, _aggregate_entries([row[1:] for row in previous], METRIC_COLUMNS), sign=-1)
+                _apply_aggregates(conn, _aggregate_entries(
+                    [(accuracy.get(update[-1]),) + update[:4] for update in updates], METRIC_COLUMNS
+                ))
+        run_with_retry(write, self.db_file)
+        print(f"Scored metrics for {len(updates)} rows.")  # For debugging
+
+_scoring_worker = None
+_scoring_worker_lock = threading.Lock()
+
+def get_scoring_worker():
+    """Return the process-wide scoring worker, starting it on first use"""
+    global _scoring_worker
+    with _scoring_worker_lock:
+        if _scoring_worker is None:
+            _scoring_worker = MetricsScoringWorker()
+            # Pick up rows left pending by a previous run
+            _scoring_worker.enqueue_pending()
+        return _scoring_worker
+
+def recompute_metrics(all_rows=False):
+    """Mark rows as pending and schedule them for scoring.
+
+    With all_rows=False only rows whose metrics failed or were never computed are backfilled;
+    with all_rows=True every row is re-scored (e.g. after changing metrics.py). Rows that are
+    already pending are scheduled already and are left alone. Returns the number of rows scheduled.
+    """
+    try:
+        if all_rows:
+            condition = "1 = 1"
+        else:
+            condition = f"metrics_status IS NULL OR metrics_status != '{METRICS_DONE}' OR bleu_score IS NULL"
+        # Started first, so the pending rows it picks up on first use do not include the ones marked here
+        worker = get_scoring_worker()
+
+        def mark_pending(conn):
+            with conn:
+                return conn.execute(f'''
+                UPDATE {TABLE_NAME} SET metrics_status = ?
+                WHERE ({condition}) AND (metrics_status IS NULL OR metrics_status != ?)
+                RETURNING id
+                ''', (METRICS_PENDING, METRICS_PENDING)).fetchall()
+        row_ids = [row_id for (row_id,) in run_with_retry(mark_pending)]
+        worker.enqueue(row_ids)
+        return len(row_ids)
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while scheduling metric recomputation: {e}")
+        return 0
+
 # --- Data Manipulation Functions ---
 def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time):
-    """Save chat history and evaluation metrics to the database"""
-    conn = None
+    """Save chat history to the database; evaluation metrics are filled in by the scoring worker"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Calculate additional evaluation metrics
-        bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(
-            answer, correct_answer
-        )
-
-        c.execute(f'''
-        INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score))
-        conn.commit()
+        def insert(conn):
+            with conn:  # Commits on success, rolls back on error
+                cursor = conn.execute(f'''
+                INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
+                                         response_time, metrics_status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
+                     response_time, METRICS_PENDING))
+                _apply_aggregates(conn, _aggregate_entries(
+                    [(is_correct, 1, response_time)], [ROWS_METRIC, "response_time"]
+                ))
+                return cursor.lastrowid
+        row_id = run_with_retry(insert)
+        get_scoring_worker().enqueue([row_id])
         print("Data saved to DB successfully.")  # For debugging
     except sqlite3.Error as e:
         st.error(f"An error occurred while saving to the database: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+BULK_METRICS_CHUNK = 5000  # Rows scored per calculate_metrics_batch call during bulk inserts
+HISTORY_COLUMNS = ["timestamp", "question", "answer", "feedback", "correct_answer", "is_correct", "response_time"]
+
+def save_many(records, compute_metrics=True, db_file=DB_FILE):
+    """Insert many chat history records in a single transaction.
+
+    records is an iterable of dicts with the save_to_db fields (and optionally "timestamp").
+    With compute_metrics=True the metrics are calculated in batches before inserting;
+    otherwise rows are inserted as pending and scored by the background worker.
+    Returns the number of inserted rows.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for record in records:
+        rows.append([record.get("timestamp") or now] + [record.get(column) for column in HISTORY_COLUMNS[1:]])
+    if not rows:
+        return 0
+
+    if compute_metrics:
+        # Calculated outside the transaction to keep the write lock short
+        for start in range(0, len(rows), BULK_METRICS_CHUNK):
+            chunk = rows[start:start + BULK_METRICS_CHUNK]
+            bleu_scores, similarity_scores, word_counts, relevance_scores = calculate_metrics_batch(
+                [row[2] for row in chunk], [row[4] for row in chunk]
+            )
+            for i, row in enumerate(chunk):
+                row += [float(bleu_scores[i]), float(similarity_scores[i]), int(word_counts[i]),
+                        float(relevance_scores[i]), METRICS_DONE]
+    else:
+        for row in rows:
+            row += [None, None, None, None, METRICS_PENDING]
+
+    # Started first, so the pending rows it picks up on first use do not include the ones inserted here
+    worker = None if compute_metrics else get_scoring_worker()
+
+    def insert(conn):
+        conn.execute("BEGIN IMMEDIATE")  # Holds the write lock, so the new rows get consecutive ids
+        with conn:
+            (last_id,) = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE_NAME}").fetchone()
+            conn.executemany(f'''
+            INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
+                                     response_time, bleu_score, similarity_score, word_count, relevance_score,
+                                     metrics_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            _apply_aggregates(conn, _aggregate_entries(
+                ([row[5], 1, row[6]] + row[7:11] for row in rows), [ROWS_METRIC] + AGGREGATE_METRICS
+            ))
+            return conn.execute(f"SELECT id FROM {TABLE_NAME} WHERE id > ?", (last_id,)).fetchall()
+    new_ids = run_with_retry(insert, db_file)
+    if worker is not None:
+        worker.enqueue(row_id for (row_id,) in new_ids)
+    print(f"Bulk inserted {len(rows)} rows.")  # For debugging
+    return len(rows)
 
 def get_chat_history():
     """Retrieve all chat history from the database"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
         # Since is_correct is of type REAL, read it accordingly
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
+        df = run_with_retry(
+            lambda conn: pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
+        )
         # Check the data type of the is_correct column and convert if necessary
         if 'is_correct' in df.columns:
              df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce')  # Convert to numeric, set NaN on failure
@@ -80,29 +652,238 @@ def get_chat_history():
     except sqlite3.Error as e:
         st.error(f"An error occurred while retrieving history: {e}")
         return pd.DataFrame()  # Return an empty DataFrame
-    finally:
-        if conn:
-            conn.close()
+
+def _history_filter(is_correct):
+    if is_correct is None:
+        return "", []
+    return "WHERE is_correct = ?", [is_correct]
+
+def get_chat_history_page(is_correct=None, limit=5, offset=0, after=None, db_file=DB_FILE):
+    """Retrieve one page of chat history, newest first.
+
+    is_correct filters on the accuracy score (None = all rows). Pass after=(timestamp, id) of
+    the last row of the previous page for keyset pagination; otherwise offset is used.
+    """
+    try:
+        where, params = _history_filter(is_correct)
+        if after is not None:
+            where += (" AND " if where else "WHERE ") + "(timestamp, id) < (?, ?)"
+            params += list(after)
+            offset = 0
+        query = f"SELECT * FROM {TABLE_NAME} {where} ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        df = run_with_retry(
+            lambda conn: pd.read_sql_query(query, conn, params=params + [limit, offset]), db_file
+        )
+        if 'is_correct' in df.columns:
+             df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce')
+        return df
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving history: {e}")
+        return pd.DataFrame()
+
+def count_chat_history(is_correct=None, db_file=DB_FILE):
+    """Count chat history rows matching the filter used by get_chat_history_page"""
+    try:
+        where, params = _history_filter(is_correct)
+        return run_with_retry(
+            lambda conn: conn.execute(f"SELECT COUNT(*) FROM {TABLE_NAME} {where}", params).fetchone()[0], db_file
+        )
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving the record count: {e}")
+        return 0
+
+def get_latest_history_id(db_file=DB_FILE):
+    """Id of the newest chat history row, or None if there is none (reads only the end of the primary key)
+
+    Rows are only ever inserted or all deleted, and AUTOINCREMENT never reuses an id, so the value
+    changes whenever the history does and can key caches of counts over it.
+    """
+    try:
+        return run_with_retry(
+            lambda conn: conn.execute(f"SELECT MAX(id) FROM {TABLE_NAME}").fetchone()[0], db_file
+        )
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving history: {e}")
+        return None
 
 def get_db_count():
     """Get the number of records in the database"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
-        count = c.fetchone()[0]
+        count = run_with_retry(
+            lambda conn: conn.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}").fetchone()[0]
+        )
         return count
     except sqlite3.Error as e:
         st.error(f"An error occurred while retrieving the record count: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
+
+# --- Conversations ---
+def create_chat_session(title, db_file=DB_FILE):
+    """Create a conversation and return its id"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def insert(conn):
+        with conn:
+            return conn.execute(
+                f"INSERT INTO {SESSIONS_TABLE} (created_at, updated_at, title) VALUES (?, ?, ?)",
+                (timestamp, timestamp, title),
+            ).lastrowid
+    return run_with_retry(insert, db_file)
+
+def save_chat_messages(session_id, messages, db_file=DB_FILE):
+    """Append messages (dicts with "role", "content" and optionally "tokens") to a conversation"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [(session_id, timestamp, m["role"], m["content"], m.get("tokens")) for m in messages]
+
+    def insert(conn):
+        with conn:
+            conn.executemany(
+                f"INSERT INTO {MESSAGES_TABLE} (session_id, timestamp, role, content, token_count) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute(f"UPDATE {SESSIONS_TABLE} SET updated_at = ? WHERE id = ?", (timestamp, session_id))
+    try:
+        run_with_retry(insert, db_file)
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while saving the conversation: {e}")
+
+def get_chat_sessions(limit=20, db_file=DB_FILE):
+    """Retrieve the most recently updated conversations"""
+    try:
+        return run_with_retry(
+            lambda conn: pd.read_sql_query(
+                f"SELECT id, created_at, updated_at, title FROM {SESSIONS_TABLE} ORDER BY updated_at DESC, id DESC LIMIT ?",
+                conn, params=[limit],
+            ), db_file
+        )
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving conversations: {e}")
+        return pd.DataFrame()
+
+def get_chat_messages(session_id, db_file=DB_FILE):
+    """Retrieve the messages of a conversation in order, as dicts usable by llm.generate_response_stream"""
+    try:
+        rows = run_with_retry(
+            lambda conn: conn.execute(
+                f"SELECT role, content, token_count FROM {MESSAGES_TABLE} WHERE session_id = ? ORDER BY id",
+                (session_id,),
+            ).fetchall(), db_file
+        )
+    except sqlite3.Error as e:
+        st.error(f"An error occurred while retrieving the conversation: {e}")
+        return []
+    messages = []
+    for role, content, token_count in rows:
+        message = {"role": role, "content": content}
+        if token_count is not None:
+            message["tokens"] = token_count
+        messages.append(message)
+    return messages
+
+# --- Offline Evaluation ---
+def _migrate_evaluation_tables(conn):
+    """Add columns missing from evaluation tables created by an older version"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({EVAL_RUNS_TABLE})")]
+    if "wall_seconds" not in columns:
+        conn.execute(f"ALTER TABLE {EVAL_RUNS_TABLE} ADD COLUMN wall_seconds REAL DEFAULT 0")
+
+def init_evaluation_tables(db_file=DB_FILE):
+    """Create the evaluation tables (for the evaluate.py CLI, which does not run init_db)"""
+    def create(conn):
+        with conn:
+            for schema in EVALUATION_SCHEMAS:
+                conn.execute(schema)
+            _migrate_evaluation_tables(conn)
+    run_with_retry(create, db_file)
+
+def get_evaluation_questions(db_file=DB_FILE):
+    """Questions of the chat history that have a correct answer, as (item_key, question, correct_answer)"""
+    rows = run_with_retry(
+        lambda conn: conn.execute(
+            f"SELECT id, question, correct_answer FROM {TABLE_NAME} "
+            "WHERE correct_answer IS NOT NULL AND correct_answer != '' ORDER BY id"
+        ).fetchall(), db_file
+    )
+    return [(f"history:{row_id}", question, correct_answer) for row_id, question, correct_answer in rows]
+
+def get_or_create_eval_run(model, config_hash, config_json, total_items, db_file=DB_FILE):
+    """Return the id of the run for model + config_hash, creating it if needed"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def upsert(conn):
+        with conn:
+            conn.execute(
+                f"INSERT OR IGNORE INTO {EVAL_RUNS_TABLE} (model, config_hash, config, created_at, updated_at, total_items) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (model, config_hash, config_json, timestamp, timestamp, total_items),
+            )
+            conn.execute(
+                f"UPDATE {EVAL_RUNS_TABLE} SET total_items = ? WHERE model = ? AND config_hash = ?",
+                (total_items, model, config_hash),
+            )
+            return conn.execute(
+                f"SELECT id FROM {EVAL_RUNS_TABLE} WHERE model = ? AND config_hash = ?", (model, config_hash)
+            ).fetchone()[0]
+    return run_with_retry(upsert, db_file)
+
+def get_eval_done_keys(run_id, db_file=DB_FILE):
+    """Item keys that already have results in the run (the checkpoint)"""
+    rows = run_with_retry(
+        lambda conn: conn.execute(f"SELECT item_key FROM {EVAL_RESULTS_TABLE} WHERE run_id = ?", (run_id,)).fetchall(),
+        db_file,
+    )
+    return {row[0] for row in rows}
+
+EVAL_RESULT_COLUMNS = ["item_key", "question", "correct_answer", "answer", "response_time", "batch_size",
+                       "bleu_score", "similarity_score", "word_count", "relevance_score"]
+
+def save_eval_results(run_id, results, wall_seconds=0.0, db_file=DB_FILE):
+    """Store scored results (dicts with EVAL_RESULT_COLUMNS) of a run in one transaction.
+
+    wall_seconds is the wall-clock time since the previous checkpoint of this invocation; it is
+    added to the run's total, from which get_eval_run_summaries computes the throughput.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [[run_id] + [result[column] for column in EVAL_RESULT_COLUMNS] for result in results]
+
+    def insert(conn):
+        with conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {EVAL_RESULTS_TABLE} (run_id, {', '.join(EVAL_RESULT_COLUMNS)}) "
+                f"VALUES ({', '.join(['?'] * (len(EVAL_RESULT_COLUMNS) + 1))})",
+                rows,
+            )
+            conn.execute(
+                f"UPDATE {EVAL_RUNS_TABLE} SET updated_at = ?, wall_seconds = COALESCE(wall_seconds, 0) + ? WHERE id = ?",
+                (timestamp, wall_seconds, run_id),
+            )
+    run_with_retry(insert, db_file)
+
+def get_eval_run_summaries(run_ids=None, db_file=DB_FILE):
+    """Aggregate quality and latency per evaluation run as a DataFrame (all runs when run_ids is None)"""
+    where = f"WHERE r.id IN ({', '.join('?' * len(run_ids))})" if run_ids else ""
+    runs = run_with_retry(
+        lambda conn: pd.read_sql_query(f'''
+            SELECT r.id AS run_id, r.model, r.config_hash, r.updated_at, r.total_items, r.wall_seconds,
+                   COUNT(e.item_key) AS items,
+                   AVG(e.bleu_score) AS bleu_score, AVG(e.similarity_score) AS similarity_score,
+                   AVG(e.relevance_score) AS relevance_score, AVG(e.word_count) AS word_count
+            FROM {EVAL_RUNS_TABLE} r LEFT JOIN {EVAL_RESULTS_TABLE} e ON e.run_id = r.id
+            {where} GROUP BY r.id ORDER BY r.id
+            ''', conn, params=list(run_ids or [])), db_file
+    )
+    # An item's latency is the time of the batch it was generated in
+    latencies = run_with_retry(
+        lambda conn: pd.read_sql_query(f"SELECT run_id, response_time FROM {EVAL_RESULTS_TABLE}", conn), db_file
+    ).groupby("run_id")["response_time"]
+    runs["latency_p50"] = runs["run_id"].map(latencies.quantile(0.5))
+    runs["latency_p95"] = runs["run_id"].map(latencies.quantile(0.95))
+    # Wall-clock rate of the whole run, so processes working in parallel (--workers) add up
+    runs["items_per_second"] = runs["items"] / runs["wall_seconds"].where(runs["wall_seconds"] > 0)
+    return runs
 
 def clear_db():
     """Delete all records from the database"""
-    conn = None
     confirmed = st.session_state.get("confirm_clear", False)
 
     if not confirmed:
@@ -111,10 +892,12 @@ def clear_db():
         return False  # Deletion was not executed
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"DELETE FROM {TABLE_NAME}")
-        conn.commit()
+        def delete_all(conn):
+            with conn:
+                conn.execute(f"DELETE FROM {TABLE_NAME}")
+                conn.execute(f"DELETE FROM {SUMMARY_TABLE}")
+                conn.execute(f"DELETE FROM {SKETCH_TABLE}")
+        run_with_retry(delete_all)
         st.success("The database has been successfully cleared.")
         st.session_state.confirm_clear = False  # Reset confirmation state
         return True  # Deletion successful
@@ -122,6 +905,14 @@ def clear_db():
         st.error(f"An error occurred while clearing the database: {e}")
         st.session_state.confirm_clear = False  # Reset on error as well
         return False  # Deletion failed
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+
+# --- Command Line ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands for the chat history database")
+    parser.add_argument("--rebuild-aggregates", action="store_true", help="Recompute the metric aggregate tables exactly")
+    args = parser.parse_args()
+    if args.rebuild_aggregates:
+        init_db()
+        rebuild_aggregates()
+    else:
+        parser.print_help()
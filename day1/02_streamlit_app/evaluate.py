@@ -0,0 +1,191 @@
+# evaluate.py
+# Offline evaluation runner: answer the questions that have a correct answer (the chat history in
+# database.py, or SAMPLE_QUESTIONS_DATA) with a model in batches, score the answers with
+# metrics.calculate_metrics_batch and store them in the eval_runs / eval_results tables.
+# A run is keyed by model and generation configuration, and every finished batch is stored, so
+# re-running the same command resumes where it stopped. Questions are tokenized once here and batched
+# by token length (bucketing.py) before --workers splits the batches across processes.
+# Usage: python evaluate.py --model meta-llama/Llama-3.2-1B-Instruct --source samples --batch-size 8 --workers 2
+#        python evaluate.py --report
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+
+import shared_path  # Puts ../shared on sys.path
+import bucketing
+import database
+from config import DB_FILE, MODEL_NAME, PRECISION
+from precision import PRECISIONS, resolve_precision
+
+_pipe = None  # Pipeline of this process, loaded by _init_worker
+
+
+def load_questions(source, limit=None, db_file=DB_FILE):
+    """(item_key, question, correct_answer) for every question of the source"""
+    if source == "history":
+        items = database.get_evaluation_questions(db_file)
+    else:
+        from data import SAMPLE_QUESTIONS_DATA
+        items = [(f"sample:{i}", d["question"], d["correct_answer"]) for i, d in enumerate(SAMPLE_QUESTIONS_DATA)]
+    return items[:limit] if limit else items
+
+
+def config_hash(config):
+    """Short stable hash of a run configuration"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _init_worker(model_name, mode, threads):
+    """Load the model once per process"""
+    global _pipe
+    import torch
+    import llm
+
+    if threads:
+        torch.set_num_threads(threads)
+    _pipe = llm.build_pipeline(model_name, mode)
+
+
+def evaluate_batch(items, generation_kwargs):
+    """Generate and score the answers of one batch of items"""
+    import llm
+    from metrics import calculate_metrics_batch
+
+    answers = llm.generate_batch(
+        _pipe, [question for _, question, _, _ in items], batch_size=len(items),
+        input_ids=[input_ids for _, _, _, input_ids in items], **generation_kwargs
+    )
+    bleu_scores, similarity_scores, word_counts, relevance_scores = calculate_metrics_batch(
+        [answer for answer, _ in answers], [correct_answer for _, _, correct_answer, _ in items]
+    )
+    return [
+        {
+            "item_key": item_key,
+            "question": question,
+            "correct_answer": correct_answer,
+            "answer": answer,
+            "response_time": seconds,
+            "batch_size": len(items),
+            "bleu_score": float(bleu_scores[i]),
+            "similarity_score": float(similarity_scores[i]),
+            "word_count": int(word_counts[i]),
+            "relevance_score": float(relevance_scores[i]),
+        }
+        for i, ((item_key, question, correct_answer, _), (answer, seconds)) in enumerate(zip(items, answers))
+    ]
+
+
+def print_report(run_ids=None, db_file=DB_FILE):
+    """Print aggregate quality and latency per run"""
+    summaries = database.get_eval_run_summaries(run_ids, db_file)
+    if summaries.empty:
+        print("No evaluation runs yet.")
+        return
+    columns = ["run_id", "model", "config_hash", "items", "total_items", "bleu_score", "similarity_score",
+               "relevance_score", "word_count", "latency_p50", "latency_p95", "items_per_second"]
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.4f}".format):
+        print(summaries[columns].to_string(index=False))
+
+
+def run(args):
+    database.init_evaluation_tables(args.db)
+    generation_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": args.sample}
+    if args.sample:
+        generation_kwargs.update(temperature=args.temperature, top_p=args.top_p)
+    # Everything that changes the answers or their timing; --limit and --workers only change which and how
+    config = {"source": args.source, "precision": args.precision, "batch_size": args.batch_size, **generation_kwargs}
+    items = load_questions(args.source, args.limit, args.db)
+    run_id = database.get_or_create_eval_run(args.model, config_hash(config), json.dumps(config, sort_keys=True),
+                                             len(items), args.db)
+    done = database.get_eval_done_keys(run_id, args.db)
+    remaining = [item for item in items if item[0] not in done]
+    print(f"Run {run_id} ({args.model}, config {config_hash(config)}): {len(items)} items, "
+          f"{len(done)} already done, {len(remaining)} to evaluate")
+
+    if remaining:
+        from transformers import AutoTokenizer
+        import llm
+
+        # Tokenize once and batch questions of similar length together; workers generate from these IDs
+        input_ids = llm.tokenize_questions(AutoTokenizer.from_pretrained(args.model), [q for _, q, _ in remaining])
+        lengths = [len(ids) for ids in input_ids]
+        plan = bucketing.plan_batches(lengths, args.batch_size)
+        batches = [[remaining[i] + (input_ids[i],) for i in batch] for batch in plan]
+        bucketed, in_order = bucketing.PaddingStats(), bucketing.PaddingStats()
+        for batch in plan:
+            bucketed.record([lengths[i] for i in batch])
+        for start in range(0, len(lengths), args.batch_size):
+            in_order.record(lengths[start:start + args.batch_size])
+        print(f"Padding efficiency: {bucketed.efficiency():.1%} bucketed by length "
+              f"({in_order.efficiency():.1%} in question order)")
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        task = functools.partial(evaluate_batch, generation_kwargs=generation_kwargs)
+        start_time = checkpoint_time = time.perf_counter()
+        finished = 0
+
+        def store(results):
+            # Each batch is committed as it arrives, which is the checkpoint a later run resumes from;
+            # the wall-clock time since the last checkpoint is stored with it (including model loading)
+            nonlocal finished, checkpoint_time
+            now = time.perf_counter()
+            database.save_eval_results(run_id, results, now - checkpoint_time, args.db)
+            checkpoint_time = now
+            finished += len(results)
+            print(f"  {finished}/{len(remaining)} items ({time.perf_counter() - start_time:.1f} s)")
+
+        if args.workers > 1:
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(args.workers, initializer=_init_worker,
+                          initargs=(args.model, args.precision, threads)) as pool:
+                for results in pool.imap_unordered(task, batches):
+                    store(results)
+        else:
+            _init_worker(args.model, args.precision, args.threads)
+            for batch in batches:
+                store(task(batch))
+        print(f"Evaluated {finished} items in {time.perf_counter() - start_time:.1f} s with {args.workers} process(es)")
+
+    print_report([run_id], args.db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a model against the stored correct answers")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--precision", default=None, type=str.lower, choices=PRECISIONS,
+                        help="Precision mode of precision.py (default: LLM_PRECISION or config.PRECISION)")
+    parser.add_argument("--source", choices=["history", "samples"], default="history",
+                        help="Questions with a correct answer from chat_history, or SAMPLE_QUESTIONS_DATA")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first N questions")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--sample", action="store_true", help="Sample instead of greedy decoding")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--workers", type=int, default=1, help="Processes, each with its own copy of the model")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads per process")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--report", action="store_true", help="Only print the summary of all runs")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers)
+    if args.precision is None:
+        # argparse does not check a default against choices, so the configured mode is validated here
+        try:
+            args.precision = resolve_precision(PRECISION)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.report:
+        database.init_evaluation_tables(args.db)
+        print_report(db_file=args.db)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# lazy_imports.py
+# Lazy module proxies for heavy dependencies (torch, transformers, sklearn, Janome, NLTK), so pages
+# that do not need them render without paying their import time, and an opt-in import profiler.
+# Set STARTUP_PROFILE=1 to print the time spent importing each module when the app starts.
+import builtins
+import importlib
+import os
+import sys
+import threading
+import time
+import types
+
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "") not in ("", "0")
+
+_profile_lock = threading.Lock()
+_profile_entries = []  # [depth, module name, seconds], in the order the imports started
+_profile_state = threading.local()
+_profile_thread = None  # Only imports on the thread that started profiling (the script thread) are recorded
+_original_import = builtins.__import__
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that imports it on first attribute access"""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            with self.__dict__["_lock"]:
+                module = self.__dict__["_module"]
+                if module is None:
+                    entry = _profile_start(f"{self.__name__} (lazy)") if _profiling() else None
+                    start_time = time.perf_counter()
+                    module = importlib.import_module(self.__name__)
+                    if entry is not None:
+                        _profile_end(entry, time.perf_counter() - start_time)
+                    self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name):
+    """Return the module if it is already imported, otherwise a proxy that imports it on first use"""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+def is_loaded(module):
+    """Whether a module returned by lazy_import has actually been imported"""
+    return not isinstance(module, LazyModule) or module.__dict__["_module"] is not None
+
+
+# --- Startup profiler ---
+def _profiling():
+    return _profile_thread is not None and threading.get_ident() == _profile_thread
+
+
+def _profile_start(name):
+    depth = getattr(_profile_state, "depth", 0)
+    entry = [depth, name, None]
+    with _profile_lock:
+        _profile_entries.append(entry)
+    _profile_state.depth = depth + 1
+    return entry
+
+
+def _profile_end(entry, seconds):
+    entry[2] = seconds
+    _profile_state.depth = entry[0]
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules or not _profiling():
+        return _original_import(name, globals, locals, fromlist, level)
+    entry = _profile_start(name)
+    start_time = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _profile_end(entry, time.perf_counter() - start_time)
+
+
+def start_import_profile():
+    """Record the import time of every module this thread imports from now on (only with STARTUP_PROFILE=1)"""
+    global _profile_thread
+    if STARTUP_PROFILE:
+        _profile_thread = threading.get_ident()
+        builtins.__import__ = _profiled_import
+
+
+def print_import_profile(max_depth=2, min_ms=1.0):
+    """Print the recorded import times as a tree and clear them"""
+    if not STARTUP_PROFILE:
+        return
+    with _profile_lock:
+        entries = [entry for entry in _profile_entries if entry[2] is not None]
+        _profile_entries.clear()
+    if not entries:
+        return
+    total = sum(seconds for depth, _, seconds in entries if depth == 0)
+    print(f"Import profile: {total * 1000:.0f} ms in top-level imports")
+    for depth, name, seconds in entries:
+        if depth <= max_depth and seconds * 1000 >= min_ms:
+            print(f"  {seconds * 1000:9.1f} ms  {'  ' * depth}{name}")
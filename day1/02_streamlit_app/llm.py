@@ -1,48 +1,240 @@
 # llm.py
 import os
-import torch
-from transformers import pipeline
 import streamlit as st
 import time
-from config import MODEL_NAME
-from huggingface_hub import login
+import threading
+from config import MODEL_NAME, PRECISION, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB, RESPONSE_CACHE_DB_SIZE, PREFIX_CACHE_MAX_MB
+from config import PREFIX_CACHE_CONVERSATIONS
+from config import MAX_CONTEXT_TOKENS, CONTEXT_TRIM_TARGET, MESSAGE_OVERHEAD_TOKENS
+from config import DRAFT_MODEL_NAME, DRAFT_TOKENS
+import shared_path  # Puts ../shared on sys.path
+from response_cache import ResponseCache, make_cache_key, should_use_cache
+from model_loader import BackgroundModelLoader, READY
+from telemetry import LLMMetrics
+from lazy_imports import lazy_import
 
+# torch and transformers take seconds to import; they are loaded on first use (normally by the
+# background model loader), so pages that do not generate text render without them
+torch = lazy_import("torch")
+transformers = lazy_import("transformers")
+prefix_cache = lazy_import("prefix_cache")  # Imports torch
+precision = lazy_import("precision")  # Imports torch
+bucketing = lazy_import("bucketing")  # Imports torch
+speculative = lazy_import("speculative")  # Imports torch
 
-# モデルをキャッシュして再利用
+# Sampling parameters used for every chat response
+GENERATION_KWARGS = {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 0.9}
+
+
+def build_pipeline(model_name=MODEL_NAME, mode=None):
+    """Create the text-generation pipeline (no Streamlit calls, so it can run on a background thread or in another process)"""
+    mode = mode or precision.resolve_precision(PRECISION)
+    print(f"Using device: {precision.precision_device(mode)}, precision: {mode}")  # For debugging
+    return precision.build_precision_pipeline(model_name, mode)
+
+def load_pipeline():
+    """Load the chat pipeline and, when DRAFT_MODEL_NAME is set, the draft model for speculative decoding.
+
+    The decoder is kept on the pipeline (pipe.speculative_decoder) so it is loaded and released
+    together with the model. If the draft model cannot be used, chat falls back to plain decoding.
+    """
+    pipe = build_pipeline()
+    if DRAFT_MODEL_NAME:
+        try:
+            draft = speculative.load_draft(DRAFT_MODEL_NAME, precision.resolve_precision(PRECISION))
+            pipe.speculative_decoder = speculative.make_decoder(pipe, draft, DRAFT_TOKENS)
+            print(f"Speculative decoding with draft model '{DRAFT_MODEL_NAME}'")  # For debugging
+        except Exception as e:
+            print(f"Warning: draft model '{DRAFT_MODEL_NAME}' is not used: {e}")
+    return pipe
+
+def get_speculative_decoder(pipe):
+    """The pipeline's speculative decoder, or None when chat uses plain decoding"""
+    return getattr(pipe, "speculative_decoder", None)
+
+# Loaded once per process on a background thread so pages render while the model loads
 @st.cache_resource
-def load_model():
-    """Load the LLM model"""
-    try:
-        # Save access token
-        hf_token = st.secrets["huggingface"]["token"]
-        
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.info(f"Using device: {device}")  # Display the device being used
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        st.success(f"Successfully loaded model '{MODEL_NAME}'.")
-        return pipe
-    except Exception as e:
-        st.error(f"Failed to load model '{MODEL_NAME}': {e}")
-        st.error("There might be insufficient GPU memory. Consider terminating unnecessary processes or using a smaller model.")
+def get_model_loader():
+    """Return the process-wide model loader, starting the load on first use"""
+    loader = BackgroundModelLoader(load_pipeline)
+    loader.start()
+    return loader
+
+# Shared by all sessions so repeated questions hit the cache regardless of who asked first
+@st.cache_resource
+def get_response_cache():
+    """Return the process-wide response cache"""
+    return ResponseCache(
+        max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+        disk_path=RESPONSE_CACHE_DB, disk_max_entries=RESPONSE_CACHE_DB_SIZE,
+    )
+
+# Key/values of the chat template header are shared by every question, so they are kept across sessions.
+# The leading underscore keeps _model out of the cache key: the app has one model, which sizes the budget once
+@st.cache_resource
+def get_prefix_cache(_model):
+    """Return the process-wide prefix key/value cache, or None when disabled.
+
+    Without a fixed PREFIX_CACHE_MAX_MB the budget is sized from _model so that
+    PREFIX_CACHE_CONVERSATIONS conversations at the full context window (MAX_CONTEXT_TOKENS
+    plus a reply of max_new_tokens) fit; a smaller budget could not keep long conversations.
+    """
+    if PREFIX_CACHE_MAX_MB is None:
+        window_tokens = MAX_CONTEXT_TOKENS + GENERATION_KWARGS["max_new_tokens"]
+        max_bytes = PREFIX_CACHE_CONVERSATIONS * window_tokens * prefix_cache.kv_bytes_per_token(_model)
+    elif PREFIX_CACHE_MAX_MB <= 0:
         return None
+    else:
+        max_bytes = PREFIX_CACHE_MAX_MB * 1024 * 1024
+    return prefix_cache.PrefixKVCache(max_bytes=max_bytes)
+
+# Process-wide like the caches, so the sidebar panel shows every session's requests
+@st.cache_resource
+def get_metrics():
+    """Return the process-wide generation metrics"""
+    metrics = LLMMetrics()
+    metrics.track_model_state(lambda: get_model_loader().state)
+
+    def cache_hits():
+        hits = {"response": get_response_cache().hits}
+        # The prefix cache imports torch, so it is only read once the model (and torch) is loaded
+        kv_cache = get_prefix_cache(get_model_loader().model.model) if get_model_loader().state == READY else None
+        if kv_cache is not None:
+            hits["prefix"] = kv_cache.hits
+        return hits
+
+    def speculative_stats():
+        decoder = get_speculative_decoder(get_model_loader().model)
+        return decoder.stats.stats() if decoder is not None else None
+
+    metrics.track_cache_hits(cache_hits)
+    metrics.track_speculative(speculative_stats)
+    return metrics
+
+class Conversation:
+    """Turns of one multi-turn chat session and the window of them sent to the model.
+
+    Each message caches its token count ("tokens"), so budgeting a turn never tokenizes the
+    history again. When the window exceeds MAX_CONTEXT_TOKENS, whole turns are dropped from
+    the front until it fits CONTEXT_TRIM_TARGET of the budget; between trims the window only
+    grows, so the encoded history stays in the prefix cache and every turn only encodes its
+    new tokens.
+    """
+
+    def __init__(self, messages=None, session_id=None, max_tokens=MAX_CONTEXT_TOKENS):
+        self.messages = messages or []
+        self.session_id = session_id  # chat_sessions.id once persisted
+        self.max_tokens = max_tokens
+        self.context_start = 0  # Index of the first message in the window
+
+    @staticmethod
+    def count_tokens(tokenizer, message):
+        """Tokens a message takes in the prompt, computed once per message"""
+        if message.get("tokens") is None:
+            content_tokens = len(tokenizer(message["content"], add_special_tokens=False)["input_ids"])
+            message["tokens"] = content_tokens + MESSAGE_OVERHEAD_TOKENS
+        return message["tokens"]
+
+    def context(self, tokenizer, user_question):
+        """Messages to send for a new question: the window of earlier turns plus the question"""
+        candidate = self.messages + [{"role": "user", "content": user_question}]
+        total = sum(self.count_tokens(tokenizer, m) for m in candidate[self.context_start:])
+        if total > self.max_tokens:
+            target = self.max_tokens * CONTEXT_TRIM_TARGET
+            start = self.context_start
+            # Drop whole turns so the window still starts with a user message; the question itself is always kept
+            while start < len(candidate) - 1 and (total > target or candidate[start]["role"] != "user"):
+                total -= candidate[start]["tokens"]
+                start += 1
+            self.context_start = start
+        return [{"role": m["role"], "content": m["content"]} for m in candidate[self.context_start:]]
+
+    def add_turn(self, tokenizer, user_question, answer):
+        """Record a finished turn and return its two new messages"""
+        new_messages = [{"role": "user", "content": user_question}, {"role": "assistant", "content": answer}]
+        for message in new_messages:
+            self.count_tokens(tokenizer, message)
+        self.messages.extend(new_messages)
+        return new_messages
+
+def _run_pipeline(pipe, messages, store_output=False, stats=None, **kwargs):
+    """Generate a reply to messages, reusing cached key/values of the prompt prefix when enabled.
 
-def generate_response(pipe, user_question):
-    """Generate a response to the user's question using the LLM"""
+    With store_output=True the key/values of the whole exchange are kept for the next turn.
+    With a speculative decoder on the pipeline, the draft model assists instead (assisted
+    generation keeps its own key/values, so the prefix cache is not used).
+    The chat template is rendered once and every path generates from those token IDs with the
+    pipeline's model, so nothing is tokenized twice; the reply is decoded from the output IDs.
+    Returns the pipeline's output format so callers can extract the reply the same way.
+    Token counts and tokens/sec are recorded in get_metrics(), and written to the optional
+    `stats` dict ("tokens_per_second", and "speculative" acceptance statistics or None).
+    """
+    if stats is None:
+        stats = {}
+    kv_cache = get_prefix_cache(pipe.model)
+    decoder = get_speculative_decoder(pipe)
+    tokenizer = pipe.tokenizer
+    input_ids = tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_dict=True, return_tensors="pt"
+    )["input_ids"][0]
+    start_time = time.perf_counter()
+    stats["speculative"] = None
+    if decoder is not None:
+        output_ids, stats["speculative"] = decoder.generate(input_ids, **GENERATION_KWARGS, **kwargs)
+    elif kv_cache is None:
+        batch = input_ids.unsqueeze(0).to(pipe.model.device)
+        with torch.no_grad():
+            output_ids = pipe.model.generate(
+                batch, attention_mask=torch.ones_like(batch), **GENERATION_KWARGS, **kwargs
+            )
+    else:
+        output_ids = kv_cache.generate(
+            pipe.model, input_ids,
+            prefix_length=prefix_cache.chat_prefix_length(tokenizer, messages, input_ids),
+            store_output=store_output,
+            **GENERATION_KWARGS, **kwargs,
+        )
+    compute_time = time.perf_counter() - start_time
+    generated_tokens = output_ids.shape[1] - len(input_ids)
+    get_metrics().record_tokens(len(input_ids), generated_tokens, compute_time)
+    stats["tokens_per_second"] = generated_tokens / compute_time if compute_time else None
+    reply = tokenizer.decode(output_ids[0, len(input_ids):], skip_special_tokens=True)
+    return [{"generated_text": messages + [{"role": "assistant", "content": reply}]}]
+
+def _cache_key(messages):
+    """Cache key for a chat request with the current model and sampling parameters"""
+    return make_cache_key(messages, MODEL_NAME, **GENERATION_KWARGS)
+
+def generate_response(pipe, user_question, cache_sampled=False, conversation=None):
+    """Generate a response to the user's question using the LLM.
+
+    Responses are cached per question; because sampling is enabled, the cache is only
+    used when cache_sampled=True. When a Conversation is given, its earlier turns are sent
+    as context (the caller records the new turn with Conversation.add_turn).
+    """
     if pipe is None:
         return "Cannot generate a response because the model is not loaded.", 0
 
+    metrics = get_metrics()
+    metrics.in_flight.inc()
     try:
         start_time = time.time()
-        messages = [
-            {"role": "user", "content": user_question},
-        ]
+        if conversation is not None:
+            messages = conversation.context(pipe.tokenizer, user_question)
+        else:
+            messages = [
+                {"role": "user", "content": user_question},
+            ]
+        use_cache = should_use_cache(GENERATION_KWARGS["do_sample"], cache_sampled)
+        if use_cache:
+            cached = get_response_cache().get(_cache_key(messages))
+            if cached is not None:
+                response_time = time.time() - start_time
+                metrics.record_generation(response_time, endpoint="chat")
+                return cached, response_time
+
         # Allow adjustment of max_new_tokens (example)
-        outputs = pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
+        outputs = _run_pipeline(pipe, messages, store_output=conversation is not None)
 
         # Adjustments may be needed to match Gemma's output format
         # Retrieve the last assistant message
@@ -72,15 +264,137 @@ def generate_response(pipe, user_question):
              # Fallback or debugging if the response is not found above
              print("Warning: Could not extract assistant response. Full output:", outputs)
              assistant_response = "Failed to extract the response."
+        elif use_cache:
+             get_response_cache().set(_cache_key(messages), assistant_response)
 
         end_time = time.time()
         response_time = end_time - start_time
         print(f"Generated response in {response_time:.2f}s")  # For debugging
+        metrics.record_generation(response_time, endpoint="chat")
         return assistant_response, response_time
 
     except Exception as e:
+        metrics.record_error("generation")
         st.error(f"An error occurred while generating the response: {e}")
         # Output error details to the log
         import traceback
         traceback.print_exc()
         return f"An error occurred: {str(e)}", 0
+    finally:
+        metrics.in_flight.dec()
+
+def tokenize_questions(tokenizer, questions):
+    """Chat-template token IDs of single-turn questions, as generate_batch sends them"""
+    return bucketing.tokenize(tokenizer, [[{"role": "user", "content": q}] for q in questions])
+
+def generate_batch(pipe, questions, batch_size=8, input_ids=None, padding_stats=None, **generation_kwargs):
+    """Answer single-turn questions in length-bucketed batches, for offline evaluation.
+
+    Questions are tokenized once (or input_ids from tokenize_questions are reused) and
+    batched with prompts of similar length, so little compute goes to padding; padding_stats
+    (bucketing.PaddingStats) collects how much. No caches, metrics or Streamlit calls are
+    involved. generation_kwargs override GENERATION_KWARGS. Returns (answer, seconds) per
+    question, in order, where seconds is the time of the batch the question was generated in.
+    """
+    if input_ids is None:
+        input_ids = tokenize_questions(pipe.tokenizer, questions)
+    kwargs = {**GENERATION_KWARGS, **generation_kwargs}
+    results = bucketing.generate_bucketed(
+        pipe.model, pipe.tokenizer, input_ids, batch_size, padding_stats=padding_stats, **kwargs
+    )
+    return [(answer.strip(), seconds) for answer, seconds in results]
+
+def generate_response_stream(pipe, user_question, timings=None, cache_sampled=False, conversation=None):
+    """Stream the response to the user's question as text chunks.
+
+    `timings` (optional dict) is filled with "response_time", "time_to_first_token",
+    "cached", "tokens_per_second" and "speculative" (draft acceptance statistics when
+    speculative decoding is on) once the generator is exhausted. Caching and `conversation` work as
+    in generate_response.
+    """
+    if timings is None:
+        timings = {}
+    metrics = get_metrics()
+    metrics.in_flight.inc()
+    try:
+        yield from _stream_response(pipe, user_question, timings, cache_sampled, conversation)
+        if pipe is not None:
+            metrics.record_generation(
+                timings["response_time"], endpoint="chat_stream", time_to_first_token=timings["time_to_first_token"]
+            )
+    finally:
+        metrics.in_flight.dec()
+
+def _stream_response(pipe, user_question, timings, cache_sampled, conversation):
+    """Body of generate_response_stream"""
+    timings["response_time"] = 0
+    timings["time_to_first_token"] = None
+    timings["cached"] = False
+    timings["tokens_per_second"] = None
+    timings["speculative"] = None
+    if pipe is None:
+        yield "Cannot generate a response because the model is not loaded."
+        return
+
+    start_time = time.time()
+    if conversation is not None:
+        messages = conversation.context(pipe.tokenizer, user_question)
+    else:
+        messages = [
+            {"role": "user", "content": user_question},
+        ]
+    use_cache = should_use_cache(GENERATION_KWARGS["do_sample"], cache_sampled)
+    if use_cache:
+        cached = get_response_cache().get(_cache_key(messages))
+        if cached is not None:
+            timings["time_to_first_token"] = timings["response_time"] = time.time() - start_time
+            timings["cached"] = True
+            yield cached
+            return
+    # skip_prompt=True means only the newly generated assistant tokens are streamed
+    streamer = transformers.TextIteratorStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+    stats = {}
+
+    def run_generation():
+        try:
+            _run_pipeline(pipe, messages, store_output=conversation is not None, stats=stats, streamer=streamer)
+        except Exception as e:
+            # Output error details to the log
+            import traceback
+            traceback.print_exc()
+            errors.append(e)
+            get_metrics().record_error("generation")
+            streamer.end()  # Unblock the consumer loop below
+
+    thread = threading.Thread(target=run_generation, daemon=True)
+    thread.start()
+
+    started = False
+    chunks = []
+    for chunk in streamer:
+        if not started:
+            # Equivalent of .strip() on the leading side of the full response
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+            timings["time_to_first_token"] = time.time() - start_time
+        chunks.append(chunk)
+        yield chunk
+    thread.join()
+    timings["tokens_per_second"] = stats.get("tokens_per_second")
+    timings["speculative"] = stats.get("speculative")
+
+    if errors:
+        st.error(f"An error occurred while generating the response: {errors[0]}")
+        yield f"An error occurred: {str(errors[0])}"
+    elif not started:
+        print("Warning: Could not extract assistant response from the stream.")
+        yield "Failed to extract the response."
+    elif use_cache:
+        get_response_cache().set(_cache_key(messages), "".join(chunks).strip())
+
+    timings["response_time"] = time.time() - start_time
+    if timings["time_to_first_token"] is not None:
+        print(f"Streamed response in {timings['response_time']:.2f}s (first token after {timings['time_to_first_token']:.2f}s)")  # For debugging
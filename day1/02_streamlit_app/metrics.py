@@ -1,38 +1,144 @@
 # metrics.py
-import streamlit as st
-import nltk
-from janome.tokenizer import Tokenizer
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+import sys
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+from lazy_imports import lazy_import
+
+# Heavy dependencies are imported on first use, so pages that never score answers do not load them
+nltk = lazy_import("nltk")
+janome_tokenizer = lazy_import("janome.tokenizer")
+sklearn_text = lazy_import("sklearn.feature_extraction.text")
+sklearn_pairwise = lazy_import("sklearn.metrics.pairwise")
 
 # NLTK helper functions (with fallback on error)
-try:
-    nltk.download('punkt', quiet=True)
-    from nltk.translate.bleu_score import sentence_bleu as nltk_sentence_bleu
-    from nltk.tokenize import word_tokenize as nltk_word_tokenize
-    print("NLTK loaded successfully.")  # For debugging
-except Exception as e:
-    st.warning(f"An error occurred during NLTK initialization: {e}\nUsing simplified fallback functions.")
-    def nltk_word_tokenize(text):
-        return text.split()
-    def nltk_sentence_bleu(references, candidate):
-        # Simplified BLEU score (exact/partial match)
-        ref_words = set(references[0])
-        cand_words = set(candidate)
-        common_words = ref_words.intersection(cand_words)
-        precision = len(common_words) / len(cand_words) if cand_words else 0
-        recall = len(common_words) / len(ref_words) if ref_words else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        return f1  # Return F1 score as a simplified alternative
+def nltk_word_tokenize(text):
+    return text.split()
 
-def initialize_nltk():
-    """Function to attempt downloading NLTK data"""
+def nltk_sentence_bleu(references, candidate):
+    # Simplified BLEU score (exact/partial match)
+    ref_words = set(references[0])
+    cand_words = set(candidate)
+    common_words = ref_words.intersection(cand_words)
+    precision = len(common_words) / len(cand_words) if cand_words else 0
+    recall = len(common_words) / len(ref_words) if ref_words else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    return f1  # Return F1 score as a simplified alternative
+
+NLTK_AVAILABLE = False
+NLTK_DOWNLOAD_TIMEOUT = 10  # Seconds to wait for the punkt download before giving up (e.g. offline)
+_nltk_checked = False
+_nltk_lock = threading.Lock()
+
+def _punkt_available(word_tokenize):
     try:
-        nltk.download('punkt', quiet=True)
-        print("NLTK Punkt data checked/downloaded.")  # For debugging
-    except Exception as e:
-        st.error(f"Failed to download NLTK data: {e}")
+        word_tokenize("Punkt check.")
+        return True
+    except LookupError:
+        return False
+
+def _download_punkt():
+    # nltk.download has no timeout, so it runs on a daemon thread that is abandoned if it hangs
+    def download():
+        for resource in ("punkt_tab", "punkt"):  # punkt_tab is used by NLTK >= 3.8.2
+            try:
+                nltk.download(resource, quiet=True)
+            except Exception:
+                pass
+    thread = threading.Thread(target=download, name="nltk-download", daemon=True)
+    thread.start()
+    thread.join(NLTK_DOWNLOAD_TIMEOUT)
+
+def initialize_nltk():
+    """Import NLTK and check its punkt data once per process; returns whether NLTK is available.
+
+    The data is downloaded only if it is missing, with a timeout. Without punkt, words are
+    tokenized without sentence splitting (which needs no data); without NLTK itself, the
+    simplified fallback functions above are used.
+    """
+    global NLTK_AVAILABLE, _nltk_checked, nltk_word_tokenize, nltk_sentence_bleu
+    if _nltk_checked:
+        return NLTK_AVAILABLE
+    with _nltk_lock:
+        if _nltk_checked:
+            return NLTK_AVAILABLE
+        try:
+            from nltk.translate.bleu_score import sentence_bleu
+            from nltk.tokenize import word_tokenize
+            if not _punkt_available(word_tokenize):
+                _download_punkt()
+            if _punkt_available(word_tokenize):
+                nltk_word_tokenize = word_tokenize
+                print("NLTK loaded successfully.")  # For debugging
+            else:
+                nltk_word_tokenize = lambda text: word_tokenize(text, preserve_line=True)
+                print("NLTK punkt data is unavailable; tokenizing without sentence splitting.")  # For debugging
+            nltk_sentence_bleu = sentence_bleu
+            NLTK_AVAILABLE = True
+        except Exception as e:
+            print(f"An error occurred during NLTK initialization: {e}\nUsing simplified fallback functions.")
+        _nltk_checked = True
+    return NLTK_AVAILABLE
+
+# --- Shared tokenizer and tokenization cache ---
+# Building a Janome Tokenizer loads its system dictionary, so one instance is shared by the process.
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+_tokenize_lock = threading.Lock()
+
+TOKEN_CACHE_SIZE = 4096  # Number of (kind, text) tokenization results kept
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def get_tokenizer():
+    """Return the process-wide Janome tokenizer, loading it on first use"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                _tokenizer = janome_tokenizer.Tokenizer()
+    return _tokenizer
+
+def _janome_tokenize(text):
+    # Janome does not document its tokenizer as thread-safe, so calls are serialized
+    tokenizer = get_tokenizer()
+    with _tokenize_lock:
+        return tuple(token.surface for token in tokenizer.tokenize(text))
+
+def _word_tokenize(text):
+    initialize_nltk()
+    return tuple(nltk_word_tokenize(text))
+
+def _regex_words(text):
+    return frozenset(re.findall(r'\w+', text))
+
+_TOKENIZERS = {
+    "janome": _janome_tokenize,           # Word count
+    "word": _word_tokenize,               # BLEU
+    "regex": _regex_words,                # Relevance
+}
+
+def tokenize_cached(text, kind):
+    """Tokenize text with the given tokenizer kind, reusing results from an LRU cache keyed by text hash"""
+    key = (kind, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    with _token_cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is not None:
+            _token_cache.move_to_end(key)
+            return tokens
+    tokens = _TOKENIZERS[kind](text)
+    with _token_cache_lock:
+        _token_cache[key] = tokens
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return tokens
+
+def clear_token_cache():
+    """Drop all cached tokenization results"""
+    with _token_cache_lock:
+        _token_cache.clear()
 
 def calculate_metrics(answer, correct_answer):
     """Calculate evaluation metrics from the answer and correct answer"""
@@ -43,11 +149,10 @@ def calculate_metrics(answer, correct_answer):
 
     if not answer:  # Do not calculate if there is no answer
         return bleu_score, similarity_score, word_count, relevance_score
+    initialize_nltk()
 
     # Count the number of words
-    tokenizer = Tokenizer()
-    tokens = list(tokenizer.tokenize(answer))  # Convert iterator to list
-    word_count = len(tokens)
+    word_count = len(tokenize_cached(answer, "janome"))
 
     # Calculate BLEU and similarity only if there is a correct answer
     if correct_answer:
@@ -56,8 +161,8 @@ def calculate_metrics(answer, correct_answer):
 
         # Calculate BLEU score
         try:
-            reference = [nltk_word_tokenize(correct_answer_lower)]
-            candidate = nltk_word_tokenize(answer_lower)
+            reference = [list(tokenize_cached(correct_answer_lower, "word"))]
+            candidate = list(tokenize_cached(answer_lower, "word"))
             # Prevent division by zero
             if candidate:
                 bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25))  # 4-gram BLEU
@@ -69,11 +174,11 @@ def calculate_metrics(answer, correct_answer):
 
         # Calculate cosine similarity
         try:
-            vectorizer = TfidfVectorizer()
+            vectorizer = sklearn_text.TfidfVectorizer()
             # fit_transform expects a list, so pass as a list
             if answer_lower.strip() and correct_answer_lower.strip():  # Ensure non-empty strings
                 tfidf_matrix = vectorizer.fit_transform([answer_lower, correct_answer_lower])
-                similarity_score = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
+                similarity_score = sklearn_pairwise.cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
             else:
                 similarity_score = 0.0
         except Exception as e:
@@ -82,8 +187,8 @@ def calculate_metrics(answer, correct_answer):
 
         # Calculate relevance score (based on keyword match rate)
         try:
-            answer_words = set(re.findall(r'\w+', answer_lower))
-            correct_words = set(re.findall(r'\w+', correct_answer_lower))
+            answer_words = tokenize_cached(answer_lower, "regex")
+            correct_words = tokenize_cached(correct_answer_lower, "regex")
             if len(correct_words) > 0:
                 common_words = answer_words.intersection(correct_words)
                 relevance_score = len(common_words) / len(correct_words)
@@ -95,6 +200,101 @@ def calculate_metrics(answer, correct_answer):
 
     return bleu_score, similarity_score, word_count, relevance_score
 
+BLEU_MAX_ORDER = 4  # 4-gram BLEU with uniform weights, as in calculate_metrics
+
+def _ngram_counts(tokens, n):
+    return Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+def _bleu_from_counts(matches, totals, hyp_lengths, ref_lengths):
+    """Sentence BLEU for every row from clipped n-gram match counts (same result as NLTK's sentence_bleu)"""
+    totals = np.maximum(totals, 1)
+    # NLTK's default smoothing replaces zero precisions with the smallest positive float
+    precisions = np.where(matches > 0, matches / totals, sys.float_info.min)
+    log_precision = np.log(precisions).mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        brevity_penalty = np.where(
+            hyp_lengths > ref_lengths, 1.0, np.exp(1 - ref_lengths / np.maximum(hyp_lengths, 1))
+        )
+    bleu = brevity_penalty * np.exp(log_precision)
+    # No candidate tokens or no unigram match -> 0, as in calculate_metrics
+    return np.where((hyp_lengths > 0) & (matches[:, 0] > 0), bleu, 0.0)
+
+def calculate_metrics_batch(answers, correct_answers):
+    """Calculate evaluation metrics for many (answer, correct_answer) pairs at once.
+
+    Returns NumPy arrays (bleu_scores, similarity_scores, word_counts, relevance_scores)
+    aligned with the inputs. A single TF-IDF vectorizer is fitted over the whole batch,
+    so similarity uses IDF weights from the batch rather than from each pair alone.
+    """
+    answers = [a or "" for a in answers]
+    correct_answers = [c or "" for c in correct_answers]
+    n = len(answers)
+    bleu_scores = np.zeros(n)
+    similarity_scores = np.zeros(n)
+    word_counts = np.zeros(n, dtype=np.int64)
+    relevance_scores = np.zeros(n)
+    if n == 0:
+        return bleu_scores, similarity_scores, word_counts, relevance_scores
+
+    initialize_nltk()
+    answers_lower = [a.lower() for a in answers]
+    correct_lower = [c.lower() for c in correct_answers]
+    # Rows that calculate_metrics would score against a correct answer
+    scored = np.array([bool(a) and bool(c) for a, c in zip(answers, correct_answers)])
+
+    # One pass for word counts, BLEU n-gram counts and relevance word sets
+    matches = np.zeros((n, BLEU_MAX_ORDER))
+    totals = np.zeros((n, BLEU_MAX_ORDER))
+    hyp_lengths = np.zeros(n)
+    ref_lengths = np.zeros(n)
+    bleu_ok = np.zeros(n, dtype=bool)
+    for i in range(n):
+        if not answers[i]:
+            continue
+        word_counts[i] = len(tokenize_cached(answers[i], "janome"))
+        if not scored[i]:
+            continue
+        try:
+            candidate = tokenize_cached(answers_lower[i], "word")
+            reference = tokenize_cached(correct_lower[i], "word")
+            if NLTK_AVAILABLE:
+                for order in range(1, BLEU_MAX_ORDER + 1):
+                    candidate_counts = _ngram_counts(candidate, order)
+                    reference_counts = _ngram_counts(reference, order)
+                    matches[i, order - 1] = sum((candidate_counts & reference_counts).values())
+                    totals[i, order - 1] = sum(candidate_counts.values())
+                hyp_lengths[i] = len(candidate)
+                ref_lengths[i] = len(reference)
+                bleu_ok[i] = True
+            elif candidate:
+                bleu_scores[i] = nltk_sentence_bleu([list(reference)], list(candidate))
+        except Exception:
+            pass  # BLEU stays 0 on error, as in calculate_metrics
+
+        correct_words = tokenize_cached(correct_lower[i], "regex")
+        if correct_words:
+            relevance_scores[i] = len(tokenize_cached(answers_lower[i], "regex") & correct_words) / len(correct_words)
+
+    if bleu_ok.any():
+        bleu_scores[bleu_ok] = _bleu_from_counts(
+            matches[bleu_ok], totals[bleu_ok], hyp_lengths[bleu_ok], ref_lengths[bleu_ok]
+        )
+
+    # Row-wise cosine similarity: TF-IDF rows are L2-normalized, so the dot product is the cosine
+    nonblank = scored & np.array([bool(a.strip()) and bool(c.strip()) for a, c in zip(answers_lower, correct_lower)])
+    if nonblank.any():
+        try:
+            index = np.flatnonzero(nonblank)
+            vectorizer = sklearn_text.TfidfVectorizer()
+            vectorizer.fit([answers_lower[i] for i in index] + [correct_lower[i] for i in index])
+            answer_matrix = vectorizer.transform([answers_lower[i] for i in index])
+            correct_matrix = vectorizer.transform([correct_lower[i] for i in index])
+            similarity_scores[index] = np.asarray(answer_matrix.multiply(correct_matrix).sum(axis=1)).ravel()
+        except Exception:
+            pass  # e.g. empty vocabulary; similarity stays 0 as in calculate_metrics
+
+    return bleu_scores, similarity_scores, word_counts, relevance_scores
+
 def get_metrics_descriptions():
     """Return descriptions of evaluation metrics"""
     return {
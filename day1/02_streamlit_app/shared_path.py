@@ -0,0 +1,10 @@
+# shared_path.py
+# Modules used by both apps (response_cache, prefix_cache, model_loader, precision, telemetry, bucketing,
+# speculative) live in ../shared, so there is one copy of each. Importing this module puts that directory
+# on sys.path; modules that import any of them import this first.
+import os
+import sys
+
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shared")
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
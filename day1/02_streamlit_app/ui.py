@@ -2,10 +2,33 @@
 import streamlit as st
 import pandas as pd
 import time
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
-from data import create_sample_evaluation_data
+from database import save_to_db, get_chat_history_page, count_chat_history, get_latest_history_id, get_db_count, clear_db, recompute_metrics
+from database import create_chat_session, save_chat_messages, get_chat_sessions, get_chat_messages
+from database import get_accuracy_counts, get_accuracy_means, get_metrics_describe, get_top_efficiency, get_recent_metrics, rebuild_aggregates
+from llm import generate_response_stream, Conversation
+from data import create_sample_evaluation_data, import_history_file
 from metrics import get_metrics_descriptions
+import shared_path  # Puts ../shared on sys.path
+from model_loader import LOADING, READY
+from config import MODEL_NAME
+
+RECENT_POINTS = 2000  # 散布図に表示する直近の件数
+
+# --- モデルの読み込み状態 ---
+@st.fragment(run_every=2)
+def display_model_status(model_loader):
+    """モデルの読み込み状態を定期的に確認して表示する"""
+    status = model_loader.status()
+    if status["state"] == READY:
+        st.rerun()  # アプリ全体を再実行してチャットを有効にする
+    elif status["state"] == LOADING:
+        st.info(f"Loading model '{MODEL_NAME}'... ({status['loading_seconds'] or 0:.0f}s) The chat will be enabled when it is ready.")
+    else:
+        st.error(f"Chat functionality is unavailable. Failed to load the model: {status['error']}")
+        st.error("There might be insufficient GPU memory. Consider terminating unnecessary processes or using a smaller model.")
+        if st.button("Retry loading the model"):
+            model_loader.start()
+            st.rerun()
 
 # --- チャットページのUI ---
 def display_chat_page(pipe):
@@ -26,9 +49,24 @@ def display_chat_page(pipe):
     """,
     unsafe_allow_html=True
     )
+    if "conversation" not in st.session_state:
+        st.session_state.conversation = Conversation()
+    conversation = st.session_state.conversation
+    display_conversation_controls()
+
+    # これまでのやり取りを表示（最新の回答は下の Response 欄に表示する）
+    shown_messages = conversation.messages
+    if st.session_state.get("current_answer") and len(shown_messages) >= 2:
+        shown_messages = shown_messages[:-2]
+    for message in shown_messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
     st.subheader("please input your question")
-    user_question = st.text_area("question", key="question_input", height=100, value=st.session_state.get("current_question", ""))
-    submit_button = st.button("submit")
+    # モデルの読み込みが終わるまで入力は無効
+    user_question = st.text_area("question", key="question_input", height=100, value=st.session_state.get("current_question", ""),
+                                 disabled=pipe is None)
+    submit_button = st.button("submit", disabled=pipe is None)
 
     # セッション状態の初期化（安全のため）
     if "current_question" not in st.session_state:
@@ -37,6 +75,8 @@ def display_chat_page(pipe):
         st.session_state.current_answer = ""
     if "response_time" not in st.session_state:
         st.session_state.response_time = 0.0
+    if "time_to_first_token" not in st.session_state:
+        st.session_state.time_to_first_token = None
     if "feedback_given" not in st.session_state:
         st.session_state.feedback_given = False
 
@@ -46,18 +86,46 @@ def display_chat_page(pipe):
         st.session_state.current_answer = "" # 回答をリセット
         st.session_state.feedback_given = False # フィードバック状態もリセット
 
-        with st.spinner("Generating response from the model..."):
-            answer, response_time = generate_response(pipe, user_question)
-            st.session_state.current_answer = answer
-            st.session_state.response_time = response_time
-            # ここでrerunすると回答とフィードバックが一度に表示される
-            st.rerun()
+        # 生成されたテキストを届いた順に表示する
+        st.subheader("Response:")
+        timings = {}
+        # サイドバーで有効にした場合は、同じ質問への過去の回答をキャッシュから返す
+        cache_sampled = st.session_state.get("cache_sampled", False)
+        answer = st.write_stream(generate_response_stream(
+            pipe, user_question, timings, cache_sampled=cache_sampled, conversation=conversation
+        ))
+        st.session_state.current_answer = answer.strip() if isinstance(answer, str) else str(answer)
+        # 会話に追加してデータベースにも保存（トークン数も一緒に保存し、再開時に数え直さない）
+        if pipe is not None:
+            new_messages = conversation.add_turn(pipe.tokenizer, user_question, st.session_state.current_answer)
+            if conversation.session_id is None:
+                conversation.session_id = create_chat_session(user_question[:50])
+            save_chat_messages(conversation.session_id, new_messages)
+        st.session_state.response_time = timings["response_time"]
+        st.session_state.time_to_first_token = timings["time_to_first_token"]
+        st.session_state.tokens_per_second = timings["tokens_per_second"]
+        st.session_state.speculative = timings["speculative"]
+        # ここでrerunすると回答とフィードバックが一度に表示される
+        st.rerun()
 
     # 回答が表示されるべきか判断 (質問があり、回答が生成済みで、まだフィードバックされていない)
     if st.session_state.current_question and st.session_state.current_answer:
         st.subheader("Response:")
         st.markdown(st.session_state.current_answer) # Markdownで表示
-        st.info(f"Response time: {st.session_state.response_time:.2f} seconds")
+        if st.session_state.time_to_first_token is not None:
+            st.info(f"Response time: {st.session_state.response_time:.2f} seconds (first token: {st.session_state.time_to_first_token:.2f} seconds)")
+        else:
+            st.info(f"Response time: {st.session_state.response_time:.2f} seconds")
+        # 生成速度と、投機的デコーディング時はドラフトモデルのトークンが採用された割合
+        details = []
+        if st.session_state.get("tokens_per_second"):
+            details.append(f"{st.session_state.tokens_per_second:.1f} tokens/sec")
+        speculative = st.session_state.get("speculative")
+        if speculative and speculative["acceptance_rate"] is not None:
+            details.append(f"draft acceptance {speculative['acceptance_rate']:.0%} "
+                           f"({speculative['accepted_tokens']}/{speculative['drafted_tokens']} tokens)")
+        if details:
+            st.caption(" / ".join(details))
 
         # フィードバックフォームを表示 (まだフィードバックされていない場合)
         if not st.session_state.feedback_given:
@@ -69,10 +137,32 @@ def display_chat_page(pipe):
                   st.session_state.current_question = ""
                   st.session_state.current_answer = ""
                   st.session_state.response_time = 0.0
+                  st.session_state.time_to_first_token = None
                   st.session_state.feedback_given = False
                   st.rerun() # 画面をクリア
 
 
+def display_conversation_controls():
+    """新しい会話の開始と過去の会話の再開"""
+    with st.expander("Conversation"):
+        if st.button("New conversation"):
+            st.session_state.conversation = Conversation()
+            st.session_state.current_question = ""
+            st.session_state.current_answer = ""
+            st.session_state.feedback_given = False
+            st.rerun()
+        sessions = get_chat_sessions()
+        if not sessions.empty:
+            options = {row.id: f"{row.updated_at} {row.title}" for row in sessions.itertuples()}
+            session_id = st.selectbox("Resume a conversation", list(options), format_func=options.get)
+            if st.button("Resume"):
+                st.session_state.conversation = Conversation(get_chat_messages(session_id), session_id=session_id)
+                st.session_state.current_question = ""
+                st.session_state.current_answer = ""
+                st.session_state.feedback_given = False
+                st.rerun()
+
+
 def display_feedback_form():
     """フィードバック入力フォームを表示する"""
     with st.form("feedback_form"):
@@ -121,23 +211,23 @@ def display_history_page():
     unsafe_allow_html=True
     )
     st.subheader("Chat History and Metrics")
-    history_df = get_chat_history()
 
-    if history_df.empty:
+    # 空かどうかは最新行のIDだけで判定する（COUNT(*) は全行を走査するため、再実行のたびには使わない）
+    latest_id = get_latest_history_id()
+    if latest_id is None:
         st.info("There are no chat history yet.")
         return
 
-    # タブでセクションを分ける
-    tab1, tab2 = st.tabs(["History", "Metrics Analysis"])
+    # セクションを切り替える（st.tabsは全タブを毎回描画するため、選択中のセクションだけを実行する）
+    section = st.radio("Section", ["History", "Metrics Analysis"], horizontal=True, label_visibility="collapsed", key="history_section")
 
-    with tab1:
-        display_history_list(history_df)
-
-    with tab2:
-        display_metrics_analysis(history_df)
+    if section == "History":
+        display_history_list(latest_id)
+    else:
+        display_metrics_analysis()
 
-def display_history_list(history_df):
-    """履歴リストを表示する"""
+def display_history_list(latest_id):
+    """履歴リストを表示する（latest_id は最新行のID。件数のキャッシュが古くなったかの判定に使う）"""
     st.write("#### History List")
     # 表示オプション
     filter_options = {
@@ -154,26 +244,40 @@ def display_history_list(history_df):
     )
 
     filter_value = filter_options[display_option]
-    if filter_value is not None:
-        # is_correctがNaNの場合を考慮
-        filtered_df = history_df[history_df["is_correct"].notna() & (history_df["is_correct"] == filter_value)]
-    else:
-        filtered_df = history_df
-
-    if filtered_df.empty:
+    # 件数はフィルターか履歴が変わったときだけ数え直し、ページ移動では再計算しない
+    pages = st.session_state.setdefault("history_pages", {})
+    page_key = (filter_value, latest_id)
+    if page_key not in pages:
+        pages[page_key] = {"total": count_chat_history(filter_value), "cursors": {}}
+        if len(pages) > 8:
+            # フィルターや履歴が変わった古い件数とカーソルは破棄する
+            for key in list(pages)[:-8]:
+                del pages[key]
+    total_items = pages[page_key]["total"]
+
+    if total_items == 0:
         st.info("No history matches the selected criteria.")
         return
 
-    # ページネーション
+    # ページネーション（表示するページ分だけをデータベースから取得する）
     items_per_page = 5
-    total_items = len(filtered_df)
     total_pages = (total_items + items_per_page - 1) // items_per_page
     current_page = st.number_input('Page', min_value=1, max_value=total_pages, value=1, step=1)
 
     start_idx = (current_page - 1) * items_per_page
     end_idx = start_idx + items_per_page
-    paginated_df = filtered_df.iloc[start_idx:end_idx]
 
+    # 各ページ先頭の直前の行 (timestamp, id) を覚えておき、前後のページ移動はキーセットで取得する
+    page_cursors = pages[page_key]["cursors"]
+    if current_page == 1:
+        paginated_df = get_chat_history_page(filter_value, limit=items_per_page)
+    elif current_page in page_cursors:
+        paginated_df = get_chat_history_page(filter_value, limit=items_per_page, after=page_cursors[current_page])
+    else:
+        paginated_df = get_chat_history_page(filter_value, limit=items_per_page, offset=start_idx)
+    if not paginated_df.empty:
+        last_row = paginated_df.iloc[-1]
+        page_cursors[current_page + 1] = (last_row['timestamp'], int(last_row['id']))
 
     for i, row in paginated_df.iterrows():
         with st.expander(f"{row['timestamp']} - Q: {row['question'][:50] if row['question'] else 'N/A'}..."):
@@ -188,19 +292,21 @@ def display_history_list(history_df):
             cols = st.columns(3)
             cols[0].metric("Accuracy Score", f"{row['is_correct']:.1f}")
             cols[1].metric("Response Time (seconds)", f"{row['response_time']:.2f}")
-            cols[2].metric("Word Count", f"{row['word_count']}")
+            cols[2].metric("Word Count", f"{int(row['word_count'])}" if pd.notna(row['word_count']) else "-")
 
             cols = st.columns(3)
             # NaNの場合はハイフン表示
             cols[0].metric("BLEU", f"{row['bleu_score']:.4f}" if pd.notna(row['bleu_score']) else "-")
             cols[1].metric("Similarity", f"{row['similarity_score']:.4f}" if pd.notna(row['similarity_score']) else "-")
             cols[2].metric("Relevance", f"{row['relevance_score']:.4f}" if pd.notna(row['relevance_score']) else "-")
+            if row.get('metrics_status') == 'pending':
+                st.caption("Metrics are being calculated in the background.")
     #英吾に変更
     st.caption(f" {start_idx+1} - {min(end_idx, total_items)} / {total_items}")
 
 
-def display_metrics_analysis(history_df):
-    """評価指標の分析結果を表示する"""
+def display_metrics_analysis():
+    """評価指標の分析結果を表示する（集計テーブルから取得するため、履歴の件数に関係なく描画時間は一定）"""
     # --- Footer and others (optional) ---
     st.markdown(
     """
@@ -215,28 +321,21 @@ def display_metrics_analysis(history_df):
     )
     st.write("#### analysis of evaluation metrics")
 
-    # is_correct が NaN のレコードを除外して分析
-    analysis_df = history_df.dropna(subset=['is_correct'])
-    if analysis_df.empty:
+    accuracy_counts = get_accuracy_counts()
+    if accuracy_counts.empty:
         st.warning("No evaluable data available.")
         return
 
-    accuracy_labels = {1.0: 'accurate', 0.5: 'partially accurate', 0.0: 'inaccurate'}
-    analysis_df['accuracy'] = analysis_df['is_correct'].map(accuracy_labels)
-
     # Accuracy distribution
     st.write("##### Accuracy Distribution")
-    accuracy_counts = analysis_df['accuracy'].value_counts()
-    if not accuracy_counts.empty:
-        st.bar_chart(accuracy_counts)
-    else:
-        st.info("No accuracy data available.")
+    st.bar_chart(accuracy_counts)
 
-    # Response time and other metrics relationship
+    # Response time and other metrics relationship（散布図は直近の行のみを使用）
     st.write("##### Response Time and Other Metrics Relationship")
+    recent_df = get_recent_metrics(limit=RECENT_POINTS)
     metric_options = ["bleu_score", "similarity_score", "relevance_score", "word_count"]
     # Include only available metrics in the options
-    valid_metric_options = [m for m in metric_options if m in analysis_df.columns and analysis_df[m].notna().any()]
+    valid_metric_options = [m for m in metric_options if m in recent_df.columns and recent_df[m].notna().any()]
 
     if valid_metric_options:
         metric_option = st.selectbox(
@@ -245,7 +344,7 @@ def display_metrics_analysis(history_df):
             key="metric_select"
         )
 
-        chart_data = analysis_df[['response_time', metric_option, 'accuracy']].dropna() # NaNを除外
+        chart_data = recent_df[['response_time', metric_option, 'accuracy']].dropna() # NaNを除外
         if not chart_data.empty:
              st.scatter_chart(
                 chart_data,
@@ -253,6 +352,7 @@ def display_metrics_analysis(history_df):
                 y=metric_option,
                 color='accuracy',
             )
+             st.caption(f"Showing the latest {len(recent_df)} records.")
         else:
             st.info(f"There are no valid data for the selected metric ({metric_option}) and response time.")
 
@@ -260,46 +360,29 @@ def display_metrics_analysis(history_df):
         st.info("There are no metric data available to compare with response time.")
 
 
-    # 全体の評価指標の統計
+    # 全体の評価指標の統計（パーセンタイルは近似値）
     st.write("##### Evaluation Metrics Statistics")
-    stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
-    valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
-    if valid_stats_cols:
-        metrics_stats = analysis_df[valid_stats_cols].describe()
+    metrics_stats = get_metrics_describe()
+    if not metrics_stats.empty:
         st.dataframe(metrics_stats)
+        st.caption("Percentiles are approximate (within 1%).")
     else:
         st.info("There is no metric data available to calculate statistics.")
 
     # Accuracy level average scores
     st.write("##### Average Scores by Accuracy Level")
-    if valid_stats_cols and 'accuracy' in analysis_df.columns:
-        try:
-            accuracy_groups = analysis_df.groupby('accuracy')[valid_stats_cols].mean()
-            st.dataframe(accuracy_groups)
-        except Exception as e:
-            st.warning(f"An error occurred while aggregating scores by accuracy: {e}")
+    accuracy_groups = get_accuracy_means()
+    if not accuracy_groups.empty:
+        st.dataframe(accuracy_groups)
     else:
          st.info("There is no data available to calculate average scores by accuracy level.")
 
 
     # カスタム評価指標：効率性スコア
     st.write("##### efficiency (accuracy) / (response time + 0.1)")  # Fixed typo in "response"
-    if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
-        # ゼロ除算を避けるために0.1を追加
-        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'].fillna(0) + 0.1)
-        # IDカラムが存在するか確認
-        if 'id' in analysis_df.columns:
-            # 上位10件を表示
-            top_efficiency = analysis_df.sort_values('efficiency_score', ascending=False).head(10)
-            # id をインデックスにする前に存在確認
-            if not top_efficiency.empty:
-                st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
-            else:
-                st.info("There are no efficiency score data available.")
-        else:
-            # IDがない場合は単純にスコアを表示
-             st.bar_chart(analysis_df.sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
-
+    top_efficiency = get_top_efficiency(limit=10)
+    if not top_efficiency.empty:
+        st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
     else:
         st.info("There is no data available to calculate efficiency scores.")
 
@@ -335,9 +418,55 @@ def display_data_page():
             if clear_db(): # clear_db内で確認と実行を行う
                 st.rerun() # クリア後に件数表示を更新
 
+    # 評価指標の再計算（未計算・失敗した行のバックフィル、または全件の再計算）
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Backfill missing metrics", key="backfill_metrics"):
+            scheduled = recompute_metrics(all_rows=False)
+            st.success(f"{scheduled} records were scheduled for metric calculation.")
+    with col2:
+        if st.button("Recompute all metrics", key="recompute_metrics"):
+            scheduled = recompute_metrics(all_rows=True)
+            st.success(f"{scheduled} records were scheduled for metric recalculation.")
+
+    # 過去の質問・回答データ（CSV / JSONL）の一括インポート
+    st.subheader("Import History")
+    st.caption("Columns: question, answer (required), feedback, correct_answer, is_correct, response_time, timestamp")
+    uploaded_file = st.file_uploader("CSV or JSONL file", type=["csv", "jsonl", "json"], key="history_import_file")
+    compute_now = st.checkbox("Calculate metrics during import (slower; otherwise they are calculated in the background)", key="import_compute_metrics")
+    if uploaded_file is not None and st.button("Import", key="import_history"):
+        if import_history_file(uploaded_file, compute_metrics=compute_now):
+            st.rerun() # 件数表示を更新
+
+    if st.button("Rebuild metric aggregates", key="rebuild_aggregates"):
+        rebuild_aggregates()
+        st.success("The metric aggregates have been rebuilt from the chat history.")
+
     # 評価指標に関する解説
     st.subheader("Evaluation Metrics Explanation")
     metrics_info = get_metrics_descriptions()
     for metric, description in metrics_info.items():
         with st.expander(f"{metric}"):
-            st.write(description)
\ No newline at end of file
+            st.write(description)
+# --- サイドバーのメトリクス表示 ---
+def display_telemetry_panel(metrics):
+    """生成のメトリクス（レイテンシ・TTFT・トークン数・エラー・キャッシュヒットなど）をサイドバーに表示する"""
+    snapshot = metrics.snapshot()
+
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+
+    with st.sidebar.expander("Telemetry"):
+        latency, ttft, tps = snapshot["latency"], snapshot["time_to_first_token"], snapshot["tokens_per_second"]
+        st.caption(f"Model: {snapshot['model_state']} / in flight: {snapshot['in_flight']}")
+        st.caption(f"Requests: {latency['count']} (mean {seconds(latency['mean'])}, p95 {seconds(latency['p95'])})")
+        st.caption(f"Time to first token: p50 {seconds(ttft['p50'])}, p95 {seconds(ttft['p95'])}")
+        mean_tps = f"{tps['mean']:.1f}" if tps["mean"] is not None else "-"
+        st.caption(f"Tokens/sec: mean {mean_tps}")
+        if snapshot["draft_acceptance_rate"] is not None:
+            st.caption(f"Speculative decoding: {snapshot['draft_acceptance_rate']:.0%} of draft tokens accepted")
+        st.caption(f"Tokens: {snapshot['prompt_tokens']} prompt / {snapshot['generated_tokens']} generated")
+        st.caption("Cache hits: " + (", ".join(f"{name} {hits}" for name, hits in snapshot["cache_hits"].items()) or "-"))
+        st.caption("Errors: " + (", ".join(f"{kind} {count}" for kind, count in snapshot["errors"].items()) or "none"))
+        if st.checkbox("Show Prometheus text", key="telemetry_raw"):
+            st.code(metrics.render(), language="text")
@@ -0,0 +1,161 @@
+# admission.py
+# 生成リクエストの受け付け制御（バックプレッシャー）
+# キューの上限・クライアントごとの同時実行数・トークンレート制限を超えたリクエストは、
+# 待たせずに即座に拒否する（APIは Retry-After 付きの429を返す）
+import math
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """受け付けを拒否したリクエスト"""
+
+    def __init__(self, detail, retry_after):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = max(1, int(math.ceil(retry_after)))  # Retry-After ヘッダーの秒数
+
+
+class DeadlineExceeded(Exception):
+    """リクエストの期限までに推論を開始できなかった"""
+
+
+class TokenBucket:
+    """トークンバケット: rate[トークン/秒]で補充され、最大 capacity まで貯まる"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount, allow_debt=False):
+        """
+        amount を消費できれば0を、できなければ消費できるまでの待ち時間[秒]を返す
+
+        バースト上限より大きいリクエストも、満タンなら受け付ける。そのとき allow_debt=False なら capacity 分だけ消費し、
+        True なら全量を消費して残量を負にする（超えた分が補充されるまで次のリクエストは受け付けない）。
+        """
+        self._refill()
+        required = min(amount, self.capacity)
+        if self.tokens < required:
+            return (required - self.tokens) / self.rate
+        self.tokens -= amount if allow_debt else required
+        return 0.0
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class Ticket:
+    """受け付けたリクエスト1件分（処理が終わったら release() に渡す）"""
+
+    def __init__(self, client_id, cost):
+        self.client_id = client_id
+        self.cost = cost
+        self.admitted_at = time.perf_counter()
+
+
+class AdmissionController:
+    """受け付け済みリクエスト数とクライアントごとの使用量を管理する"""
+
+    def __init__(self, max_queue=64, max_per_client=4, token_rate=0, token_burst=4096):
+        """
+        初期化
+
+        Args:
+            max_queue (int): 同時に受け付けるリクエストの上限（処理中 + 待機中、0なら無制限）
+            max_per_client (int): クライアントごとの同時リクエスト数の上限（0なら無制限）
+            token_rate (float): クライアントごとに1秒あたり要求できる生成トークン数（0なら無制限）
+            token_burst (int): トークンバケットの容量（一度に要求できるトークン数）
+        """
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.peak_client_in_flight = 0  # 1クライアントの同時実行数の最大値
+        self.client_in_flight = {}
+        self.buckets = {}
+        self.avg_service_time = 1.0  # 処理時間の指数移動平均（Retry-After の見積もりに使う）
+        self.counters = {"admitted": 0, "rejected_queue_full": 0, "rejected_client_concurrency": 0,
+                         "rejected_rate_limit": 0, "deadline_exceeded": 0}
+        self._lock = threading.Lock()
+
+    def admit(self, client_id, cost, allow_debt=False):
+        """
+        リクエストを受け付ける。上限を超える場合は待たずに AdmissionRejected を送出する
+
+        Args:
+            client_id (str): クライアントの識別子
+            cost (int): 要求する生成トークン数（レート制限に使う）
+            allow_debt (bool): バースト上限を超える cost も全量をトークンバケットから引く（複数件をまとめたリクエスト用）
+        """
+        with self._lock:
+            if self.max_queue and self.in_flight >= self.max_queue:
+                self.counters["rejected_queue_full"] += 1
+                # 1件あたりの処理時間から、空きが出るまでのおおよその時間を見積もる
+                raise AdmissionRejected("サーバーが混雑しています。後でもう一度お試しください。", self.avg_service_time)
+            client_count = self.client_in_flight.get(client_id, 0)
+            if self.max_per_client and client_count >= self.max_per_client:
+                self.counters["rejected_client_concurrency"] += 1
+                raise AdmissionRejected(
+                    f"同時に実行できるリクエストは{self.max_per_client}件までです。", self.avg_service_time
+                )
+            if self.token_rate:
+                bucket = self.buckets.get(client_id)
+                if bucket is None:
+                    if len(self.buckets) > 10000:
+                        # 満タンに戻ったバケットは新しく作り直すのと同じなので捨てる
+                        self.buckets = {k: b for k, b in self.buckets.items() if not b.is_full()}
+                    bucket = self.buckets[client_id] = TokenBucket(self.token_rate, self.token_burst)
+                wait = bucket.try_consume(cost, allow_debt)
+                if wait > 0:
+                    self.counters["rejected_rate_limit"] += 1
+                    raise AdmissionRejected(
+                        f"トークンのレート制限（{self.token_rate:g}トークン/秒）を超えました。", wait
+                    )
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.client_in_flight[client_id] = client_count + 1
+            self.peak_client_in_flight = max(self.peak_client_in_flight, client_count + 1)
+            self.counters["admitted"] += 1
+            return Ticket(client_id, cost)
+
+    def release(self, ticket):
+        """受け付けたリクエストの処理が終わったことを記録する"""
+        elapsed = time.perf_counter() - ticket.admitted_at
+        with self._lock:
+            self.in_flight -= 1
+            count = self.client_in_flight.get(ticket.client_id, 1) - 1
+            if count:
+                self.client_in_flight[ticket.client_id] = count
+            else:
+                self.client_in_flight.pop(ticket.client_id, None)
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * elapsed
+
+    def record_deadline_exceeded(self):
+        with self._lock:
+            self.counters["deadline_exceeded"] += 1
+
+    def stats(self):
+        """受け付け状況（/health 用）"""
+        with self._lock:
+            return dict(
+                self.counters,
+                in_flight=self.in_flight,
+                peak_in_flight=self.peak_in_flight,
+                peak_client_in_flight=self.peak_client_in_flight,
+                clients=len(self.client_in_flight),
+                max_queue=self.max_queue,
+                max_per_client=self.max_per_client,
+                token_rate=self.token_rate,
+                avg_service_time=round(self.avg_service_time, 3),
+            )
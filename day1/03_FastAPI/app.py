@@ -1,15 +1,33 @@
 import os
+import json
+import asyncio
+import threading
 import torch
-from transformers import pipeline
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 import time
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import uvicorn
 import nest_asyncio
 from pyngrok import ngrok
+import shared_path  # ../shared を sys.path に追加する
+from batching import MicroBatchScheduler
+from response_cache import ResponseCache, make_cache_key, should_use_cache
+from prefix_cache import PrefixKVCache
+from model_loader import BackgroundModelLoader, LOADING, FAILED
+from registry import ModelRegistry
+from workers import WorkerPool
+from precision import resolve_precision, precision_device, build_precision_pipeline
+from admission import AdmissionController, AdmissionRejected, DeadlineExceeded
+from telemetry import LLMMetrics
+from speculative import AcceptanceStats, load_draft, make_decoder
+import bucketing
 
 # --- 設定 ---
 # モデル名を設定
@@ -20,6 +38,51 @@ print(f"モデル名を設定: {MODEL_NAME}")
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # マイクロバッチ設定（環境変数で上書き可能）
+        self.BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+        self.BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "20"))
+        # 長さの違うバケットのプロンプトを同じバッチにまとめてよいパディング効率の下限（1.0ならバケットをまたがない）
+        self.BUCKET_MIN_EFFICIENCY = float(os.environ.get("BUCKET_MIN_EFFICIENCY", "0.5"))
+        # 応答キャッシュ設定（RESPONSE_CACHE_DB を指定するとディスク上のSQLiteにも保存）
+        self.RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+        self.RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+        self.RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB") or None
+        # システムプロンプトのキー/バリューを再利用するプレフィックスキャッシュのメモリ上限（0で無効）
+        self.PREFIX_CACHE_MAX_MB = float(os.environ.get("PREFIX_CACHE_MAX_MB", "256"))
+        # モデル読み込み中に届いたリクエストが読み込み完了を待つ最大秒数（超えたら503を返す）
+        self.MODEL_WAIT_TIMEOUT = float(os.environ.get("MODEL_WAIT_TIMEOUT", "10"))
+        # モデルの精度（環境変数 LLM_PRECISION）: bfloat16 / float32 / int8（Linear層の動的量子化、CPUのみ）
+        self.PRECISION = resolve_precision("bfloat16")
+        # 複数モデルの提供: MODELS="名前=モデルID,名前=モデルID"（MODEL_NAME は既定モデルとして常に登録）
+        self.MODELS = {model_name: model_name}
+        for item in filter(None, os.environ.get("MODELS", "").split(",")):
+            name, _, model_id = item.partition("=")
+            self.MODELS[name.strip()] = (model_id or name).strip()
+        # 読み込み済みモデルの合計メモリ上限（GB、0で無制限）。超えると使われていないモデルから解放する
+        self.MODEL_MEMORY_BUDGET_GB = float(os.environ.get("MODEL_MEMORY_BUDGET_GB", "0"))
+        # マルチプロセス提供: NUM_WORKERS > 0 なら既定モデルへの /generate をワーカープロセスで処理する
+        self.NUM_WORKERS = int(os.environ.get("NUM_WORKERS", "0"))
+        self.WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "0"))  # 0ならCPUコア数 / ワーカー数
+        self.WORKER_DTYPE = os.environ.get("WORKER_DTYPE", "auto")  # auto: 重みをメモリマップのまま共有する
+        # 受け付け制御: 同時に受け付けるリクエスト数（処理中 + 待機中）とクライアントごとの同時実行数（0で無制限）
+        self.MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "64"))
+        self.MAX_CONCURRENT_PER_CLIENT = int(os.environ.get("MAX_CONCURRENT_PER_CLIENT", "4"))
+        # クライアントごとの制限は接続元アドレス単位。X-Client-ID ヘッダーは呼び出し側が自由に変えられるため、
+        # 認証済みのプロキシがヘッダーを設定する構成でのみ 1 にして、ヘッダーの値を単位にする
+        self.TRUST_CLIENT_ID_HEADER = os.environ.get("TRUST_CLIENT_ID_HEADER", "0").strip().lower() in ("1", "true", "yes")
+        # クライアントごとのトークンレート制限（1秒あたりの max_new_tokens の合計、0で無制限）とバースト量
+        self.CLIENT_TOKEN_RATE = float(os.environ.get("CLIENT_TOKEN_RATE", "0"))
+        self.CLIENT_TOKEN_BURST = int(os.environ.get("CLIENT_TOKEN_BURST", "4096"))
+        # 1リクエストで指定できる max_new_tokens の上限
+        self.MAX_NEW_TOKENS_LIMIT = int(os.environ.get("MAX_NEW_TOKENS_LIMIT", "2048"))
+        # リクエストの期限（秒、0で無期限）。リクエストの timeout でこれより短くできる
+        self.REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "120"))
+        # /generate/batch: 1リクエストで送れるプロンプト数の上限
+        self.BATCH_MAX_PROMPTS = int(os.environ.get("BATCH_MAX_PROMPTS", "256"))
+        # 投機的デコーディング: 既定モデルと同じトークナイザーの小さなドラフトモデル（同じファミリー）を指定すると、
+        # ドラフトが提案したトークンを既定モデルが1回の推論でまとめて検証する（生成結果の分布は変わらない）
+        self.DRAFT_MODEL = os.environ.get("DRAFT_MODEL") or None
+        self.DRAFT_TOKENS = int(os.environ.get("DRAFT_TOKENS", "5"))  # 1ステップで提案させるトークン数の初期値
 
 config = Config(MODEL_NAME)
 
@@ -51,35 +114,122 @@ class SimpleGenerationRequest(BaseModel):
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    cache: Optional[bool] = False  # do_sample=True でも応答キャッシュを使う場合は True
+    system_prompt: Optional[str] = None  # プロンプトの前に付ける共通の指示（プレフィックスキャッシュで再利用）
+    model: Optional[str] = None  # 使用するモデル名（/models の一覧から選択、省略時は既定モデル）
+    timeout: Optional[float] = None  # この秒数を過ぎたら生成を打ち切る（サーバーの REQUEST_TIMEOUT が上限）
+    speculative: Optional[bool] = False  # True ならドラフトモデルで投機的デコーディング（DRAFT_MODEL 設定時のみ。バッチにはまとめない）
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    queue_time: Optional[float] = None    # バッチ待ちキューでの待ち時間
+    compute_time: Optional[float] = None  # バッチ推論にかかった時間
+    cached: Optional[bool] = False        # 応答キャッシュから返した場合は True
+    model: Optional[str] = None           # 応答を生成したモデル名
+    deadline_exceeded: Optional[bool] = False  # 期限で生成を打ち切った場合は True
+    tokens_per_second: Optional[float] = None  # 推論時間あたりの生成トークン数
+    speculative: Optional[Dict[str, Any]] = None  # 投機的デコーディングの統計（ドラフトトークンの採用率など）
+
+# /generate/batch の1件分（省略したサンプリングパラメータはリクエスト全体の値を使う）
+class BatchItem(BaseModel):
+    prompt: str
+    max_new_tokens: Optional[int] = None
+    do_sample: Optional[bool] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+
+class BatchGenerationRequest(BaseModel):
+    prompts: List[Union[str, BatchItem]]
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+    model: Optional[str] = None
+    timeout: Optional[float] = None
+    batch_size: Optional[int] = None  # サブバッチの大きさ（省略時は BATCH_MAX_SIZE）
+    stream: Optional[bool] = False    # True ならサブバッチが終わるごとに結果をNDJSONで返す
+
+class SwapRequest(BaseModel):
+    model_id: Optional[str] = None  # 新しい重みのモデルIDまたはパス（省略時は同じmodel_idを読み直す）
 
 # --- モデル関連の関数 ---
 # モデルのグローバル変数
 model = None
 
+def create_pipeline(model_id):
+    """推論用のパイプラインを作成する（モデルレジストリから呼ばれる）"""
+    print(f"使用デバイス: {precision_device(config.PRECISION)}, 精度: {config.PRECISION}")
+    pipe = build_precision_pipeline(model_id, config.PRECISION)
+    # バッチ推論用にパディングを設定（デコーダモデルは左詰めパディングが必要）
+    if pipe.tokenizer.pad_token is None:
+        pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    print(f"モデル '{model_id}' の読み込みに成功しました")
+    return pipe
+
 def load_model():
-    """推論用のLLMモデルを読み込む"""
+    """既定のLLMモデルをレジストリに読み込む"""
     global model  # グローバル変数を更新するために必要
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用デバイス: {device}")
-        pipe = pipeline(
-            "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
+        pipe = attach_draft_model(registry.load(config.MODEL_NAME).pipe)
         model = pipe  # グローバル変数を更新
         return pipe
     except Exception as e:
         error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
         print(error_msg)
-        traceback.print_exc()  # 詳細なエラー情報を出力
-        return None
+        raise  # 詳細なエラー情報は model_loader が出力し、/health の model_state に記録される
+
+# モデルはバックグラウンドスレッドで読み込み、読み込み中もサーバーは応答できるようにする
+model_loader = BackgroundModelLoader(load_model)
+
+async def wait_for_model():
+    """
+    モデルが使えるようになるまで最大 MODEL_WAIT_TIMEOUT 秒待つ
+
+    読み込みに失敗していた場合はバックグラウンドで再読み込みを開始する。
+    時間内に準備できなければ Retry-After 付きの503を送出する。
+    """
+    if model is not None:
+        return
+    if model_loader.state != LOADING:
+        load_model_task()
+    deadline = time.time() + config.MODEL_WAIT_TIMEOUT
+    while model is None and model_loader.state == LOADING and time.time() < deadline:
+        await asyncio.sleep(0.1)  # イベントループをブロックせずに待つ
+    if model is None:
+        if model_loader.state == FAILED:
+            detail = f"モデルの読み込みに失敗しました: {model_loader.error}"
+        else:
+            detail = "モデルを読み込み中です。後でもう一度お試しください。"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(model_loader.retry_after())})
+
+async def acquire_model(name=None):
+    """
+    リクエストで指定されたモデルをレジストリから借りる（使い終わったら registry.release() する）
+
+    既定モデルは読み込み完了を待ち、それ以外の未読み込みモデルはこの時点で読み込む。
+    """
+    name = name or config.MODEL_NAME
+    if name not in registry.models:
+        raise HTTPException(status_code=404, detail=f"モデル '{name}' は登録されていません。利用可能なモデル: {list(registry.models)}")
+    if name == config.MODEL_NAME and model is None:
+        print("モデルが読み込まれていません。読み込み完了を待ちます...")
+        await wait_for_model()
+    entry = registry.try_acquire(name)
+    while entry is None:
+        try:
+            # 読み込みには時間がかかるため、イベントループをブロックしないよう別スレッドで行う
+            await asyncio.get_running_loop().run_in_executor(None, registry.load, name)
+        except Exception as e:
+            traceback.print_exc()
+            raise HTTPException(
+                status_code=503,
+                detail=f"モデル '{name}' の読み込みに失敗しました: {e}",
+                headers={"Retry-After": str(model_loader.default_retry_after)},
+            )
+        entry = registry.try_acquire(name)  # 読み込み直後に追い出された場合は読み込み直す
+    return entry
 
 def extract_assistant_response(outputs, user_prompt):
     """モデルの出力からアシスタントの応答を抽出する"""
@@ -130,15 +280,314 @@ def extract_assistant_response(outputs, user_prompt):
 
     return assistant_response
 
+class IncrementalResponseExtractor:
+    """ストリーミング中のテキストに extract_assistant_response と同じ抽出処理を逐次適用する"""
+
+    def __init__(self, user_prompt):
+        self.user_prompt = user_prompt or ""
+        self.head = ""           # プロンプトのエコーかどうか判定できるまで保留するテキスト
+        self.head_done = not self.user_prompt
+        self.pending_space = ""  # 末尾の空白（strip相当のため、続く文字が来るまで送信しない）
+        self.started = False     # 先頭の空白を読み飛ばし終えたか
+        self.text = ""           # ここまでに送信したテキスト
+
+    def feed(self, chunk):
+        """新しく生成されたテキストを受け取り、クライアントに送るべき差分を返す"""
+        if not self.head_done:
+            self.head += chunk
+            stripped = self.head.lstrip()
+            if self.user_prompt.startswith(stripped):
+                return ""  # まだプロンプトのエコーの途中かもしれない
+            self.head_done = True
+            prompt_index = self.head.find(self.user_prompt)
+            chunk = self.head[prompt_index + len(self.user_prompt):] if prompt_index != -1 else self.head
+            self.head = ""
+        return self._emit(chunk)
+
+    def _emit(self, chunk):
+        if not self.started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return ""
+            self.started = True
+        body = chunk.rstrip()
+        if not body:
+            self.pending_space += chunk
+            return ""
+        delta = self.pending_space + body
+        self.pending_space = chunk[len(body):]
+        self.text += delta
+        return delta
+
+    def finish(self):
+        """生成完了時に最終的な応答テキストを返す"""
+        if not self.head_done and self.head:
+            # 出力がプロンプトの先頭部分と一致したまま終わった場合
+            self.head_done = True
+            self._emit(self.head)
+        if not self.text:
+            print("警告: ストリーミング応答を抽出できませんでした。")
+            return "応答を生成できませんでした。"
+        return self.text
+
+def format_sse(data, event=None):
+    """Server-Sent Events形式の1イベント分の文字列を作る"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class CancelledCriteria(StoppingCriteria):
+    """cancelled（threading.Event）がセットされたら生成を止める（クライアントが切断した場合など）"""
+
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    送信が終わったとき・クライアントが切断したときに必ず on_close() を呼ぶ StreamingResponse
+
+    本文のジェネレータの finally は、送信が始まる前に切断されると実行されない。
+    BackgroundTask も切断時（ClientDisconnect）には実行されないため、応答の送信処理自体を try/finally で囲む。
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+# --- 応答キャッシュ ---
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_SIZE,
+    ttl=config.RESPONSE_CACHE_TTL,
+    disk_path=config.RESPONSE_CACHE_DB,
+)
+
+# --- プレフィックスキャッシュ ---
+prefix_cache = PrefixKVCache(max_bytes=int(config.PREFIX_CACHE_MAX_MB * 1024 * 1024))
+
+def generate_with_system_prompt(pipe, prompt, system_prompt, streamer=None, **generation_kwargs):
+    """
+    system_prompt + prompt から生成する（推論スレッドで実行）
+
+    system_prompt 部分のキー/バリューはプレフィックスキャッシュから再利用し、
+    以降のトークンだけをエンコードする。
+
+    Returns:
+        list: パイプラインと同じ形式の出力（generated_text はプロンプト + 生成テキスト）
+    """
+    tokenizer = pipe.tokenizer
+    prefix_ids = tokenizer(system_prompt.rstrip() + "\n\n", return_tensors="pt")["input_ids"][0]
+    prompt_ids = tokenizer(prompt, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+    input_ids = torch.cat([prefix_ids, prompt_ids])
+    output_ids = prefix_cache.generate(
+        pipe.model, input_ids, prefix_length=len(prefix_ids), streamer=streamer, **generation_kwargs
+    )
+    generated_text = tokenizer.decode(output_ids[0, len(input_ids):], skip_special_tokens=True)
+    return [{"generated_text": prompt + generated_text}]
+
+# --- 投機的デコーディング ---
+# ドラフトモデルは1回だけ読み込み、既定モデルのパイプライン（スワップ後の新しい重みも）と組み合わせる
+speculative_stats = AcceptanceStats()
+draft_pipe = None
+draft_lock = threading.Lock()
+
+def attach_draft_model(pipe):
+    """
+    既定モデルのパイプラインにドラフトモデルを組み合わせ、pipe.speculative_decoder に設定する
+
+    DRAFT_MODEL が未設定なら何もしない。読み込めない・トークナイザーが異なる場合は、警告を出して通常のデコードのまま使う。
+    """
+    global draft_pipe
+    if not config.DRAFT_MODEL or get_speculative_decoder(pipe) is not None:
+        return pipe
+    try:
+        with draft_lock:
+            if draft_pipe is None:
+                print(f"ドラフトモデル '{config.DRAFT_MODEL}' を読み込み中...")
+                draft_pipe = load_draft(config.DRAFT_MODEL, config.PRECISION)
+        pipe.speculative_decoder = make_decoder(pipe, draft_pipe, config.DRAFT_TOKENS, speculative_stats)
+        print(f"ドラフトモデル '{config.DRAFT_MODEL}' で投機的デコーディングを行います")
+    except Exception as e:
+        print(f"ドラフトモデル '{config.DRAFT_MODEL}' は使用しません: {e}")
+        traceback.print_exc()
+    return pipe
+
+def get_speculative_decoder(pipe):
+    """パイプラインに組み合わせた SpeculativeDecoder（なければNone）"""
+    return getattr(pipe, "speculative_decoder", None)
+
+def generate_speculative(decoder, tokenizer, prompt, streamer=None, **generation_kwargs):
+    """
+    投機的デコーディングで1件生成する（推論スレッドで実行）
+
+    Returns:
+        tuple: (パイプラインと同じ形式の出力, このリクエストの統計)
+    """
+    input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+    output_ids, run = decoder.generate(input_ids, streamer=streamer, **generation_kwargs)
+    generated_text = tokenizer.decode(output_ids[0, len(input_ids):], skip_special_tokens=True)
+    return [{"generated_text": prompt + generated_text}], run
+
+def speculative_status():
+    """/health に出す投機的デコーディングの状態（DRAFT_MODEL 未設定ならNone）"""
+    if not config.DRAFT_MODEL:
+        return None
+    return {"draft_model": config.DRAFT_MODEL, "active": get_speculative_decoder(model) is not None,
+            **speculative_stats.stats()}
+
+# --- モデルレジストリ ---
+# 名前付きで複数のモデルを管理する（既定モデルはメモリ上限を超えても解放しない）
+registry = ModelRegistry(
+    create_pipeline,
+    config.MODELS,
+    memory_budget=int(config.MODEL_MEMORY_BUDGET_GB * 1024 ** 3),
+    pinned=[config.MODEL_NAME],
+    on_unload=lambda entry: prefix_cache.remove_model(entry.pipe.model),
+)
+
+# --- 受け付け制御 ---
+admission = AdmissionController(
+    max_queue=config.MAX_QUEUE_SIZE,
+    max_per_client=config.MAX_CONCURRENT_PER_CLIENT,
+    token_rate=config.CLIENT_TOKEN_RATE,
+    token_burst=config.CLIENT_TOKEN_BURST,
+)
+DEADLINE_GRACE = 1.0  # 期限で打ち切った生成の結果を待つ猶予（秒）
+
+def client_id_of(http_request):
+    """制限の単位となるクライアントID（接続元アドレス。TRUST_CLIENT_ID_HEADER なら X-Client-ID ヘッダーを優先）"""
+    if config.TRUST_CLIENT_ID_HEADER and http_request.headers.get("X-Client-ID"):
+        return "id:" + http_request.headers["X-Client-ID"]
+    return http_request.client.host if http_request.client else "unknown"
+
+def admit_request(request, http_request, cost=None):
+    """
+    リクエストを受け付けて (Ticket, 期限) を返す（処理が終わったら admission.release() する）
+
+    max_new_tokens が上限を超える場合は400を、混雑時やレート制限時は待たずに Retry-After 付きの429を送出する。
+    cost はレート制限で消費するトークン数（省略時は max_new_tokens）。cost を指定した場合（/generate/batch）は
+    バースト上限を超えても全量を消費し、超えた分が補充されるまでそのクライアントの次のリクエストを受け付けない。
+    期限は time.perf_counter() の値（期限なしならNone）。
+    """
+    if request.max_new_tokens is not None and request.max_new_tokens > config.MAX_NEW_TOKENS_LIMIT:
+        raise HTTPException(status_code=400, detail=f"max_new_tokens は {config.MAX_NEW_TOKENS_LIMIT} 以下にしてください。")
+    allow_debt = cost is not None
+    if cost is None:
+        cost = request.max_new_tokens or 0
+    try:
+        ticket = admission.admit(client_id_of(http_request), cost, allow_debt=allow_debt)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    timeouts = [t for t in (request.timeout, config.REQUEST_TIMEOUT) if t]
+    deadline = time.perf_counter() + min(timeouts) if timeouts else None
+    return ticket, deadline
+
+def remaining_time(deadline):
+    """期限までの残り秒数（期限なしならNone）。既に過ぎていれば DeadlineExceeded を送出する"""
+    if deadline is None:
+        return None
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        raise DeadlineExceeded("推論開始前に期限を過ぎました。")
+    return remaining
+
+# --- メトリクス ---
+# 記録は生成の完了時とエラー時のみ。キャッシュのヒット数や読み込み状態は /metrics の取得時に読む
+metrics = LLMMetrics()
+metrics.in_flight.set_function(lambda: admission.in_flight)
+metrics.track_cache_hits(lambda: {"response": response_cache.hits, "prefix": prefix_cache.hits})
+# バッチ推論（/generate のマイクロバッチと /generate/batch）のパディング量
+padding_stats = bucketing.PaddingStats()
+metrics.track_padding(padding_stats.stats)
+metrics.track_speculative(lambda: speculative_stats.stats() if config.DRAFT_MODEL else None)
+ERROR_TYPES = {400: "bad_request", 404: "not_found", 409: "conflict", 429: "rate_limited",
+               503: "unavailable", 504: "deadline_exceeded"}
+
+def count_tokens(pipe, text):
+    """テキストのトークン数（プロセス内にトークナイザーがなければNone）"""
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if tokenizer is None or not text:
+        return None
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+# --- ワーカープロセス ---
+worker_pool = None
+if config.NUM_WORKERS > 0:
+    worker_pool = WorkerPool(
+        config.MODEL_NAME,
+        config.NUM_WORKERS,
+        threads_per_worker=config.WORKER_THREADS,
+        dtype=config.WORKER_DTYPE,
+        max_batch_size=config.BATCH_MAX_SIZE,
+        min_padding_efficiency=config.BUCKET_MIN_EFFICIENCY,
+    )
+
+async def wait_for_workers():
+    """準備できたワーカーが出るまで最大 MODEL_WAIT_TIMEOUT 秒待ち、出なければ503を送出する"""
+    deadline = time.time() + config.MODEL_WAIT_TIMEOUT
+    while not worker_pool.ready_count() and worker_pool.starting_count() and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    if not worker_pool.ready_count():
+        if worker_pool.starting_count():
+            detail = "ワーカープロセスがモデルを読み込み中です。後でもう一度お試しください。"
+        else:
+            detail = "利用できるワーカープロセスがありません。"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(model_loader.default_retry_after)})
+
+def current_model_state():
+    """既定モデルの読み込み状態（ワーカーモードではワーカーの状態から判断する）"""
+    if worker_pool is None:
+        return model_loader.state
+    if worker_pool.ready_count():
+        return "ready"
+    return "loading" if worker_pool.starting_count() else "failed"
+
+metrics.track_model_state(current_model_state)
+
+# --- バッチスケジューラ ---
+scheduler = MicroBatchScheduler(
+    get_model=lambda: model,
+    max_batch_size=config.BATCH_MAX_SIZE,
+    max_wait_ms=config.BATCH_MAX_WAIT_MS,
+    min_padding_efficiency=config.BUCKET_MIN_EFFICIENCY,
+    padding_stats=padding_stats,
+)
+
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
+    """起動時にモデルの読み込みを開始（完了を待たずに接続を受け付ける）"""
+    if worker_pool is not None:
+        # ワーカーモードでは、プロセス内のモデルはストリーミングなどで必要になった時点で読み込む
+        worker_pool.start()
     else:
-        print("起動時にモデルの初期化が完了しました。")
+        load_model_task()
+    await scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時にバッチスケジューラとワーカープロセスを停止"""
+    await scheduler.stop()
+    if worker_pool is not None:
+        worker_pool.stop()
+
+@app.exception_handler(HTTPException)
+async def count_http_error(http_request: Request, exc: HTTPException):
+    """エラー応答を種類別に数えてから、通常どおりの応答を返す"""
+    metrics.record_error(ERROR_TYPES.get(exc.status_code, "internal" if exc.status_code >= 500 else "client_error"))
+    return await http_exception_handler(http_request, exc)
+
+@app.exception_handler(RequestValidationError)
+async def count_validation_error(http_request: Request, exc: RequestValidationError):
+    metrics.record_error("validation")
+    return await request_validation_exception_handler(http_request, exc)
 
 @app.get("/")
 async def root():
@@ -147,70 +596,532 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """ヘルスチェックエンドポイント"""
+    """ヘルスチェックエンドポイント（モデルの読み込み状態も返す）"""
     global model
+    if worker_pool is not None:
+        if worker_pool.ready_count():
+            status = "ok"
+        else:
+            status = "loading" if worker_pool.starting_count() else "error"
+        return {
+            "status": status,
+            "model": config.MODEL_NAME,
+            "workers": worker_pool.status(),
+            "model_state": model_loader.status(),
+            "cache": response_cache.stats(),
+            "prefix_cache": prefix_cache.stats(),
+            "models": registry.status(),
+            "admission": admission.stats(),
+            "speculative": speculative_status(),
+        }
+    if model is None:
+        if model_loader.state == LOADING:
+            return {"status": "loading", "message": "Model is loading", "model_state": model_loader.status(), "cache": response_cache.stats()}
+        return {"status": "error", "message": "No model loaded", "model_state": model_loader.status(), "cache": response_cache.stats()}
+
+    return {
+        "status": "ok",
+        "model": config.MODEL_NAME,
+        "model_state": model_loader.status(),
+        "cache": response_cache.stats(),
+        "prefix_cache": prefix_cache.stats(),
+        "models": registry.status(),
+        "admission": admission.stats(),
+        "speculative": speculative_status(),
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """レディネスチェック: モデルが使える場合のみ200、それ以外は Retry-After 付きの503"""
+    if worker_pool is not None:
+        if worker_pool.ready_count():
+            return {"status": "ready", "model": config.MODEL_NAME, "workers": worker_pool.ready_count()}
+        return JSONResponse(
+            status_code=503,
+            content={"status": "starting" if worker_pool.starting_count() else "failed", "workers": worker_pool.status()},
+            headers={"Retry-After": str(model_loader.default_retry_after)},
+        )
     if model is None:
-        return {"status": "error", "message": "No model loaded"}
+        return JSONResponse(
+            status_code=503,
+            content={"status": model_loader.state, "model_state": model_loader.status()},
+            headers={"Retry-After": str(model_loader.retry_after())},
+        )
+    return {"status": "ready", "model": config.MODEL_NAME}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus形式のメトリクス（レイテンシ・TTFT・キュー待ち・トークン数・エラー・キャッシュヒットなど）"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/models")
+async def list_models():
+    """登録されているモデルと読み込み状態の一覧"""
+    return {
+        "default": config.MODEL_NAME,
+        "memory_budget_gb": config.MODEL_MEMORY_BUDGET_GB,
+        "models": registry.status(),
+    }
+
+@app.post("/models/{name:path}/swap", status_code=202)  # モデル名は "org/model" 形式も可
+async def swap_model(name: str, request: SwapRequest, background_tasks: BackgroundTasks):
+    """
+    モデルを新しい重みにホットスワップする
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+    読み込みはバックグラウンドで行い、すぐに202を返す。読み込みが終わるまでは古い重みで応答し、
+    切り替え後の新しいリクエストは新しい重みで処理される（進捗は /models の swap で確認できる）。
+    """
+    if name not in registry.models:
+        raise HTTPException(status_code=404, detail=f"モデル '{name}' は登録されていません。")
+    if registry.swap_status.get(name, {}).get("state") == "loading":
+        raise HTTPException(status_code=409, detail=f"モデル '{name}' は切り替え中です。")
+    model_id = request.model_id or registry.models[name]
+    background_tasks.add_task(swap_model_task, name, model_id)
+    return {"status": "swapping", "model": name, "model_id": model_id}
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request):
     """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
+    ticket, deadline = admit_request(request, http_request)
+    try:
+        return await generate_until(request, deadline)
+    finally:
+        admission.release(ticket)
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+async def generate_until(request, deadline):
+    """/generate の本体（deadline を過ぎたら生成を打ち切る）"""
+    model_name = request.model or config.MODEL_NAME
+    # ワーカーモードでは既定モデルへの通常のリクエストをワーカープロセスに振り分ける
+    # （ワーカーはドラフトモデルを持たないため、speculative: true はプロセス内のモデルで処理）
+    use_workers = (worker_pool is not None and model_name == config.MODEL_NAME
+                   and not request.system_prompt and not request.speculative)
+    if use_workers:
+        await wait_for_workers()
+        entry = None
+    else:
+        entry = await acquire_model(model_name)
+    decoder = None
+    if entry is not None and not request.system_prompt and request.speculative:
+        decoder = get_speculative_decoder(entry.pipe)
 
     try:
         start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+        print(f"シンプルなリクエストを受信: model={model_name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
 
-        # プロンプトテキストで直接応答を生成
-        print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
+        generation_kwargs = dict(
             max_new_tokens=request.max_new_tokens,
             do_sample=request.do_sample,
             temperature=request.temperature,
             top_p=request.top_p,
         )
-        print("モデル推論が完了しました。")
+        # 同じプロンプト・パラメータの応答がキャッシュにあればそのまま返す
+        use_cache = should_use_cache(request.do_sample, request.cache)
+        cache_key_params = dict(generation_kwargs)
+        if request.system_prompt:
+            cache_key_params["system_prompt"] = request.system_prompt
+        cache_key = make_cache_key(request.prompt, registry.models[model_name], **cache_key_params)
+        if use_cache:
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                print("応答キャッシュにヒットしました。")
+                response_time = time.time() - start_time
+                metrics.record_generation(response_time, endpoint="generate")
+                return GenerationResponse(
+                    generated_text=cached_response,
+                    response_time=response_time,
+                    queue_time=0.0,
+                    compute_time=0.0,
+                    cached=True,
+                    model=model_name
+                )
+
+        print("モデル推論を開始...")
+        speculative = None
+        # キューで待ち続けている場合なども、期限を過ぎたら結果を待たずに打ち切る
+        wait_timeout = None if deadline is None else max(0.0, deadline - time.perf_counter()) + DEADLINE_GRACE
+        if use_workers:
+            # キューの深さが最も浅いワーカープロセスで推論する
+            outputs, queue_time, compute_time = await asyncio.wait_for(
+                worker_pool.submit(request.prompt, deadline=deadline, **generation_kwargs), wait_timeout
+            )
+        elif request.system_prompt:
+            # システムプロンプト付きはプレフィックスキャッシュを使うため、推論スレッドで1件ずつ実行する
+            loop = asyncio.get_running_loop()
+            enqueued_at = time.perf_counter()
+            started = []
+
+            def run_generation():
+                started.append(time.perf_counter())
+                kwargs = dict(generation_kwargs)
+                if deadline is not None:
+                    kwargs["max_time"] = remaining_time(deadline)
+                return generate_with_system_prompt(entry.pipe, request.prompt, request.system_prompt, **kwargs)
+
+            outputs = await asyncio.wait_for(loop.run_in_executor(scheduler.executor, run_generation), wait_timeout)
+            queue_time = started[0] - enqueued_at
+            compute_time = time.perf_counter() - started[0]
+        elif decoder is not None:
+            # 投機的デコーディングは1件ずつしか生成できないため、バッチにはまとめず推論スレッドで実行する
+            loop = asyncio.get_running_loop()
+            enqueued_at = time.perf_counter()
+            started = []
+
+            def run_speculative():
+                started.append(time.perf_counter())
+                kwargs = dict(generation_kwargs)
+                if deadline is not None:
+                    kwargs["max_time"] = remaining_time(deadline)
+                return generate_speculative(decoder, entry.pipe.tokenizer, request.prompt, **kwargs)
+
+            outputs, speculative = await asyncio.wait_for(
+                loop.run_in_executor(scheduler.executor, run_speculative), wait_timeout
+            )
+            queue_time = started[0] - enqueued_at
+            compute_time = time.perf_counter() - started[0]
+        else:
+            # 他の同時リクエストとまとめてバッチ推論する（イベントループはブロックしない）
+            outputs, queue_time, compute_time = await asyncio.wait_for(
+                scheduler.submit(request.prompt, model=entry.pipe, deadline=deadline, **generation_kwargs), wait_timeout
+            )
+        print(f"モデル推論が完了しました。(キュー待ち: {queue_time:.2f}秒, 推論: {compute_time:.2f}秒)")
 
         # アシスタント応答を抽出
         assistant_response = extract_assistant_response(outputs, request.prompt)
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        deadline_exceeded = deadline is not None and time.perf_counter() >= deadline
+        if deadline_exceeded:
+            admission.record_deadline_exceeded()
+        if use_cache and not deadline_exceeded and assistant_response not in ("応答を生成できませんでした。", "応答の抽出に失敗しました。"):
+            response_cache.set(cache_key, assistant_response)
 
         end_time = time.time()
         response_time = end_time - start_time
         print(f"応答生成時間: {response_time:.2f}秒")
+        # ワーカーモードではプロセス内にトークナイザーがないため、トークン数は記録しない
+        pipe = entry.pipe if entry is not None else None
+        prompt = f"{request.system_prompt.rstrip()}\n\n{request.prompt}" if request.system_prompt else request.prompt
+        generated_tokens = count_tokens(pipe, assistant_response)
+        metrics.record_generation(
+            response_time,
+            endpoint="generate",
+            prompt_tokens=count_tokens(pipe, prompt),
+            generated_tokens=generated_tokens,
+            compute_time=compute_time,
+            queue_wait=queue_time,
+        )
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            queue_time=queue_time,
+            compute_time=compute_time,
+            model=model_name,
+            deadline_exceeded=deadline_exceeded,
+            tokens_per_second=generated_tokens / compute_time if generated_tokens and compute_time else None,
+            speculative=speculative,
         )
 
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        admission.record_deadline_exceeded()
+        raise HTTPException(status_code=504, detail="期限までに応答を生成できませんでした。")
     except Exception as e:
         print(f"シンプル応答生成中にエラーが発生しました: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    finally:
+        # スワップ済みの古いモデルは、処理中のリクエストがすべて返却された時点で解放される
+        if entry is not None:
+            registry.release(entry)
+
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest, http_request: Request):
+    """生成されたトークンをServer-Sent Eventsで逐次返す"""
+    ticket, deadline = admit_request(request, http_request)
+    try:
+        entry = await acquire_model(request.model)
+    except Exception:
+        admission.release(ticket)
+        raise
+    pipe = entry.pipe
+
+    start_time = time.time()
+    print(f"ストリーミングリクエストを受信: model={entry.name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")
+    streamer = TextIteratorStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    generation_error = []
+    started = []
+    speculative = []
+    generation = []  # 推論スレッドでの生成（開始後のみ）
+    cancelled = threading.Event()  # クライアントが切断したら生成を止める
+    decoder = None
+    if not request.system_prompt and request.speculative:
+        decoder = get_speculative_decoder(pipe)
+
+    def run_generation():
+        """推論スレッドで実行する生成処理（トークンはstreamerに送られる）"""
+        started.append(time.time())
+        generation_kwargs = dict(
+            max_new_tokens=request.max_new_tokens,
+            do_sample=request.do_sample,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            stopping_criteria=StoppingCriteriaList([CancelledCriteria(cancelled)]),
+        )
+        try:
+            if deadline is not None:
+                generation_kwargs["max_time"] = remaining_time(deadline)
+            if request.system_prompt:
+                generate_with_system_prompt(pipe, request.prompt, request.system_prompt, streamer=streamer, **generation_kwargs)
+            elif decoder is not None:
+                speculative.append(generate_speculative(decoder, pipe.tokenizer, request.prompt, streamer=streamer, **generation_kwargs)[1])
+            else:
+                pipe(request.prompt, streamer=streamer, **generation_kwargs)
+        except Exception as e:
+            print(f"ストリーミング生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            generation_error.append(e)
+            metrics.record_error("generation")
+            streamer.end()  # 受信側のループを終了させる
+
+    async def event_stream():
+        loop = asyncio.get_running_loop()
+        # バッチ推論と同じ推論スレッドで実行し、モデルへの同時アクセスを避ける
+        generation.append(loop.run_in_executor(scheduler.executor, run_generation))
+        extractor = IncrementalResponseExtractor(request.prompt)
+        time_to_first_token = None
+        tokens = iter(streamer)
+        while True:
+            chunk = await loop.run_in_executor(None, next, tokens, None)
+            if chunk is None:
+                break
+            delta = extractor.feed(chunk)
+            if delta:
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                yield format_sse({"token": delta})
+        await generation[0]
+
+        if generation_error:
+            yield format_sse({"error": f"応答の生成中にエラーが発生しました: {generation_error[0]}"}, event="error")
+            return
+        response_time = time.time() - start_time
+        print(f"ストリーミング応答生成時間: {response_time:.2f}秒")
+        generated_text = extractor.finish()
+        prompt = f"{request.system_prompt.rstrip()}\n\n{request.prompt}" if request.system_prompt else request.prompt
+        generated_tokens = count_tokens(pipe, generated_text)
+        compute_time = time.time() - started[0]
+        metrics.record_generation(
+            response_time,
+            endpoint="generate_stream",
+            prompt_tokens=count_tokens(pipe, prompt),
+            generated_tokens=generated_tokens,
+            compute_time=compute_time,
+            queue_wait=started[0] - start_time,
+            time_to_first_token=time_to_first_token,
+        )
+        yield format_sse({
+            "generated_text": generated_text,
+            "response_time": response_time,
+            "time_to_first_token": time_to_first_token,
+            "model": entry.name,
+            "deadline_exceeded": deadline is not None and time.perf_counter() >= deadline,
+            "tokens_per_second": generated_tokens / compute_time if generated_tokens and compute_time else None,
+            "speculative": speculative[0] if speculative else None,
+        }, event="done")
+
+    def close():
+        """送信の完了・切断のどちらでも呼ばれる: 生成を止め、受け付け枠とモデルを返却する"""
+        cancelled.set()
+        admission.release(ticket)
+        if generation:
+            # 推論スレッドがモデルを使い終わってから返却する（スワップ済みのモデルが解放されるのはその後）
+            generation[0].add_done_callback(lambda _: registry.release(entry))
+        else:
+            registry.release(entry)
+
+    return ClosingStreamingResponse(event_stream(), close, media_type="text/event-stream")
+
+def batch_items(request):
+    """/generate/batch の各プロンプトを (プロンプト, 生成パラメータ) に展開する"""
+    items = []
+    for item in request.prompts:
+        if isinstance(item, str):
+            item = BatchItem(prompt=item)
+        generation_kwargs = {}
+        for field in ("max_new_tokens", "do_sample", "temperature", "top_p"):
+            value = getattr(item, field)
+            generation_kwargs[field] = value if value is not None else getattr(request, field)
+        items.append((item.prompt, generation_kwargs))
+    return items
+
+def plan_sub_batches(pipe, items, batch_size):
+    """
+    プロンプトを1回だけトークン化し、サンプリング条件ごとに長さの近いもの同士のサブバッチに分ける（推論スレッドで実行）
+
+    Returns:
+        tuple: (トークンIDのリスト（トークナイザーがなければNone）,
+                (入力の添字のリスト, 生成パラメータ) のリスト)
+    """
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if tokenizer is not None:
+        input_ids = bucketing.tokenize(tokenizer, [prompt for prompt, _ in items])
+        lengths = [len(ids) for ids in input_ids]
+    else:
+        input_ids, lengths = None, [len(prompt) for prompt, _ in items]
+    groups = {}
+    for index, (_, generation_kwargs) in enumerate(items):
+        groups.setdefault(tuple(sorted(generation_kwargs.items())), []).append(index)
+    sub_batches = []
+    for key, indices in groups.items():
+        plan = bucketing.plan_batches([lengths[i] for i in indices], batch_size, min_efficiency=config.BUCKET_MIN_EFFICIENCY)
+        sub_batches.extend(([indices[i] for i in batch], dict(key)) for batch in plan)
+    return input_ids, sub_batches
+
+async def run_batch_request(request, entry, deadline, start_time):
+    """
+    /generate/batch の本体: サブバッチを順に推論し、終わるごとにその結果（1件ずつのdictのリスト）をyieldする
+
+    推論は /generate と同じ推論スレッドで行い、期限を過ぎてから始まるサブバッチは推論しない。
+    """
+    items = batch_items(request)
+    batch_size = max(1, min(request.batch_size or config.BATCH_MAX_SIZE, len(items)))
+    loop = asyncio.get_running_loop()
+    pipe = entry.pipe
+    input_ids, sub_batches = await loop.run_in_executor(scheduler.executor, plan_sub_batches, pipe, items, batch_size)
+
+    def run_sub_batch(indices, prompts, generation_kwargs):
+        kwargs = dict(generation_kwargs)
+        if deadline is not None:
+            kwargs["max_time"] = remaining_time(deadline)
+        started_at = time.perf_counter()
+        if input_ids is None:
+            # トークナイザーのないパイプライン（load_test.py のスタブなど）はそのまま呼ぶ
+            outputs = pipe(prompts, batch_size=len(prompts), **kwargs)
+        else:
+            # トークン化済みのIDから生成し、パイプラインと同じ形式（プロンプト + 生成テキスト）にする
+            new_ids = bucketing.generate_from_ids(pipe.model, pipe.tokenizer, [input_ids[i] for i in indices], **kwargs)
+            padding_stats.record([len(input_ids[i]) for i in indices])
+            outputs = [[{"generated_text": prompt + pipe.tokenizer.decode(ids, skip_special_tokens=True)}]
+                       for prompt, ids in zip(prompts, new_ids)]
+        return outputs, started_at, time.perf_counter() - started_at
+
+    for batch_index, (indices, generation_kwargs) in enumerate(sub_batches):
+        prompts = [items[i][0] for i in indices]
+        prompt_tokens = [len(input_ids[i]) for i in indices] if input_ids is not None else None
+        try:
+            outputs, started_at, compute_time = await loop.run_in_executor(
+                scheduler.executor, run_sub_batch, indices, prompts, generation_kwargs
+            )
+        except DeadlineExceeded:
+            admission.record_deadline_exceeded()
+            yield [{"index": i, "error": "期限までに応答を生成できませんでした。", "deadline_exceeded": True} for i in indices]
+            continue
+        except Exception as e:
+            print(f"バッチ生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            metrics.record_error("generation")
+            yield [{"index": i, "error": f"応答の生成中にエラーが発生しました: {str(e)}"} for i in indices]
+            continue
+
+        finished_at = time.perf_counter()
+        deadline_exceeded = deadline is not None and finished_at >= deadline
+        if deadline_exceeded:
+            admission.record_deadline_exceeded()
+        results = []
+        for position, (index, prompt, output) in enumerate(zip(indices, prompts, outputs)):
+            generated_text = extract_assistant_response(output, prompt)
+            metrics.record_generation(
+                finished_at - start_time,
+                endpoint="generate_batch",
+                prompt_tokens=prompt_tokens[position] if prompt_tokens else None,
+                generated_tokens=count_tokens(pipe, generated_text),
+                compute_time=compute_time,
+                queue_wait=started_at - start_time,
+            )
+            results.append({
+                "index": index,
+                "generated_text": generated_text,
+                "response_time": finished_at - start_time,
+                "queue_time": started_at - start_time,
+                "compute_time": compute_time,
+                "batch_index": batch_index,
+                "batch_size": len(indices),
+                "padding_efficiency": bucketing.padding_efficiency(prompt_tokens) if prompt_tokens else None,
+                "deadline_exceeded": deadline_exceeded,
+            })
+        yield results
+
+@app.post("/generate/batch")
+async def generate_batch(request: BatchGenerationRequest, http_request: Request):
+    """
+    複数のプロンプトを長さ順のサブバッチにまとめて生成する
+
+    結果は入力と同じ順番で返す。stream=true なら、サブバッチが終わるごとにその結果を
+    1行1件のNDJSONで返し、最後に "done": true の行を返す（行の順番は完了順。index で入力と対応付ける）。
+    """
+    if not request.prompts:
+        raise HTTPException(status_code=400, detail="prompts を1件以上指定してください。")
+    if len(request.prompts) > config.BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"prompts は {config.BATCH_MAX_PROMPTS} 件以下にしてください。")
+    items = batch_items(request)
+    if any(kwargs["max_new_tokens"] is not None and kwargs["max_new_tokens"] > config.MAX_NEW_TOKENS_LIMIT for _, kwargs in items):
+        raise HTTPException(status_code=400, detail=f"max_new_tokens は {config.MAX_NEW_TOKENS_LIMIT} 以下にしてください。")
+    # 受け付け枠は1つ分、レート制限は全件の max_new_tokens の合計で数える
+    ticket, deadline = admit_request(request, http_request, cost=sum(kwargs["max_new_tokens"] or 0 for _, kwargs in items))
+    try:
+        entry = await acquire_model(request.model)
+    except Exception:
+        admission.release(ticket)
+        raise
+    start_time = time.perf_counter()
+    print(f"バッチリクエストを受信: model={entry.name}, prompts={len(items)}件")
+
+    if request.stream:
+        async def ndjson_stream():
+            async for results in run_batch_request(request, entry, deadline, start_time):
+                for result in results:
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "response_time": time.perf_counter() - start_time, "model": entry.name}) + "\n"
+
+        def close():
+            # 切断された場合、実行中のサブバッチは最後まで推論されるが、以降のサブバッチは推論しない
+            registry.release(entry)
+            admission.release(ticket)
+
+        return ClosingStreamingResponse(ndjson_stream(), close, media_type="application/x-ndjson")
+
+    try:
+        results = [None] * len(items)
+        async for batch_results in run_batch_request(request, entry, deadline, start_time):
+            for result in batch_results:
+                results[result["index"]] = result
+    finally:
+        registry.release(entry)
+        admission.release(ticket)
+    if all(result.get("deadline_exceeded") and "generated_text" not in result for result in results):
+        raise HTTPException(status_code=504, detail="期限までに応答を生成できませんでした。")
+    response_time = time.perf_counter() - start_time
+    print(f"バッチ応答生成時間: {response_time:.2f}秒 ({len(items)}件)")
+    return {"results": results, "response_time": response_time, "model": entry.name}
 
 def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
+    """モデルの読み込みをバックグラウンドスレッドで開始する（読み込み中・読み込み済みなら何もしない）"""
+    # load_model関数がスレッド上で実行され、成功するとグローバル変数 model が設定される
+    if model_loader.start():
+        print("load_model_task: バックグラウンドでモデルの読み込みを開始しました。")
+
+def swap_model_task(name, model_id):
+    """ホットスワップを実行する（バックグラウンドスレッド）"""
     global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+    try:
+        entry = registry.swap(name, model_id)
+    except Exception as e:
+        print(f"モデル '{name}' の切り替えに失敗しました: {e}")
+        traceback.print_exc()
+        return
+    if name == config.MODEL_NAME:
+        # 古いパイプラインへの参照を残さないよう、既定モデルの参照も新しいものに置き換える
+        model = model_loader.model = attach_draft_model(entry.pipe)
 
 print("FastAPIエンドポイントを定義しました。")
 
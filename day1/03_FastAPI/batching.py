@@ -0,0 +1,173 @@
+# batching.py
+# /generate へのリクエストを短い待ち時間の間に集約し、まとめてモデルに流すマイクロバッチスケジューラ
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import shared_path  # ../shared を sys.path に追加する
+import bucketing
+from admission import DeadlineExceeded
+
+
+class PendingRequest:
+    """キューで待機中の1件分のリクエスト"""
+
+    def __init__(self, prompt, generation_kwargs, future, model=None, deadline=None):
+        self.prompt = prompt
+        self.generation_kwargs = generation_kwargs
+        self.future = future
+        self.model = model  # 推論に使うパイプライン（Noneなら get_model() のモデル）
+        self.deadline = deadline  # 期限（time.perf_counter() の値、Noneなら無期限）
+        self.enqueued_at = time.perf_counter()
+
+    def batch_key(self):
+        """同じバッチにまとめられるかを判定するキー（モデルとサンプリング条件が同じものだけをまとめる）"""
+        return (id(self.model),) + tuple(sorted(self.generation_kwargs.items()))
+
+
+class MicroBatchScheduler:
+    """リクエストキューとバックグラウンドのバッチ処理ワーカー"""
+
+    def __init__(self, get_model, max_batch_size=8, max_wait_ms=20, min_padding_efficiency=0.5, padding_stats=None):
+        """
+        初期化
+
+        Args:
+            get_model (callable): 推論に使うパイプラインを返す関数（未ロードならNone）
+            max_batch_size (int): 1回のバッチに含める最大リクエスト数
+            max_wait_ms (float): 最初のリクエストが来てから後続を待つ最大時間（ミリ秒）
+            min_padding_efficiency (float): 長さの違うバケットを同じバッチにまとめてよいパディング効率の下限
+            padding_stats (bucketing.PaddingStats, optional): バッチのパディング量を記録する先
+        """
+        self.get_model = get_model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.min_padding_efficiency = min_padding_efficiency
+        self.padding_stats = padding_stats if padding_stats is not None else bucketing.PaddingStats()
+        self.queue = None
+        self.worker_task = None
+        # パイプラインはスレッドセーフではないため、推論は専用の1スレッドで直列に実行する
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-inference")
+
+    async def start(self):
+        """イベントループ上でワーカーを起動する"""
+        if self.worker_task is None:
+            self.queue = asyncio.Queue()
+            self.worker_task = asyncio.create_task(self._worker())
+            print(f"バッチスケジューラを起動しました (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000:.0f})")
+
+    async def stop(self):
+        """ワーカーを停止する"""
+        if self.worker_task is not None:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+            self.worker_task = None
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, prompt, model=None, deadline=None, **generation_kwargs):
+        """
+        リクエストをキューに積み、バッチ処理の完了を待つ
+
+        model を指定するとそのパイプラインで推論する（省略時は get_model() のモデル）。
+        deadline（time.perf_counter() の値）を過ぎても推論が始まらなければ DeadlineExceeded を送出し、
+        推論中に過ぎた場合はその時点で生成を打ち切る。
+
+        Returns:
+            tuple: (パイプラインの出力, キュー待ち時間[秒], 推論時間[秒])
+        """
+        if self.worker_task is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(PendingRequest(prompt, generation_kwargs, future, model, deadline))
+        return await future
+
+    async def _collect_batch(self):
+        """最初の1件を待ってから、待ち時間か最大バッチサイズに達するまで後続を集める"""
+        first = await self.queue.get()
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        """キューからバッチを取り出して推論を実行し続ける"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # モデルとサンプリング条件ごとにグループ化（到着順は保持）
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.batch_key(), []).append(request)
+
+            for group in groups.values():
+                # クライアントが切断済みのリクエストと、期限切れのリクエストは推論しない
+                now = time.perf_counter()
+                for request in group:
+                    if request.deadline is not None and request.deadline <= now and not request.future.done():
+                        request.future.set_exception(DeadlineExceeded("推論開始前に期限を過ぎました。"))
+                group = [r for r in group if not r.future.done()]
+                if not group:
+                    continue
+                try:
+                    # 結果はバッチが終わるごとに _run_batch から各リクエストに返される
+                    await loop.run_in_executor(self.executor, self._run_batch, group, loop)
+                except Exception as e:
+                    print(f"バッチ推論中にエラーが発生しました: {e}")
+                    traceback.print_exc()
+                    for request in group:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+
+    @staticmethod
+    def _resolve(requests, outputs, started_at, compute_time):
+        """推論が終わったリクエストに (出力, キュー待ち時間, 推論時間) を返す（イベントループ上で実行）"""
+        for request, output in zip(requests, outputs):
+            if not request.future.done():
+                request.future.set_result((output, started_at - request.enqueued_at, compute_time))
+
+    def _run_batch(self, group, loop):
+        """
+        同じモデル・サンプリング条件のリクエストを推論し、結果を返す（推論スレッドで実行）
+
+        プロンプトは1回だけトークン化し、長さの近いものごとのバッチに分けて、そのトークンIDから生成する
+        （短いプロンプトを長いプロンプトに合わせてパディングしない）。結果はバッチが終わるごとにそのリクエストへ返すため、
+        短いプロンプトのリクエストは長いプロンプトのバッチを待たず、推論時間も自分のバッチの分だけになる。
+        """
+        model = group[0].model or self.get_model()
+        if model is None:
+            raise RuntimeError("モデルが読み込まれていません。")
+        prompts = [r.prompt for r in group]
+        generation_kwargs = dict(group[0].generation_kwargs)
+        if all(r.deadline is not None for r in group):
+            # 最も遅い期限で生成を打ち切る（それより早い期限のリクエストは応答側で期限切れを判定する）
+            generation_kwargs["max_time"] = max(0.0, max(r.deadline for r in group) - time.perf_counter())
+        print(f"バッチ推論を開始: {len(prompts)}件")
+        tokenizer = getattr(model, "tokenizer", None)
+        if tokenizer is None:
+            # トークナイザーのないパイプライン（load_test.py のスタブなど）はそのまま呼ぶ
+            started_at = time.perf_counter()
+            outputs = model(prompts, batch_size=len(prompts), **generation_kwargs)
+            loop.call_soon_threadsafe(self._resolve, group, outputs, started_at, time.perf_counter() - started_at)
+            return
+
+        def on_batch(indices, texts, started_at, seconds):
+            # パイプラインと同じ形式（プロンプト + 生成テキスト）で返す
+            outputs = [[{"generated_text": prompts[i] + text}] for i, text in zip(indices, texts)]
+            loop.call_soon_threadsafe(self._resolve, [group[i] for i in indices], outputs, started_at, seconds)
+
+        bucketing.generate_bucketed(
+            model.model, tokenizer, bucketing.tokenize(tokenizer, prompts), len(prompts),
+            min_efficiency=self.min_padding_efficiency, padding_stats=self.padding_stats, on_batch=on_batch,
+            **generation_kwargs
+        )
@@ -0,0 +1,87 @@
+# benchmark_workers.py
+# ワーカープロセス数ごとのスループット（CPU）と、ワーカー全体のメモリ使用量を計測するベンチマーク
+# 使い方: python benchmark_workers.py --model google/gemma-2-2b-jpn-it --workers 1,2,4 --requests 32
+import argparse
+import asyncio
+import os
+import time
+
+from workers import WorkerPool
+
+# app.py の MODEL_NAME と同じ（app.py を読み込むとサーバー全体が初期化されるため直接指定）
+MODEL_NAME = "google/gemma-2-2b-jpn-it"
+
+PROMPTS = [
+    "Pythonのリスト内包表記について説明してください。",
+    "機械学習と深層学習の違いは何ですか？",
+    "HTTPのステータスコード503はどのような意味ですか？",
+    "日本の首都はどこですか？",
+    "大規模言語モデルの推論を高速化する方法を教えてください。",
+    "SQLiteのWALモードとは何ですか？",
+]
+
+
+def memory_mb(pid):
+    """プロセスのRSSとPSS（共有ページを共有プロセス数で割った値）[MB]。Linux以外ではNone"""
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        return None
+    values = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return values
+
+
+async def run(pool, num_requests, max_new_tokens):
+    """全リクエストを同時に投げ、完了までの時間を計測する"""
+    # 固定長の出力にして、ワーカー数ごとの処理量を揃える
+    kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+    # ウォームアップ（各ワーカーに1件ずつ）
+    await asyncio.gather(*(pool.submit(PROMPTS[0], **kwargs) for _ in range(pool.num_workers)))
+    start_time = time.perf_counter()
+    results = await asyncio.gather(
+        *(pool.submit(PROMPTS[i % len(PROMPTS)], **kwargs) for i in range(num_requests))
+    )
+    elapsed = time.perf_counter() - start_time
+    queue_time = sum(r[1] for r in results) / len(results)
+    return elapsed, queue_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ワーカープロセス数ごとのスループットを計測する")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--workers", default="1,2,4", help="試すワーカー数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=32, help="同時に投げるリクエスト数")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--threads-per-worker", type=int, default=0, help="0ならCPUコア数 / ワーカー数")
+    parser.add_argument("--dtype", default="auto", help="auto で重みをメモリマップのまま共有する")
+    parser.add_argument("--batch-size", type=int, default=8, help="ワーカーが1回にまとめる最大リクエスト数")
+    args = parser.parse_args()
+
+    print(f"モデル {args.model}, {args.requests}リクエスト x {args.max_new_tokens}トークン, CPUコア数 {os.cpu_count()}")
+    print(f"{'workers':>7s} {'threads':>7s} {'req/s':>8s} {'tokens/s':>9s} {'queue(s)':>9s} {'RSS合計(MB)':>12s} {'PSS合計(MB)':>12s}")
+    for num_workers in [int(n) for n in args.workers.split(",")]:
+        pool = WorkerPool(args.model, num_workers, args.threads_per_worker, args.dtype, args.batch_size)
+        pool.start()
+        while pool.starting_count():
+            time.sleep(0.2)
+        if not pool.ready_count():
+            print(f"{num_workers:7d} ワーカーの起動に失敗しました: {pool.status()}")
+            pool.stop()
+            continue
+        elapsed, queue_time = asyncio.run(run(pool, args.requests, args.max_new_tokens))
+        memory = [memory_mb(p.pid) for p in pool.processes]
+        rss = sum(m["Rss"] for m in memory) if all(memory) else float("nan")
+        pss = sum(m["Pss"] for m in memory) if all(memory) else float("nan")
+        print(
+            f"{num_workers:7d} {pool.threads_per_worker:7d} {args.requests / elapsed:8.2f} "
+            f"{args.requests * args.max_new_tokens / elapsed:9.1f} {queue_time:9.2f} {rss:12.0f} {pss:12.0f}"
+        )
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
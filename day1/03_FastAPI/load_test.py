@@ -0,0 +1,178 @@
+# load_test.py
+# 同時リクエストを送ってAPIサーバーのスループットとレイテンシを計測する簡易ロードテスト
+# 使い方: python load_test.py --url http://localhost:8501 --concurrency 8 --requests 32
+# --stub を付けると、モデルの代わりにスタブのパイプラインでサーバーをこのプロセス内に起動し、
+# 受け付け制御（キュー上限・クライアントごとの同時実行数・期限）の動作を確認する
+#   例: MAX_QUEUE_SIZE=8 MAX_CONCURRENT_PER_CLIENT=2 python load_test.py --stub --concurrency 32 --requests 128 --clients 4
+# --rotate-client-id を付けると、リクエストごとに別の X-Client-ID を送っても同時実行数の上限が増えないことを確認する
+#   例: MAX_CONCURRENT_PER_CLIENT=2 python load_test.py --stub --concurrency 16 --requests 64 --rotate-client-id
+
+import argparse
+import os
+import socket
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SAMPLE_PROMPTS = [
+    "AIについて100文字で教えてください",
+    "機械学習の過学習とは何ですか？",
+    "Pythonのリスト内包表記を説明してください",
+    "ブロックチェーンの仕組みを簡単に説明してください",
+]
+
+
+class _StubModel:
+    """レジストリがメモリ使用量を数えるためのダミー（パラメータなし）"""
+    name_or_path = "stub"
+
+    def parameters(self):
+        return []
+
+    def buffers(self):
+        return []
+
+
+class StubPipeline:
+    """モデルの代わりに、1トークンあたり一定時間スリープして応答を返すパイプライン（max_time で打ち切る）"""
+
+    def __init__(self, seconds_per_token):
+        self.seconds_per_token = seconds_per_token
+        self.model = _StubModel()
+        self.tokenizer = None
+
+    def __call__(self, prompts, max_new_tokens=16, max_time=None, batch_size=None, **kwargs):
+        single = isinstance(prompts, str)
+        duration = max_new_tokens * self.seconds_per_token
+        if max_time is not None:
+            duration = min(duration, max_time)
+        time.sleep(duration)
+        tokens = int(duration / self.seconds_per_token) if self.seconds_per_token else max_new_tokens
+        outputs = [[{"generated_text": f"{prompt} " + " ".join(["トークン"] * tokens)}]
+                   for prompt in ([prompts] if single else prompts)]
+        return outputs[0] if single else outputs
+
+
+def start_stub_server(seconds_per_token, trust_client_id=False):
+    """
+    スタブのパイプラインを使うAPIサーバーをこのプロセス内で起動し、URLを返す
+
+    trust_client_id なら X-Client-ID ヘッダーを制限の単位にする（認証済みのプロキシの後ろにある構成を模擬する）
+    """
+    import uvicorn
+    import app as api
+
+    api.config.TRUST_CLIENT_ID_HEADER = trust_client_id
+    api.registry.load_fn = lambda model_id: StubPipeline(seconds_per_token)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+    while not server.started or requests.get(f"{url}/ready").status_code != 200:
+        time.sleep(0.1)
+    return url, api
+
+
+def send_request(session, url, prompt, max_new_tokens, client_id=None, timeout=None):
+    """1件のリクエストを送信し、(ステータスコード, 応答JSON, 往復時間, Retry-After) を返す"""
+    payload = {"prompt": prompt, "max_new_tokens": max_new_tokens, "do_sample": False}
+    if timeout:
+        payload["timeout"] = timeout
+    headers = {"X-Client-ID": client_id} if client_id else {}
+    start_time = time.perf_counter()
+    response = session.post(f"{url}/generate", json=payload, headers=headers)
+    elapsed = time.perf_counter() - start_time
+    return response.status_code, response.json(), elapsed, response.headers.get("Retry-After")
+
+
+def client_id_for(i, clients=0, rotate=False):
+    """i 件目のリクエストで送る X-Client-ID（rotate ならリクエストごとに別の値）"""
+    if rotate:
+        return f"rotating-{i}"
+    return f"client-{i % clients}" if clients else None
+
+
+def run(url, concurrency, total_requests, max_new_tokens, clients=0, timeout=None, rotate=False):
+    """指定の並列度でリクエストを送り、集計結果を表示する"""
+    url = url.rstrip("/")
+    session = requests.Session()
+    # 応答キャッシュにヒットしないよう、プロンプトに連番を付ける
+    jobs = [
+        (f"{SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)]} ({i})", client_id_for(i, clients, rotate))
+        for i in range(total_requests)
+    ]
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda job: send_request(session, url, job[0], max_new_tokens, job[1], timeout), jobs
+        ))
+    wall_time = time.perf_counter() - start_time
+
+    statuses = Counter(status for status, _, _, _ in results)
+    succeeded = [(body, elapsed) for status, body, elapsed, _ in results if status == 200]
+    rejected = [(elapsed, retry_after) for status, _, elapsed, retry_after in results if status == 429]
+
+    print(f"リクエスト数: {total_requests}, 並列度: {concurrency}")
+    print(f"ステータス: {dict(sorted(statuses.items()))}")
+    print(f"スループット: {len(succeeded) / wall_time:.2f} req/s (成功分, 合計 {wall_time:.2f}秒)")
+    if succeeded:
+        latencies = sorted(elapsed for _, elapsed in succeeded)
+        print(f"レイテンシ: 平均 {statistics.mean(latencies):.2f}秒, "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0]:.2f}秒, 最大 {latencies[-1]:.2f}秒")
+        print(f"キュー待ち: 平均 {statistics.mean(body.get('queue_time') or 0.0 for body, _ in succeeded):.2f}秒")
+        print(f"推論時間: 平均 {statistics.mean(body.get('compute_time') or 0.0 for body, _ in succeeded):.2f}秒")
+        truncated = sum(1 for body, _ in succeeded if body.get("deadline_exceeded"))
+        if truncated:
+            print(f"期限で打ち切られた応答: {truncated}件")
+    if rejected:
+        print(f"429の応答時間: 最大 {max(elapsed for elapsed, _ in rejected) * 1000:.0f}ミリ秒, "
+              f"Retry-After: {sorted(set(r for _, r in rejected))}")
+    return statuses, rejected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLM APIの簡易ロードテスト")
+    parser.add_argument("--url", default="http://localhost:8501", help="APIのベースURL")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に送るリクエスト数")
+    parser.add_argument("--requests", type=int, default=32, help="送信するリクエストの総数")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="1リクエストあたりの生成トークン数")
+    parser.add_argument("--clients", type=int, default=0,
+                        help="X-Client-ID を変えて模擬するクライアント数（0なら指定しない。サーバーが TRUST_CLIENT_ID_HEADER の場合のみ有効）")
+    parser.add_argument("--rotate-client-id", action="store_true",
+                        help="リクエストごとに別の X-Client-ID を送る（--stub では上限を回避できないことを確認する）")
+    parser.add_argument("--timeout", type=float, default=None, help="リクエストごとの期限（秒）")
+    parser.add_argument("--stub", action="store_true", help="スタブのパイプラインでサーバーをこのプロセス内に起動する")
+    parser.add_argument("--seconds-per-token", type=float, default=0.002, help="スタブの1トークンあたりの生成時間")
+    args = parser.parse_args()
+
+    if not args.stub:
+        run(args.url, args.concurrency, args.requests, args.max_new_tokens, args.clients, args.timeout,
+            args.rotate_client_id)
+    else:
+        # --clients ではヘッダーを信頼するプロキシ構成を、--rotate-client-id では既定の構成を模擬する
+        url, api = start_stub_server(args.seconds_per_token, trust_client_id=bool(args.clients) and not args.rotate_client_id)
+        statuses, rejected = run(url, args.concurrency, args.requests, args.max_new_tokens, args.clients, args.timeout,
+                                 args.rotate_client_id)
+        stats = requests.get(f"{url}/health").json()["admission"]
+        print(f"受け付け状況: {stats}")
+        # 受け付け制御の確認
+        assert statuses.get(500, 0) == 0, "サーバーエラーが発生しました"
+        if stats["max_queue"]:
+            assert stats["peak_in_flight"] <= stats["max_queue"], "キューの上限を超えて受け付けました"
+        assert all(retry_after for _, retry_after in rejected), "429に Retry-After がありません"
+        assert stats["in_flight"] == 0, "処理が終わっていないリクエストが残っています"
+        if stats["max_per_client"]:
+            assert stats["peak_client_in_flight"] <= stats["max_per_client"], "クライアントごとの上限を超えて受け付けました"
+        if args.rotate_client_id:
+            # すべて同じ接続元から送っているので、ヘッダーを変えても1クライアントとして制限される
+            if stats["max_per_client"] and args.concurrency > stats["max_per_client"]:
+                assert stats["rejected_client_concurrency"] > 0, "X-Client-ID を変えると同時実行数の上限を回避できました"
+        print("OK: 受け付け制御は設定どおりに動作しました")
+        os._exit(0)  # サーバースレッドを待たずに終了する
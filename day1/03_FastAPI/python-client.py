@@ -1,87 +1,277 @@
 # python_client.py
 # このコードは、ngrokで公開されたAPIにアクセスするPythonクライアントの例です
+# AsyncLLMClient: httpx の非同期クライアント（接続プール・keep-alive）で、同時実行数を制限しつつ多数のプロンプトを送る
+# LLMClient: AsyncLLMClient をバックグラウンドのイベントループで動かす同期版（従来の呼び出し方のまま使える）
 
-import requests
-import json
+import asyncio
+import collections
+import random
+import threading
 import time
 
-class LLMClient:
-    """LLM API クライアントクラス"""
-    
-    def __init__(self, api_url):
+import httpx
+
+RETRY_STATUS_CODES = (429, 503)  # 混雑・モデル読み込み中なので、待って再送する
+
+
+class LLMAPIError(Exception):
+    """APIがエラーを返した"""
+
+    def __init__(self, status_code, text):
+        super().__init__(f"API error: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class AsyncLLMClient:
+    """LLM API の非同期クライアント"""
+
+    def __init__(self, api_url, max_concurrency=4, max_retries=5, backoff_base=0.5, backoff_max=30.0,
+                 timeout=300.0, client_id=None):
         """
         初期化
-        
+
         Args:
             api_url (str): API のベース URL（ngrok URL）
+            max_concurrency (int): 同時に送るリクエスト数の上限（接続プールの大きさも同じ）。
+                既定値はサーバーの MAX_CONCURRENT_PER_CLIENT の既定値（4）に合わせている。超えた分は429で再送になる
+            max_retries (int): 429/503 や接続エラーのときに再送する回数
+            backoff_base (float): 再送までの待ち時間の基準（秒）。回数ごとに2倍になり、ランダムに揺らす
+            backoff_max (float): 再送までの待ち時間の上限（秒）
+            timeout (float): 1リクエストのタイムアウト（秒）
+            client_id (str, optional): X-Client-ID ヘッダー（サーバーが TRUST_CLIENT_ID_HEADER の場合のみ制限の単位になる）
         """
         self.api_url = api_url.rstrip('/')
-        self.session = requests.Session()
-    
-    def health_check(self):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.client = httpx.AsyncClient(
+            base_url=self.api_url,
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+            timeout=timeout,
+            headers={"X-Client-ID": client_id} if client_id else None,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """接続プールを閉じる"""
+        await self.client.aclose()
+
+    async def health_check(self):
         """
         ヘルスチェック
-        
+
         Returns:
             dict: ヘルスチェック結果
         """
-        response = self.session.get(f"{self.api_url}/health")
+        response = await self.client.get("/health")
         return response.json()
-    
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """再送までの待ち時間（指数バックオフ + ジッター。Retry-After があればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            try:
+                # 同時に拒否されたリクエストが一斉に再送しないよう、Retry-After にも揺らぎを足す
+                delay = max(delay, float(retry_after) + random.uniform(0, self.backoff_base))
+            except ValueError:
+                pass
+        return delay
+
+    async def _post(self, path, payload):
+        """POSTして応答JSONを返す（429/503 と接続エラーは待ってから再送する）"""
+        for attempt in range(self.max_retries + 1):
+            # 待っている間は枠を空けるため、セマフォは送信中だけ確保する
+            async with self.semaphore:
+                try:
+                    response = await self.client.post(path, json=payload)
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+            if response is None:
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                await asyncio.sleep(self._retry_delay(attempt, response.headers.get("Retry-After")))
+                continue
+            if response.status_code != 200:
+                raise LLMAPIError(response.status_code, response.text)
+            return response.json()
+
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, **options):
         """
         テキスト生成
-        
+
         Args:
             prompt (str): プロンプト文字列
             max_new_tokens (int, optional): 生成する最大トークン数
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
-        
+            **options: その他のリクエストのフィールド（model, system_prompt, timeout, cache など）
+
         Returns:
-            dict: 生成結果
+            dict: 生成結果（total_request_time は再送の待ち時間を含む）
         """
         payload = {
             "prompt": prompt,
             "max_new_tokens": max_new_tokens,
             "temperature": temperature,
             "top_p": top_p,
-            "do_sample": do_sample
+            "do_sample": do_sample,
+            **options,
         }
-        
         start_time = time.time()
-        response = self.session.post(
-            f"{self.api_url}/generate",
-            json=payload
-        )
-        total_time = time.time() - start_time
-        
-        if response.status_code == 200:
-            result = response.json()
-            result["total_request_time"] = total_time
-            return result
-        else:
-            raise Exception(f"API error: {response.status_code} - {response.text}")
+        result = await self._post("/generate", payload)
+        result["total_request_time"] = time.time() - start_time
+        return result
+
+    async def generate_many(self, prompts, return_exceptions=False, **generation_kwargs):
+        """
+        多数のプロンプトを同時実行数の上限まで並行して送り、結果をプロンプトの順に返す非同期ジェネレータ
+
+        prompts はジェネレータでもよく、先読みするのは同時実行数の2倍までなので、
+        数千件でもメモリを使い切らずに、結果を受け取りながら処理できる。
+
+        Args:
+            prompts (iterable): プロンプト文字列の列
+            return_exceptions (bool): True なら失敗したプロンプトは例外オブジェクトを返す（False なら送出する）
+            **generation_kwargs: generate() に渡す生成パラメータ
+
+        Yields:
+            dict: 生成結果（プロンプトと同じ順番）
+        """
+        async def run(prompt):
+            try:
+                return await self.generate(prompt, **generation_kwargs)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        window = self.max_concurrency * 2
+        pending = collections.deque()
+        try:
+            for prompt in prompts:
+                pending.append(asyncio.ensure_future(run(prompt)))
+                if len(pending) >= window:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # 途中でやめた場合や失敗した場合は、残りのリクエストを取り消す
+            for task in pending:
+                task.cancel()
+
+
+class LLMClient:
+    """LLM API クライアントクラス（AsyncLLMClient の同期版）"""
+
+    def __init__(self, api_url, **client_options):
+        """
+        初期化
+
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            **client_options: AsyncLLMClient に渡すオプション（max_concurrency, max_retries など）
+        """
+        self.api_url = api_url.rstrip('/')
+        # 非同期クライアントはバックグラウンドスレッドのイベントループで動かす
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True)
+        self._thread.start()
+        self._client = self._run(self._create_client(api_url, client_options))
+
+    @staticmethod
+    async def _create_client(api_url, client_options):
+        return AsyncLLMClient(api_url, **client_options)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """接続プールとイベントループを閉じる"""
+        if self._loop.is_closed():
+            return
+        self._run(self._client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def health_check(self):
+        """
+        ヘルスチェック
+
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        return self._run(self._client.health_check())
+
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, **options):
+        """
+        テキスト生成（引数は AsyncLLMClient.generate と同じ）
+
+        Returns:
+            dict: 生成結果
+        """
+        return self._run(self._client.generate(prompt, max_new_tokens, temperature, top_p, do_sample, **options))
+
+    def generate_many(self, prompts, return_exceptions=False, **generation_kwargs):
+        """
+        多数のプロンプトを並行して送り、結果をプロンプトの順に返すジェネレータ（AsyncLLMClient.generate_many の同期版）
+
+        Yields:
+            dict: 生成結果（プロンプトと同じ順番）
+        """
+        results = self._client.generate_many(prompts, return_exceptions=return_exceptions, **generation_kwargs)
+        try:
+            while True:
+                try:
+                    yield self._run(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(results.aclose())
 
 # 使用例
 if __name__ == "__main__":
     # ngrok URLを設定（実際のURLに置き換えてください）
     NGROK_URL = "https://your-ngrok-url.ngrok.url"
-    
+
     # クライアントの初期化
     client = LLMClient(NGROK_URL)
-    
+
     # ヘルスチェック
     print("Health check:")
     print(client.health_check())
     print()
-    
+
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+
+    # 複数の質問（並行して送り、質問の順に結果を受け取る）
+    print("Multiple questions:")
+    questions = ["機械学習とは何ですか？", "Pythonの特徴を教えてください", "ディープラーニングを簡単に説明してください"]
+    for question, result in zip(questions, client.generate_many(questions, max_new_tokens=128)):
+        print(f"{question} -> {result['generated_text'][:50]}... ({result['total_request_time']:.2f}s)")
+
+    client.close()
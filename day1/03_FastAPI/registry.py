@@ -0,0 +1,221 @@
+# registry.py
+# 名前付きで複数のモデル（パイプライン）を読み込んで管理するレジストリ
+# メモリ上限を超える場合は使われていないモデルをLRUで解放し、ホットスワップでは
+# 新しいリクエストを新しい重みに回しつつ、処理中のリクエストは古い重みで完了させる
+import gc
+import threading
+import time
+import traceback
+
+import torch
+
+
+def pipeline_nbytes(pipe):
+    """パイプラインのモデルが保持するパラメータとバッファのバイト数"""
+    tensors = list(pipe.model.parameters()) + list(pipe.model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelEntry:
+    """読み込み済みのモデル1つ分"""
+
+    def __init__(self, name, model_id, pipe, nbytes, version):
+        self.name = name
+        self.model_id = model_id
+        self.pipe = pipe
+        self.nbytes = nbytes
+        self.version = version     # 同じ名前で何回目に読み込まれたか（ホットスワップで増える）
+        self.refcount = 0          # このモデルで処理中のリクエスト数
+        self.last_used = time.time()
+        self.loaded_at = time.time()
+        self.retired = False       # スワップ済み・解放待ち（処理中のリクエストが終わると解放）
+
+
+class ModelRegistry:
+    """名前 → モデルの対応を管理し、参照カウント付きで貸し出す"""
+
+    def __init__(self, load_fn, models, memory_budget=0, pinned=(), on_unload=None):
+        """
+        初期化
+
+        Args:
+            load_fn (callable): model_id を受け取りパイプラインを返す関数
+            models (dict): 名前 → model_id（Hugging FaceのモデルIDまたはローカルパス）
+            memory_budget (int): 読み込み済みモデルの合計バイト数の上限（0なら無制限）
+            pinned (iterable): メモリ上限を超えても解放しないモデル名
+            on_unload (callable): モデル解放時に ModelEntry を受け取って呼ばれる関数
+        """
+        self.load_fn = load_fn
+        self.models = dict(models)
+        self.memory_budget = memory_budget
+        self.pinned = set(pinned)
+        self.on_unload = on_unload
+        self._active = {}          # 名前 → ModelEntry
+        self._retired = []         # スワップで置き換えられ、まだ使用中の ModelEntry
+        self._loading = {}         # 名前 → 読み込み完了を知らせる threading.Event
+        self._versions = {}
+        self._known_sizes = {}     # model_id → 前回読み込んだときのバイト数（事前の追い出しに使う）
+        self.swap_status = {}      # 名前 → 最後のスワップの状態
+        self._lock = threading.Lock()
+
+    def _check_name(self, name):
+        if name not in self.models:
+            raise KeyError(f"未登録のモデルです: {name}")
+
+    def acquire(self, name):
+        """
+        モデルを貸し出す（未読み込みならこのスレッドで読み込むため、ブロックする）
+
+        使い終わったら必ず release() を呼ぶ。
+        """
+        self._check_name(name)
+        while True:
+            with self._lock:
+                entry = self._active.get(name)
+                if entry is not None:
+                    entry.refcount += 1
+                    entry.last_used = time.time()
+                    return entry
+                event = self._loading.get(name)
+                if event is None:
+                    event = self._loading[name] = threading.Event()
+                    break
+            event.wait()  # 他のスレッドが読み込み中なので完了を待って再試行する
+        try:
+            entry = self._load_entry(name, self.models[name])
+            with self._lock:
+                entry.refcount += 1
+                self._active[name] = entry
+            return entry
+        finally:
+            with self._lock:
+                del self._loading[name]
+            event.set()
+
+    def try_acquire(self, name):
+        """読み込み済みの場合だけモデルを貸し出す（ブロックしない）。未読み込みならNone"""
+        self._check_name(name)
+        with self._lock:
+            entry = self._active.get(name)
+            if entry is not None:
+                entry.refcount += 1
+                entry.last_used = time.time()
+            return entry
+
+    def release(self, entry):
+        """acquire() で借りたモデルを返す"""
+        with self._lock:
+            entry.refcount -= 1
+            entry.last_used = time.time()
+            unload = entry.retired and entry.refcount == 0
+            if unload:
+                self._retired.remove(entry)
+        if unload:
+            self._unload(entry)
+
+    def load(self, name):
+        """モデルを読み込んでおく（読み込み済みなら何もしない）"""
+        self.release(self.acquire(name))
+        return self._active.get(name)
+
+    def swap(self, name, model_id=None):
+        """
+        モデルを新しい重みに入れ替える（ゼロダウンタイム）
+
+        新しいモデルを読み込み終えてから切り替えるため、その間のリクエストは古いモデルで処理される。
+        切り替え後の新しいリクエストは新しいモデルに送られ、処理中のリクエストが
+        すべて終わった時点で古いモデルを解放する。
+        """
+        self._check_name(name)
+        model_id = model_id or self.models[name]
+        self.swap_status[name] = {"state": "loading", "model_id": model_id, "error": None}
+        try:
+            new_entry = self._load_entry(name, model_id)
+        except Exception as e:
+            self.swap_status[name] = {"state": "failed", "model_id": model_id, "error": str(e)}
+            raise
+        unload = None
+        with self._lock:
+            old_entry = self._active.get(name)
+            self._active[name] = new_entry
+            self.models[name] = model_id
+            if old_entry is not None:
+                old_entry.retired = True
+                if old_entry.refcount == 0:
+                    unload = old_entry
+                else:
+                    self._retired.append(old_entry)
+        if unload is not None:
+            self._unload(unload)
+        self.swap_status[name] = {"state": "done", "model_id": model_id, "error": None}
+        print(f"モデル '{name}' を '{model_id}' (version {new_entry.version}) に切り替えました")
+        return new_entry
+
+    def _load_entry(self, name, model_id):
+        """モデルを読み込み、必要ならメモリ上限に収まるよう他のモデルを解放する"""
+        # 前回のサイズが分かっていれば、読み込む前に空きを作る
+        self._evict_for(self._known_sizes.get(model_id, 0), keep=name)
+        print(f"モデル '{name}' ({model_id}) を読み込み中...")
+        pipe = self.load_fn(model_id)
+        nbytes = pipeline_nbytes(pipe)
+        self._known_sizes[model_id] = nbytes
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            entry = ModelEntry(name, model_id, pipe, nbytes, self._versions[name])
+        self._evict_for(nbytes, keep=name)
+        return entry
+
+    def _evict_for(self, incoming, keep):
+        """合計サイズ + incoming が上限を超える間、使われていないモデルを最終使用が古い順に解放する"""
+        if not self.memory_budget:
+            return
+        evicted = []
+        with self._lock:
+            total = sum(e.nbytes for e in self._active.values()) + sum(e.nbytes for e in self._retired)
+            candidates = sorted(
+                (e for e in self._active.values()
+                 if e.refcount == 0 and e.name != keep and e.name not in self.pinned),
+                key=lambda e: e.last_used,
+            )
+            for entry in candidates:
+                if total + incoming <= self.memory_budget:
+                    break
+                del self._active[entry.name]
+                total -= entry.nbytes
+                evicted.append(entry)
+        for entry in evicted:
+            print(f"メモリ上限のため、使われていないモデル '{entry.name}' を解放します")
+            self._unload(entry)
+
+    def _unload(self, entry):
+        try:
+            if self.on_unload is not None:
+                self.on_unload(entry)
+        except Exception:
+            traceback.print_exc()
+        entry.pipe = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def status(self):
+        """各モデルの読み込み状態"""
+        with self._lock:
+            result = {}
+            for name, model_id in self.models.items():
+                entry = self._active.get(name)
+                info = {"model_id": model_id, "loaded": entry is not None, "loading": name in self._loading}
+                if entry is not None:
+                    info.update(
+                        version=entry.version,
+                        memory_mb=round(entry.nbytes / 1024 / 1024, 1),
+                        in_flight=entry.refcount,
+                        idle_seconds=round(time.time() - entry.last_used, 1),
+                    )
+                retiring = [e.refcount for e in self._retired if e.name == name]
+                if retiring:
+                    info["retiring_in_flight"] = sum(retiring)
+                if name in self.swap_status:
+                    info["swap"] = self.swap_status[name]
+                result[name] = info
+            return result
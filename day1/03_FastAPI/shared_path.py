@@ -0,0 +1,10 @@
+# shared_path.py
+# 02_streamlit_app と共通のモジュール（response_cache, prefix_cache, model_loader, precision, telemetry,
+# bucketing, speculative）は ../shared に1つだけ置く。このモジュールを import するとそのディレクトリが
+# sys.path に追加されるので、それらを使うモジュールは先にこれを import する
+import os
+import sys
+
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shared")
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
@@ -0,0 +1,306 @@
+# workers.py
+# 複数のワーカープロセスでモデルを動かし、キューの深さが最も浅いワーカーにリクエストを振り分ける
+# 重みは safetensors をメモリマップして読み込むため、型変換しなければ全ワーカーが同じページを共有する
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import shared_path  # ../shared を sys.path に追加する
+import bucketing
+from admission import DeadlineExceeded
+
+# ワーカーの状態
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+STOPPED = "stopped"
+
+
+def load_worker_pipeline(model_id, dtype="auto"):
+    """
+    ワーカー用のパイプラインを作成する（CPU）
+
+    dtype="auto" ならチェックポイントの精度のまま読み込むので、safetensors のメモリマップが
+    そのままパラメータになり、ページキャッシュを全ワーカーで共有できる。
+    "bfloat16" などに変換したり "int8"（動的量子化）にすると各ワーカーが重みのコピーを持つ。
+    """
+    import torch
+    from transformers import pipeline
+
+    if dtype == "int8":
+        from precision import build_precision_pipeline
+        pipe = build_precision_pipeline(model_id, "int8")
+    else:
+        torch_dtype = dtype if dtype == "auto" else getattr(torch, dtype)
+        pipe = pipeline(
+            "text-generation",
+            model=model_id,
+            model_kwargs={"torch_dtype": torch_dtype, "use_safetensors": True},
+            device="cpu",
+        )
+    # バッチ推論用にパディングを設定（デコーダモデルは左詰めパディングが必要）
+    if pipe.tokenizer.pad_token is None:
+        pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    return pipe
+
+
+def _worker_main(worker_id, model_id, dtype, num_threads, max_batch_size, min_padding_efficiency, requests, results):
+    """ワーカープロセスの本体: リクエストを受け取り、溜まっている分は長さの近いものごとにまとめて推論する"""
+    import torch
+
+    torch.set_num_threads(num_threads)
+    try:
+        pipe = load_worker_pipeline(model_id, dtype)
+    except Exception as e:
+        traceback.print_exc()
+        results.put(("failed", worker_id, None, str(e)))
+        return
+    results.put(("ready", worker_id, None, None))
+
+    running = True
+    while running:
+        item = requests.get()
+        if item is None:
+            break
+        batch = [item]
+        # 既にキューに溜まっているリクエストは待たずに同じバッチにまとめる
+        while len(batch) < max_batch_size:
+            try:
+                item = requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+
+        groups = {}
+        for item in batch:
+            groups.setdefault(tuple(sorted(item[2].items())), []).append(item)
+        for group in groups.values():
+            started_at = time.time()
+            # 期限切れのリクエストは推論しない
+            for request_id, _, _, deadline in group:
+                if deadline is not None and deadline <= started_at:
+                    results.put(("expired", worker_id, request_id, None))
+            group = [item for item in group if item[3] is None or item[3] > started_at]
+            if not group:
+                continue
+            generation_kwargs = dict(group[0][2])
+            if all(item[3] is not None for item in group):
+                generation_kwargs["max_time"] = max(item[3] for item in group) - started_at
+
+            def on_batch(indices, texts, _, seconds):
+                # 長さ別のバッチが終わるごとに返し、短いプロンプトが長いプロンプトのバッチを待たないようにする
+                batch_started_at = time.time() - seconds
+                for i, text in zip(indices, texts):
+                    # パイプラインと同じ形式（プロンプト + 生成テキスト）で返す
+                    output = [{"generated_text": group[i][1] + text}]
+                    results.put(("done", worker_id, group[i][0], (output, batch_started_at, seconds)))
+
+            try:
+                prompts = [item[1] for item in group]
+                bucketing.generate_bucketed(
+                    pipe.model, pipe.tokenizer, bucketing.tokenize(pipe.tokenizer, prompts), len(prompts),
+                    min_efficiency=min_padding_efficiency, on_batch=on_batch, **generation_kwargs
+                )
+            except Exception as e:
+                traceback.print_exc()
+                # 結果を返し済みのリクエストへのエラーは受信側で無視される
+                for item in group:
+                    results.put(("error", worker_id, item[0], str(e)))
+
+
+class WorkerPool:
+    """ワーカープロセス群と、キューの深さで負荷を分散するディスパッチャ"""
+
+    def __init__(self, model_id, num_workers, threads_per_worker=0, dtype="auto", max_batch_size=8,
+                 min_padding_efficiency=0.5):
+        """
+        初期化
+
+        Args:
+            model_id (str): 各ワーカーが読み込むモデルIDまたはパス
+            num_workers (int): ワーカープロセス数
+            threads_per_worker (int): 各ワーカーのtorchスレッド数（0ならCPUコア数をワーカー数で割った値）
+            dtype (str): 読み込む精度（"auto" でチェックポイントのまま。重みのページを共有できる）
+            max_batch_size (int): ワーカーが1回にまとめて推論する最大リクエスト数
+            min_padding_efficiency (float): 長さの違うバケットを同じバッチにまとめてよいパディング効率の下限
+        """
+        self.model_id = model_id
+        self.num_workers = max(1, int(num_workers))
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.dtype = dtype
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.min_padding_efficiency = min_padding_efficiency
+        self.processes = []
+        self.request_queues = []
+        self.results = None
+        self.states = []
+        self.errors = []
+        self.depths = []      # ワーカーごとの処理中・待機中のリクエスト数
+        self.completed = []
+        self._pending = {}    # request_id → (future, loop, worker_id, 投入時刻)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._collector = None
+
+    def start(self):
+        """ワーカープロセスを起動する（モデルの読み込み完了は待たない）"""
+        if self.processes:
+            return
+        # torchのスレッドを持つ親プロセスからforkすると固まることがあるため spawn を使う
+        ctx = multiprocessing.get_context("spawn")
+        self.results = ctx.Queue()
+        for worker_id in range(self.num_workers):
+            requests = ctx.Queue()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(worker_id, self.model_id, self.dtype, self.threads_per_worker,
+                      self.max_batch_size, self.min_padding_efficiency, requests, self.results),
+                name=f"llm-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+            self.request_queues.append(requests)
+            self.states.append(STARTING)
+            self.errors.append(None)
+            self.depths.append(0)
+            self.completed.append(0)
+        self._collector = threading.Thread(target=self._collect, name="worker-results", daemon=True)
+        self._collector.start()
+        print(f"ワーカープロセスを{self.num_workers}個起動しました (各{self.threads_per_worker}スレッド, dtype={self.dtype})")
+
+    def stop(self):
+        """ワーカープロセスを停止する"""
+        for worker_id, requests in enumerate(self.request_queues):
+            if self.states[worker_id] in (STARTING, READY):
+                requests.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        with self._lock:
+            self.states = [STOPPED] * len(self.states)
+            pending, self._pending = self._pending, {}
+        for future, loop, _, _ in pending.values():
+            self._resolve(future, loop, RuntimeError("ワーカープロセスが停止しました。"))
+
+    def ready_count(self):
+        return self.states.count(READY)
+
+    def starting_count(self):
+        return self.states.count(STARTING)
+
+    async def submit(self, prompt, deadline=None, **generation_kwargs):
+        """
+        キューの深さが最も浅いワーカーにリクエストを送り、完了を待つ
+
+        deadline（time.perf_counter() の値）を過ぎても推論が始まらなければ DeadlineExceeded を送出し、
+        推論中に過ぎた場合はその時点で生成を打ち切る。
+
+        Returns:
+            tuple: (パイプラインの出力, キュー待ち時間[秒], 推論時間[秒])
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            ready = [i for i, state in enumerate(self.states) if state == READY]
+            if not ready:
+                raise RuntimeError("準備できているワーカープロセスがありません。")
+            # 深さが同じなら完了数が少ないワーカーを選び、順番に使われるようにする
+            worker_id = min(ready, key=lambda i: (self.depths[i], self.completed[i]))
+            self.depths[worker_id] += 1
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = (future, loop, worker_id, time.time())
+        # プロセスをまたぐため、期限は時刻（time.time()）に直して渡す
+        wall_deadline = None if deadline is None else time.time() + (deadline - time.perf_counter())
+        self.request_queues[worker_id].put((request_id, prompt, generation_kwargs, wall_deadline))
+        return await future
+
+    def _collect(self):
+        """ワーカーからの結果を受け取り、待っているリクエストに返す（バックグラウンドスレッド）"""
+        while True:
+            try:
+                kind, worker_id, request_id, payload = self.results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                if self.states and all(state == STOPPED for state in self.states):
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            if kind == "ready":
+                self.states[worker_id] = READY
+                print(f"ワーカー {worker_id} の準備ができました")
+                continue
+            if kind == "failed":
+                self.states[worker_id] = FAILED
+                self.errors[worker_id] = payload
+                print(f"ワーカー {worker_id} のモデル読み込みに失敗しました: {payload}")
+                continue
+            with self._lock:
+                entry = self._pending.pop(request_id, None)
+                if entry is not None:
+                    # 見つからない場合は _check_workers / stop で処理済みで、深さもそこでリセットされている
+                    self.depths[worker_id] = max(0, self.depths[worker_id] - 1)
+                    self.completed[worker_id] += 1
+            if entry is None:
+                continue
+            future, loop, _, enqueued_at = entry
+            if kind == "done":
+                output, started_at, compute_time = payload
+                self._resolve(future, loop, (output, max(0.0, started_at - enqueued_at), compute_time))
+            elif kind == "expired":
+                self._resolve(future, loop, DeadlineExceeded("推論開始前に期限を過ぎました。"))
+            else:
+                self._resolve(future, loop, RuntimeError(payload))
+
+    def _check_workers(self):
+        """異常終了したワーカーを検出し、そのワーカーで待っていたリクエストを失敗させる"""
+        for worker_id, process in enumerate(self.processes):
+            if self.states[worker_id] in (STARTING, READY) and not process.is_alive():
+                self.states[worker_id] = FAILED
+                self.errors[worker_id] = f"ワーカープロセスが終了しました (exitcode={process.exitcode})"
+                print(f"ワーカー {worker_id}: {self.errors[worker_id]}")
+                with self._lock:
+                    lost = [rid for rid, entry in self._pending.items() if entry[2] == worker_id]
+                    entries = [self._pending.pop(rid) for rid in lost]
+                    self.depths[worker_id] = 0
+                for future, loop, _, _ in entries:
+                    self._resolve(future, loop, RuntimeError(self.errors[worker_id]))
+
+    @staticmethod
+    def _resolve(future, loop, result):
+        def set_result():
+            if future.done():
+                return  # クライアントが切断済み
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        try:
+            loop.call_soon_threadsafe(set_result)
+        except RuntimeError:
+            pass  # イベントループが終了済み
+
+    def status(self):
+        """ワーカーごとの状態"""
+        return [
+            {
+                "pid": process.pid,
+                "state": self.states[worker_id],
+                "queue_depth": self.depths[worker_id],
+                "completed": self.completed[worker_id],
+                "threads": self.threads_per_worker,
+                "error": self.errors[worker_id],
+            }
+            for worker_id, process in enumerate(self.processes)
+        ]
@@ -0,0 +1,154 @@
+# bucketing.py
+# Length-bucketed batching for generation. Prompts are tokenized once, grouped into buckets of
+# similar token length and generated from those token IDs (the pipeline would tokenize them again),
+# so a short prompt is never padded to the length of a long one in the same batch.
+import threading
+import time
+
+import torch
+
+# Upper bounds (in tokens) of the length buckets; longer prompts share the last, open-ended bucket
+DEFAULT_BOUNDARIES = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def tokenize(tokenizer, prompts):
+    """Token IDs of each prompt, encoded the way the text-generation pipeline would.
+
+    A prompt is a string or a chat (list of message dicts), which gets the chat template
+    with the generation prompt appended.
+    """
+    ids = [None] * len(prompts)
+    texts = [i for i, prompt in enumerate(prompts) if isinstance(prompt, str)]
+    if texts:
+        # One call for all plain prompts: fast tokenizers encode the batch in parallel
+        for i, input_ids in zip(texts, tokenizer([prompts[i] for i in texts])["input_ids"]):
+            ids[i] = list(input_ids)
+    for i, prompt in enumerate(prompts):
+        if ids[i] is None:
+            ids[i] = list(tokenizer.apply_chat_template(
+                prompt, add_generation_prompt=True, return_dict=True
+            )["input_ids"])
+    return ids
+
+
+def bucket_of(length, boundaries=DEFAULT_BOUNDARIES):
+    """Index of the bucket a prompt of `length` tokens falls into"""
+    for i, bound in enumerate(boundaries):
+        if length <= bound:
+            return i
+    return len(boundaries)
+
+
+def plan_batches(lengths, max_batch_size, boundaries=DEFAULT_BOUNDARIES, min_efficiency=None):
+    """Split prompt indices into batches of at most max_batch_size from the same length bucket.
+
+    Within a bucket prompts are sorted by length, so neighbours in a batch differ as little as
+    possible. Each batch is a separate generate() call, so with min_efficiency a partly filled
+    batch is merged into the previous one as long as the merged batch keeps at least that share
+    of real tokens, and prompts that fit one batch with at least that share are not split at all.
+    Returns a list of index lists, shortest bucket first.
+    """
+    if (min_efficiency is not None and 0 < len(lengths) <= max_batch_size
+            and padding_efficiency(lengths) >= min_efficiency):
+        return [sorted(range(len(lengths)), key=lambda i: lengths[i])]
+    buckets = {}
+    for i, length in enumerate(lengths):
+        buckets.setdefault(bucket_of(length, boundaries), []).append(i)
+    batches = []
+    for bucket in sorted(buckets):
+        indices = sorted(buckets[bucket], key=lambda i: lengths[i])
+        for start in range(0, len(indices), max_batch_size):
+            batches.append(indices[start:start + max_batch_size])
+    if min_efficiency is not None:
+        merged = []
+        for batch in batches:
+            if (merged and len(merged[-1]) + len(batch) <= max_batch_size
+                    and padding_efficiency([lengths[i] for i in merged[-1] + batch]) >= min_efficiency):
+                merged[-1] = merged[-1] + batch
+            else:
+                merged.append(batch)
+        batches = merged
+    return batches
+
+
+def padding_efficiency(lengths):
+    """Share of a padded batch that is real tokens (1.0 = no padding)"""
+    return sum(lengths) / (len(lengths) * max(lengths)) if lengths else 1.0
+
+
+class PaddingStats:
+    """Running totals of real and padded prompt tokens over generated batches"""
+
+    def __init__(self):
+        self.batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0  # Pad positions only
+        self._lock = threading.Lock()
+
+    def record(self, lengths):
+        with self._lock:
+            self.batches += 1
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += len(lengths) * max(lengths) - sum(lengths)
+
+    def efficiency(self):
+        total = self.real_tokens + self.padded_tokens
+        return self.real_tokens / total if total else 1.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "real_tokens": self.real_tokens,
+                "padded_tokens": self.padded_tokens,
+                "efficiency": self.efficiency(),
+            }
+
+
+def generate_from_ids(model, tokenizer, batch_ids, **generation_kwargs):
+    """Generate for a batch of token ID lists (left-padded) and return the new token IDs of each row"""
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(len(ids) for ids in batch_ids)
+    input_ids = torch.full((len(batch_ids), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_ids), width), dtype=torch.long)
+    for row, ids in enumerate(batch_ids):
+        # Decoder-only models continue from the last position, so padding goes on the left
+        input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, width - len(ids):] = 1
+    with torch.no_grad():
+        output_ids = model.generate(
+            input_ids.to(model.device), attention_mask=attention_mask.to(model.device),
+            pad_token_id=pad_token_id, **generation_kwargs,
+        )
+    return [row[width:].tolist() for row in output_ids]
+
+
+def generate_bucketed(model, tokenizer, input_ids, max_batch_size, boundaries=DEFAULT_BOUNDARIES,
+                      min_efficiency=None, padding_stats=None, on_batch=None, **generation_kwargs):
+    """Generate for every prompt in length-bucketed batches.
+
+    input_ids are the prompts' token IDs from tokenize(). A max_time in generation_kwargs is
+    the budget for all batches together. on_batch(indices, texts, started_at, seconds) is called
+    as soon as each batch finishes, so callers can hand out its results before the later batches run.
+    Returns (text, seconds) per prompt in input order, where seconds is the time of the batch
+    the prompt was generated in.
+    """
+    lengths = [len(ids) for ids in input_ids]
+    results = [None] * len(input_ids)
+    max_time = generation_kwargs.pop("max_time", None)
+    start_time = time.perf_counter()
+    for batch in plan_batches(lengths, max_batch_size, boundaries, min_efficiency):
+        kwargs = dict(generation_kwargs)
+        if max_time is not None:
+            kwargs["max_time"] = max(0.0, max_time - (time.perf_counter() - start_time))
+        batch_start = time.perf_counter()
+        new_ids = generate_from_ids(model, tokenizer, [input_ids[i] for i in batch], **kwargs)
+        seconds = time.perf_counter() - batch_start
+        if padding_stats is not None:
+            padding_stats.record([lengths[i] for i in batch])
+        texts = [tokenizer.decode(ids, skip_special_tokens=True) for ids in new_ids]
+        for i, text in zip(batch, texts):
+            results[i] = (text, seconds)
+        if on_batch is not None:
+            on_batch(batch, texts, batch_start, seconds)
+    return results
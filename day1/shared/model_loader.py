@@ -0,0 +1,84 @@
+# model_loader.py
+# Load the model on a background thread so the app can serve requests (health checks, the UI)
+# while the weights are still loading.
+import threading
+import time
+import traceback
+
+# Loader states
+NOT_STARTED = "not_started"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class BackgroundModelLoader:
+    """Runs load_fn() on a background thread and reports its state.
+
+    load_fn returns the loaded model, or raises / returns None on failure. A failed
+    load can be started again with start().
+    """
+
+    def __init__(self, load_fn, default_retry_after=5):
+        self.load_fn = load_fn
+        self.default_retry_after = default_retry_after
+        self.state = NOT_STARTED
+        self.model = None
+        self.error = None
+        self.started_at = None
+        self.load_time = None  # Seconds the last successful load took
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start loading unless a load is already running or finished; returns True if a load was started"""
+        with self._lock:
+            if self.state in (LOADING, READY):
+                return False
+            self.state = LOADING
+            self.error = None
+            self.started_at = time.time()
+            self._ready.clear()
+        threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+        return True
+
+    def _load(self):
+        try:
+            model = self.load_fn()
+            if model is None:
+                raise RuntimeError("load function returned no model")
+        except Exception as e:
+            traceback.print_exc()
+            with self._lock:
+                self.state = FAILED
+                self.error = str(e)
+        else:
+            with self._lock:
+                self.model = model
+                self.load_time = time.time() - self.started_at
+                self.state = READY
+        finally:
+            self._ready.set()
+
+    def wait(self, timeout=None):
+        """Block until the running load finishes (or timeout seconds pass); returns the model or None"""
+        if self.state == LOADING:
+            self._ready.wait(timeout)
+        return self.model
+
+    def retry_after(self):
+        """Seconds a client should wait before retrying while the model is not ready"""
+        if self.state == LOADING and self.load_time:
+            elapsed = time.time() - self.started_at
+            return max(1, int(self.load_time - elapsed + 1))
+        return self.default_retry_after
+
+    def status(self):
+        """State, error and timing information for health checks"""
+        elapsed = time.time() - self.started_at if self.started_at and self.state == LOADING else None
+        return {
+            "state": self.state,
+            "error": self.error,
+            "loading_seconds": elapsed,
+            "load_time": self.load_time,
+        }
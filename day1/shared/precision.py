@@ -0,0 +1,60 @@
+# precision.py
+# Precision modes for loading the model: bfloat16, float32, or float32 weights with the Linear layers
+# dynamically quantized to int8 (CPU only), which is usually the fastest option on CPUs without bfloat16 support.
+# The mode comes from config (PRECISION) and can be overridden with the LLM_PRECISION environment variable.
+import os
+
+import torch
+
+PRECISIONS = ("bfloat16", "float32", "int8")
+
+
+def check_precision(precision):
+    """Raise ValueError unless precision is one of PRECISIONS, so a typo never loads float32 silently"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}'; expected one of {', '.join(PRECISIONS)}")
+    return precision
+
+
+def resolve_precision(default="bfloat16"):
+    """Precision mode from the LLM_PRECISION environment variable, falling back to default"""
+    return check_precision(os.environ.get("LLM_PRECISION", default).strip().lower())
+
+
+def precision_device(precision):
+    """Device to load the model on; dynamically quantized int8 kernels only exist for CPU"""
+    if precision == "int8" or not torch.cuda.is_available():
+        return "cpu"
+    return "cuda"
+
+
+def precision_model_kwargs(precision):
+    """model_kwargs for transformers.pipeline; int8 loads float32 weights and quantizes them afterwards"""
+    check_precision(precision)
+    return {"torch_dtype": torch.bfloat16 if precision == "bfloat16" else torch.float32}
+
+
+def apply_precision(pipe, precision):
+    """Quantize the Linear layers of the pipeline's model to int8 in place when precision is int8"""
+    if precision == "int8":
+        try:
+            from torch.ao.quantization import quantize_dynamic
+        except ImportError as e:
+            raise RuntimeError("This torch build has no dynamic quantization; use float32 or bfloat16") from e
+        pipe.model.eval()
+        quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return pipe
+
+
+def build_precision_pipeline(model_name, precision):
+    """Create a text-generation pipeline in the given precision mode"""
+    from transformers import pipeline
+
+    check_precision(precision)
+    pipe = pipeline(
+        "text-generation",
+        model=model_name,
+        model_kwargs=precision_model_kwargs(precision),
+        device=precision_device(precision),
+    )
+    return apply_precision(pipe, precision)
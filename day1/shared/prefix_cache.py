@@ -0,0 +1,223 @@
+# prefix_cache.py
+# Reuse of attention key/values for prompt prefixes shared between requests, such as the chat template
+# header and system instructions, so only the tokens after the prefix are encoded again.
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+def cache_nbytes(past_key_values):
+    """Memory held by a key/value cache in bytes"""
+    if hasattr(past_key_values, "layers"):  # transformers >= 4.56
+        tensors = [t for layer in past_key_values.layers for t in (layer.keys, layer.values) if t is not None]
+    elif hasattr(past_key_values, "key_cache"):
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    else:  # Legacy tuple of (key, value) per layer
+        tensors = [t for layer in past_key_values for t in layer]
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+def kv_bytes_per_token(model):
+    """Key/value cache memory one token takes in the model, in bytes"""
+    config = model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    element_size = torch.empty(0, dtype=model.dtype).element_size()
+    return 2 * config.num_hidden_layers * kv_heads * head_dim * element_size
+
+
+def common_prefix_length(a, b):
+    """Number of leading positions at which two 1-D token id tensors agree"""
+    n = min(len(a), len(b))
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def chat_prefix_length(tokenizer, messages, input_ids):
+    """Number of leading tokens of the rendered chat that do not depend on the last message.
+
+    The template is rendered again with two different placeholder contents for the last
+    message; the tokens all renderings share form the reusable prefix (template header,
+    system prompt and any earlier turns).
+    """
+    length = len(input_ids)
+    for placeholder in ("A", "Z"):
+        probe = messages[:-1] + [dict(messages[-1], content=placeholder)]
+        probe_ids = tokenizer.apply_chat_template(
+            probe, add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        )["input_ids"][0]
+        length = min(length, common_prefix_length(input_ids, probe_ids))
+    return length
+
+
+class PrefixKVCache:
+    """LRU cache of key/values for token prefixes, bounded by a memory budget in bytes.
+
+    Lookups return a copy of the longest cached prefix of the input (cropped when the input
+    only shares part of an entry), since generation extends the cache object in place.
+    Generation can also store the key/values of the whole finished sequence, so the next turn
+    of a conversation only encodes its new tokens; such an entry replaces the stored earlier turn
+    whose whole prompt it contains.
+    Key/values are always held in a DynamicCache, which can be cropped and extended; models
+    such as Gemma-2 would otherwise build a fixed-size cache sized to the prefix.
+    Only batch size 1 is supported.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, min_prefix_tokens=4):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.oversized = 0  # Entries not stored because they alone exceed max_bytes
+        # ((model name, model id), token ids) -> (ids tensor, past_key_values, nbytes, prompt length if stored after generation)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _model_name(model):
+        # The object id keeps two loaded versions of the same checkpoint (a hot-swap) apart. Callers that
+        # unload models (the FastAPI registry) call remove_model() before one is freed, so ids are not reused
+        # while cached; the Streamlit app keeps its one model for the life of the process
+        return (getattr(model, "name_or_path", None) or type(model).__name__, id(model))
+
+    def lookup(self, model, input_ids):
+        """Return (copy of past_key_values, prefix length) for the longest cached prefix, or (None, 0)"""
+        past_key_values, length = self._lookup(model, input_ids)
+        self._record(length)
+        return past_key_values, length
+
+    def _lookup(self, model, input_ids):
+        model_name = self._model_name(model)
+        best_key, best_length = None, 0
+        with self._lock:
+            for key, (ids, _, _, _) in self._entries.items():
+                if key[0] != model_name:
+                    continue
+                # At least one input token must remain for the model to produce logits from
+                length = min(common_prefix_length(ids, input_ids), len(input_ids) - 1)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None or best_length < self.min_prefix_tokens:
+                return None, 0
+            self._entries.move_to_end(best_key)
+            past_key_values = copy.deepcopy(self._entries[best_key][1])
+        if past_key_values.get_seq_length() > best_length:
+            past_key_values.crop(best_length)
+        return past_key_values, best_length
+
+    def _record(self, length):
+        with self._lock:
+            if length:
+                self.hits += 1
+                self.reused_tokens += length
+            else:
+                self.misses += 1
+
+    def add(self, model, prefix_ids):
+        """Encode prefix_ids (1-D tensor) with the model and store its key/values.
+
+        Only the tokens after the longest already cached prefix are encoded.
+        """
+        prefix_ids = prefix_ids.detach().to("cpu")
+        key = (self._model_name(model), tuple(prefix_ids.tolist()))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+        past_key_values, length = self._lookup(model, prefix_ids)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        with torch.no_grad():
+            outputs = model(
+                prefix_ids[length:].unsqueeze(0).to(model.device), past_key_values=past_key_values, use_cache=True
+            )
+        self._insert(key, prefix_ids, outputs.past_key_values)
+
+    def _insert(self, key, ids, past_key_values, prompt_length=None):
+        nbytes = cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            with self._lock:
+                self.oversized += 1
+                if self.oversized == 1:
+                    print(f"Warning: prefix cache entry of {nbytes / 2**20:.0f} MB ({len(ids)} tokens) exceeds "
+                          f"the {self.max_bytes / 2**20:.0f} MB budget and is not cached")
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            if prompt_length is not None:
+                # A stored turn whose whole prompt this sequence contains is the previous turn of the
+                # same conversation; only its reply may differ (re-tokenized), so it is not needed any more
+                for old_key in [k for k, entry in self._entries.items()
+                                if entry[3] is not None and k[0] == key[0]
+                                and common_prefix_length(entry[0], ids) >= entry[3]]:
+                    self.total_bytes -= self._entries.pop(old_key)[2]
+            self._entries[key] = (ids, past_key_values, nbytes, prompt_length)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted
+
+    def generate(self, model, input_ids, prefix_length=None, store_output=False, **generation_kwargs):
+        """model.generate() for a single sequence, reusing cached key/values of its prefix.
+
+        input_ids is a 1-D tensor. When prefix_length is given and no cached entry covers
+        that many tokens yet, input_ids[:prefix_length] is encoded and cached first.
+        With store_output=True the key/values of the prompt and generated tokens are cached
+        afterwards instead, for a follow-up prompt that extends this one (the next conversation turn).
+        Returns the output ids of model.generate (prompt followed by the generated tokens).
+        """
+        input_ids = input_ids.detach().to("cpu")
+        past_key_values, length = self._lookup(model, input_ids)
+        # A prefix encoded just now for this request still counts as a miss
+        self._record(length)
+        if (not store_output and prefix_length is not None and length < prefix_length
+                and self.min_prefix_tokens <= prefix_length < len(input_ids)):
+            self.add(model, input_ids[:prefix_length])
+            past_key_values, length = self._lookup(model, input_ids)
+        generation_kwargs["past_key_values"] = past_key_values if past_key_values is not None else DynamicCache()
+        batch = input_ids.unsqueeze(0).to(model.device)
+        with torch.no_grad():
+            if not store_output:
+                return model.generate(batch, attention_mask=torch.ones_like(batch), **generation_kwargs)
+            outputs = model.generate(
+                batch, attention_mask=torch.ones_like(batch), return_dict_in_generate=True, **generation_kwargs
+            )
+        if outputs.past_key_values is not None:
+            # The last generated token has not been fed through the model, so the cache is one shorter
+            ids = outputs.sequences[0, :outputs.past_key_values.get_seq_length()].detach().to("cpu")
+            self._insert((self._model_name(model), tuple(ids.tolist())), ids, outputs.past_key_values, len(input_ids))
+        return outputs.sequences
+
+    def remove_model(self, model):
+        """Drop every cached prefix of a model that is being unloaded"""
+        model_name = self._model_name(model)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == model_name]:
+                self.total_bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """Drop every cached prefix"""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Hit/miss counters and memory usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "reused_tokens": self.reused_tokens,
+                "oversized": self.oversized,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,141 @@
+# response_cache.py
+# Cache of generated responses keyed by the normalized prompt, model name and sampling parameters.
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """Normalize a prompt so trivially different spellings share a cache entry"""
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+    prompt = unicodedata.normalize("NFKC", prompt)
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def make_cache_key(prompt, model_name, **generation_kwargs):
+    """Build the cache key for a prompt, model and sampling parameters"""
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "model": model_name, "params": generation_kwargs},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def should_use_cache(do_sample, cache_sampled=False):
+    """Sampled generations differ on every call, so they are only cached when the caller opts in"""
+    return cache_sampled or not do_sample
+
+
+class ResponseCache:
+    """Two-tier response cache: an in-memory LRU and an optional on-disk SQLite tier.
+
+    Entries expire after ttl seconds. Each tier evicts its least recently used
+    entries once it holds more than its maximum number of entries.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, disk_path=None, disk_max_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache
+            (key TEXT PRIMARY KEY,
+             value TEXT,
+             expires_at REAL,
+             last_access REAL)
+            ''')
+            self._disk.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_access ON response_cache (last_access)")
+            self._disk.commit()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = json.loads(row[0]), row[1]
+                    if expires_at > now:
+                        self._disk.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+                        self._disk.commit()
+                        self._set_memory(key, value, expires_at)  # Promote to the memory tier
+                        self.hits += 1
+                        return value
+                    self._disk.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self._disk.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """Store value (must be JSON serializable) under key"""
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._set_memory(key, value, expires_at)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), expires_at, now),
+                )
+                self._disk.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+                self._disk.execute('''
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+                ''', (self.disk_max_entries,))
+                self._disk.commit()
+
+    def _set_memory(self, key, value, expires_at):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM response_cache")
+                self._disk.commit()
+
+    def stats(self):
+        """Hit/miss counters and tier sizes"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            disk_entries = None
+            if self._disk is not None:
+                disk_entries = self._disk.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
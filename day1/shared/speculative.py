@@ -0,0 +1,120 @@
+# speculative.py
+# Speculative (assisted) decoding with a small draft model: the draft proposes a few tokens, the main
+# model checks them all in one forward pass and keeps the ones it agrees with, so every main-model
+# pass can yield several tokens. Output follows the main model's distribution (identical for greedy
+# decoding); the speed-up depends on how often the draft's tokens are accepted, which is measured here.
+import threading
+import time
+
+import torch
+
+from precision import build_precision_pipeline
+
+
+def load_draft(draft_model_name, precision):
+    """Load the draft model's pipeline; use the main model's precision mode"""
+    return build_precision_pipeline(draft_model_name, precision)
+
+
+def make_decoder(pipe, draft, num_draft_tokens=5, stats=None):
+    """Pair the pipeline's model with a draft pipeline from load_draft().
+
+    The draft must use the same tokenizer as the main model (the same model family), because
+    its token IDs are passed to the main model as they are; otherwise ValueError is raised.
+    """
+    if draft.tokenizer.get_vocab() != pipe.tokenizer.get_vocab():
+        raise ValueError(
+            f"Draft model '{draft.model.name_or_path}' uses a different tokenizer; pick a smaller model of the same family"
+        )
+    return SpeculativeDecoder(pipe.model, draft.model, num_draft_tokens, stats)
+
+
+class AcceptanceStats:
+    """Running totals of draft tokens proposed and accepted over speculative generations"""
+
+    def __init__(self):
+        self.generations = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.verify_steps = 0  # Forward passes of the main model
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, run):
+        with self._lock:
+            self.generations += 1
+            self.drafted_tokens += run["drafted_tokens"]
+            self.accepted_tokens += run["accepted_tokens"]
+            self.generated_tokens += run["generated_tokens"]
+            self.verify_steps += run["verify_steps"]
+            self.seconds += run["seconds"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "generations": self.generations,
+                "drafted_tokens": self.drafted_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else None,
+                "tokens_per_step": self.generated_tokens / self.verify_steps if self.verify_steps else None,
+                "tokens_per_second": self.generated_tokens / self.seconds if self.seconds else None,
+            }
+
+
+class SpeculativeDecoder:
+    """Generates with the main model, using the draft model as the assistant.
+
+    Assisted generation works one sequence at a time, and the acceptance counts come from
+    forward hooks on both models, so generations through one decoder are serialized.
+    """
+
+    def __init__(self, model, draft_model, num_draft_tokens=5, stats=None):
+        self.model = model
+        self.draft_model = draft_model
+        # Starting number of tokens drafted per step; transformers adapts it to the acceptance rate
+        self.draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+        self.stats = stats if stats is not None else AcceptanceStats()
+        self._lock = threading.Lock()
+
+    def generate(self, input_ids, streamer=None, **generation_kwargs):
+        """Generate for one prompt (1-D token IDs).
+
+        Returns (output_ids of shape (1, prompt + new tokens), statistics of this generation).
+        """
+        input_ids = input_ids.reshape(1, -1).to(self.model.device)
+        calls = {"main": 0, "draft": 0}
+
+        def counter(name):
+            def hook(module, args, output):
+                calls[name] += 1
+            return hook
+
+        with self._lock:
+            handles = [self.model.register_forward_hook(counter("main")),
+                       self.draft_model.register_forward_hook(counter("draft"))]
+            try:
+                start_time = time.perf_counter()
+                with torch.no_grad():
+                    output_ids = self.model.generate(
+                        input_ids, attention_mask=torch.ones_like(input_ids), assistant_model=self.draft_model,
+                        streamer=streamer, **generation_kwargs,
+                    )
+                seconds = time.perf_counter() - start_time
+            finally:
+                for handle in handles:
+                    handle.remove()
+        generated = output_ids.shape[1] - input_ids.shape[1]
+        # Each main-model pass keeps the accepted draft tokens plus one token of its own
+        accepted = min(calls["draft"], max(0, generated - calls["main"]))
+        run = {
+            "drafted_tokens": calls["draft"],
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / calls["draft"] if calls["draft"] else None,
+            "generated_tokens": generated,
+            "verify_steps": calls["main"],
+            "seconds": seconds,
+            "tokens_per_second": generated / seconds if seconds else None,
+        }
+        self.stats.record(run)
+        return output_ids, run
@@ -0,0 +1,273 @@
+# telemetry.py
+# Lightweight in-process metrics (counters, gauges, histograms) rendered in the Prometheus text
+# exposition format, without a prometheus_client dependency. Recording is a dict update under a
+# lock, so it is cheap enough for the generation path; values that other objects already track
+# (cache hit counts, loader state) are read through callbacks only when metrics are rendered.
+import bisect
+import math
+import threading
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+MODEL_STATES = ("not_started", "loading", "ready", "failed")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set_function(self, function):
+        """Read the value when rendering: function() returns a number, or {label values tuple: number}"""
+        self._function = function
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def values(self):
+        """{label values tuple: value} for counters and gauges"""
+        if self._function is not None:
+            value = self._function()
+            return dict(value) if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{self._labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: ([*counts], total, count) for key, (counts, total, count) in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+    def summary(self, quantiles=(0.5, 0.95)):
+        """Count, mean and bucket-interpolated quantiles over all label values"""
+        snapshot = self._snapshot().values()
+        counts = [sum(c[i] for c, _, _ in snapshot) for i in range(len(self.buckets))]
+        total = sum(t for _, t, _ in snapshot)
+        count = sum(n for _, _, n in snapshot)
+        result = {"count": count, "mean": total / count if count else None}
+        for q in quantiles:
+            result[f"p{round(q * 100)}"] = self._quantile(counts, count, q) if count else None
+        return result
+
+    def _quantile(self, counts, count, q):
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                if upper == math.inf:
+                    return lower  # Above the largest bucket; the bound is the best estimate available
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-2]
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        return self._register(Histogram(name, documentation, buckets, labelnames))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class LLMMetrics:
+    """The metric set both apps record for text generation"""
+
+    def __init__(self):
+        registry = self.registry = MetricsRegistry()
+        self.queue_wait = registry.histogram(
+            "llm_queue_wait_seconds", "Time requests waited before inference started")
+        self.time_to_first_token = registry.histogram(
+            "llm_time_to_first_token_seconds", "Time from request to the first streamed token")
+        self.latency = registry.histogram(
+            "llm_request_latency_seconds", "Total time to produce a response", labelnames=("endpoint",))
+        self.tokens_per_second = registry.histogram(
+            "llm_tokens_per_second", "Generated tokens per second of inference time", TOKENS_PER_SECOND_BUCKETS)
+        self.prompt_tokens = registry.counter("llm_prompt_tokens_total", "Prompt tokens sent to the model")
+        self.generated_tokens = registry.counter("llm_generated_tokens_total", "Tokens generated by the model")
+        self.errors = registry.counter("llm_errors_total", "Failed requests by error type", labelnames=("type",))
+        self.cache_hits = registry.counter("llm_cache_hits_total", "Cache hits by cache", labelnames=("cache",))
+        self.model_state = registry.gauge("llm_model_state", "1 for the current model load state", labelnames=("state",))
+        self.in_flight = registry.gauge("llm_in_flight_requests", "Requests currently being processed")
+        self.batch_prompt_tokens = registry.counter(
+            "llm_batch_prompt_tokens_total", "Prompt token positions of batched generation, real or padding",
+            labelnames=("kind",))
+        self.padding_efficiency = registry.gauge(
+            "llm_batch_padding_efficiency", "Share of batched prompt token positions that are real tokens")
+        self.draft_tokens = registry.counter(
+            "llm_speculative_draft_tokens_total", "Draft model tokens of speculative decoding, proposed or accepted",
+            labelnames=("kind",))
+        self.draft_acceptance_rate = registry.gauge(
+            "llm_speculative_acceptance_rate", "Share of proposed draft tokens the main model accepted")
+
+    def record_generation(self, latency, endpoint, prompt_tokens=None, generated_tokens=None,
+                          compute_time=None, queue_wait=None, time_to_first_token=None):
+        """Record one finished generation; token counts and timings that are unknown are left out"""
+        self.latency.observe(latency, endpoint=endpoint)
+        if queue_wait is not None:
+            self.queue_wait.observe(queue_wait)
+        if time_to_first_token is not None:
+            self.time_to_first_token.observe(time_to_first_token)
+        self.record_tokens(prompt_tokens, generated_tokens, compute_time)
+
+    def record_tokens(self, prompt_tokens=None, generated_tokens=None, compute_time=None):
+        if prompt_tokens:
+            self.prompt_tokens.inc(prompt_tokens)
+        if generated_tokens:
+            self.generated_tokens.inc(generated_tokens)
+            if compute_time:
+                self.tokens_per_second.observe(generated_tokens / compute_time)
+
+    def record_error(self, error_type):
+        self.errors.inc(type=error_type)
+
+    def track_model_state(self, get_state):
+        """Report the model load state returned by get_state() (one of MODEL_STATES)"""
+        self.model_state.set_function(lambda: {(state,): int(get_state() == state) for state in MODEL_STATES})
+
+    def track_cache_hits(self, get_hits):
+        """Report cache hits from get_hits() -> {cache name: hit count}, read only when rendering"""
+        self.cache_hits.set_function(lambda: {(name,): hits for name, hits in get_hits().items()})
+
+    def track_padding(self, get_stats):
+        """Report padding of batched generation from get_stats() -> bucketing.PaddingStats.stats()"""
+        self.batch_prompt_tokens.set_function(
+            lambda: {("real",): get_stats()["real_tokens"], ("padding",): get_stats()["padded_tokens"]})
+        self.padding_efficiency.set_function(lambda: get_stats()["efficiency"])
+
+    def track_speculative(self, get_stats):
+        """Report draft acceptance from get_stats() -> speculative.AcceptanceStats.stats(), or None without a draft model"""
+        def drafted():
+            stats = get_stats()
+            return {} if stats is None else {("proposed",): stats["drafted_tokens"], ("accepted",): stats["accepted_tokens"]}
+
+        def acceptance_rate():
+            stats = get_stats()
+            return {} if stats is None or stats["acceptance_rate"] is None else stats["acceptance_rate"]
+
+        self.draft_tokens.set_function(drafted)
+        self.draft_acceptance_rate.set_function(acceptance_rate)
+
+    def render(self):
+        return self.registry.render()
+
+    def snapshot(self):
+        """Summary of the current values for display"""
+        return {
+            "latency": self.latency.summary(),
+            "time_to_first_token": self.time_to_first_token.summary(),
+            "queue_wait": self.queue_wait.summary(),
+            "tokens_per_second": self.tokens_per_second.summary(),
+            "prompt_tokens": sum(self.prompt_tokens.values().values()),
+            "generated_tokens": sum(self.generated_tokens.values().values()),
+            "errors": {key[0]: value for key, value in self.errors.values().items()},
+            "cache_hits": {key[0]: value for key, value in self.cache_hits.values().items()},
+            "model_state": next((key[0] for key, value in self.model_state.values().items() if value), None),
+            "in_flight": sum(self.in_flight.values().values()),
+            "draft_acceptance_rate": self.draft_acceptance_rate.values().get(()),
+        }